@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# coding: utf-8
+'''
+ASGI 入口 (可选, 需另外安装 ASGI 服务器, 如 `pip install uvicorn`)
+
+```
+python asgi.py  # 使用 uvicorn, 监听 main.host / main.port
+uvicorn asgi:app --host 0.0.0.0 --port 9010 --timeout-graceful-shutdown 5
+```
+
+- SSE 事件流 (`/api/status/events`, v4 `/events`) 由广播频道直接推送到事件循环中的异步生成器, 每个连接不占用线程
+- 其他请求仍由 Flask 处理 (在线程池中运行, 请求体 / 响应体均为流式)
+- *只能运行 1 个 worker 进程*
+'''
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Any, AsyncGenerator, Awaitable, Callable
+
+import main
+import plugin as pl
+from broadcast import ASGI_CHANNEL_KEY
+
+l = getLogger(__name__)
+
+WSGI_THREADS = 32
+'''处理普通 (非 SSE) 请求的线程数'''
+
+_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+Receive = Callable[[], Awaitable[dict[str, Any]]]
+Send = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+class _InputStream(io.RawIOBase):
+    '''
+    WSGI 请求体: 在线程中按需从 ASGI `receive()` 读取 (不会一次读入整个请求体)
+    '''
+
+    def __init__(self, receive: Receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buf = b''
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf and not self._eof:
+            msg = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if msg['type'] == 'http.request':
+                self._buf = msg.get('body', b'')
+                self._eof = not msg.get('more_body', False)
+            else:
+                # http.disconnect
+                self._eof = True
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def _environ(scope: dict[str, Any], body: io.BufferedReader) -> dict[str, Any]:
+    '''
+    由 ASGI scope 生成 WSGI environ
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ: dict[str, Any] = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        ASGI_CHANNEL_KEY: None
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        if key in environ:
+            environ[key] += ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        else:
+            environ[key] = value
+    return environ
+
+
+async def _sse(stream_func: Callable[[], AsyncGenerator[bytes, None]], receive: Receive, send: Send):
+    '''
+    在事件循环中发送频道的事件流, 直到客户端断开 / 订阅被关闭
+
+    :param stream_func: 生成事件流的函数 (由 `Channel.response()` 放入 environ)
+    '''
+    stream = stream_func()
+
+    async def pump():
+        async for frame in stream:
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    pump_task = asyncio.create_task(pump())
+    disconnect_task = asyncio.create_task(wait_disconnect())
+    try:
+        await asyncio.wait((pump_task, disconnect_task), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, disconnect_task):
+            task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+        await stream.aclose()
+    if pump_task.cancelled() or pump_task.exception() is not None:
+        return
+    # 订阅被关闭 (如读取过慢), 结束响应
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _http(scope: dict[str, Any], receive: Receive, send: Send):
+    loop = asyncio.get_running_loop()
+    environ = _environ(scope, io.BufferedReader(_InputStream(receive, loop)))
+    response_start: dict[str, Any] = {}
+    started = False
+
+    def call(message: dict[str, Any]):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+        if exc_info and started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response_start.update({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        })
+        return write
+
+    def write(chunk: bytes):
+        nonlocal started
+        if not started:
+            call(response_start)
+            started = True
+        if chunk:
+            call({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    def run():
+        '''
+        (线程池) 调用 Flask, 并流式发送普通响应; SSE 响应则返回其 app_iter, 由事件循环继续处理
+        '''
+        app_iter = main.app(environ, start_response)
+        if environ.get(ASGI_CHANNEL_KEY) is not None:
+            return app_iter
+        try:
+            for chunk in app_iter:
+                write(chunk)
+            write(b'')
+            call({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()  # type: ignore
+
+    app_iter = await loop.run_in_executor(_executor, run)
+    if app_iter is None:
+        return
+
+    # SSE: 响应头由事件循环发送, 连接结束后再关闭 app_iter (触发 call_on_close)
+    try:
+        await send(response_start)
+        await _sse(environ[ASGI_CHANNEL_KEY], receive, send)
+    finally:
+        if hasattr(app_iter, 'close'):
+            await loop.run_in_executor(_executor, app_iter.close)
+
+
+async def app(scope: dict[str, Any], receive: Receive, send: Send):
+    '''
+    ASGI 应用
+    '''
+    if scope['type'] == 'http':
+        await _http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            msg = await receive()
+            if msg['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif msg['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'websocket':
+        await send({'type': 'websocket.close'})
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        l.critical('ASGI mode requires an ASGI server, install it with: pip install uvicorn')
+        exit(1)
+    c = main.c
+    listening = f'{f"[{c.main.host}]" if ":" in c.main.host else c.main.host}:{c.main.port}'
+    l.info(f'Listening service on: {"https" if c.main.https else "http"}://{listening} (asgi)')
+    try:
+        uvicorn.run(
+            app,
+            host=c.main.host,
+            port=c.main.port,
+            ssl_certfile=c.main.ssl_cert if c.main.https else None,
+            ssl_keyfile=c.main.ssl_key if c.main.https else None,
+            log_config=None,  # 使用主程序的日志设置
+            access_log=False,
+            timeout_graceful_shutdown=5  # SSE 连接不会自行结束
+        )
+    except Exception as e:
+        l.critical(f'Critical error when running server: {e}')
+        main.p.trigger_event(pl.AppStoppedEvent(1))
+        exit(1)
+    main.p.trigger_event(pl.AppStoppedEvent(0))
+    l.info('Bye.')
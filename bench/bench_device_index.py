@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# coding: utf-8
+'''
+设备索引基准测试: 大量设备时读取排序后的设备列表 / 修改单个设备的耗时
+
+```
+python bench/bench_device_index.py  # 默认 10000 个设备
+python bench/bench_device_index.py 50000
+```
+
+- 使用内存存储 (`memory://`), 不会修改已有的数据
+'''
+
+import os
+import random
+import sys
+from pathlib import Path
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+os.environ['SLEEPY_MAIN_DATABASE'] = 'memory://'
+os.environ['SLEEPY_MAIN_DEBUG'] = 'false'
+
+import main  # noqa: E402
+
+
+def bench(func, n: int) -> float:
+    '''
+    :return: 平均耗时 (ms)
+    '''
+    start = perf_counter()
+    for _ in range(n):
+        func()
+    return (perf_counter() - start) / n * 1000
+
+
+def run(count: int):
+    d = main.d
+    ids = [f'dev{i:05d}' for i in range(count)]
+    random.seed(1)
+    random.shuffle(ids)
+    with d.batch():
+        for i, id in enumerate(ids):
+            d.device_set(id=id, show_name=id, using=[True, False, None][i % 3], status='app')
+    snap = d.snapshot()
+    print(f'devices: {count} (sorted={main.c.status.sorted}, using_first={main.c.status.using_first})')
+    print(f'snapshot:              {bench(d.snapshot, 50):8.3f}ms')
+    print(f'device_list (copy):    {bench(snap.device_list, 20):8.3f}ms')
+    print(f'device_set:            {bench(lambda: d.device_set(id=ids[1], show_name="x", using=random.random() < .5), 50):8.3f}ms')
+    print(f'device_set + snapshot: {bench(lambda: (d.device_set(id=ids[0], show_name="x", using=random.random() < .5), d.snapshot()), 50):8.3f}ms')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+# coding: utf-8
+'''
+设备扩展字段合并基准测试: 不同字段大小下 `utils.merge_patch()` 与旧的 `utils.deep_merge_dict()` 的耗时
+
+```
+python bench/bench_merge_patch.py
+```
+'''
+
+import sys
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import utils as u  # noqa: E402
+
+
+def bench(func, target: dict, patch: dict, number: int = 2000) -> float:
+    '''
+    :return: 平均耗时 (us)
+    '''
+    return timeit(lambda: func(target, patch), number=number) / number * 1e6
+
+
+def run():
+    print(f'{"keys":>6} | {"deep_merge (no change)":>22} {"merge_patch (no change)":>23} | {"deep_merge (1 change)":>21} {"merge_patch (1 change)":>22}')
+    for n in (10, 100, 1000, 10000):
+        target = {f'k{i}': {'v': i, 'tags': [i, i + 1], 'sub': {'x': str(i)}} for i in range(n)}
+        same = {'k0': {'v': 0}}
+        one = {'k0': {'v': -1}}
+        number = max(20, 20000 // n)
+        print(f'{n:>6} | {bench(u.deep_merge_dict, target, same, number):20.1f}us {bench(u.merge_patch, target, same, number):21.1f}us | '
+              f'{bench(u.deep_merge_dict, target, one, number):19.1f}us {bench(u.merge_patch, target, one, number):20.1f}us')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# coding: utf-8
+'''
+SSE 负载测试: 对运行中的服务打开大量 SSE 连接, 测量连接耗时及一次状态修改推送到所有连接的延迟
+
+```
+python asgi.py  # 另一个终端中启动服务 (ASGI 模式, 也可测试 python main.py)
+python bench/sse_load.py --port 9010 --secret <main.secret> -n 2000
+```
+
+- 一半连接 `/api/status/events`, 一半连接 v4 的 `/events`
+- 会修改服务的当前状态 (在 0 / 1 之间切换), 请勿对正式环境运行
+- 连接数较多时可能需要先调高打开文件数限制 (`ulimit -n`)
+'''
+
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+
+
+def request(base: str, path: str, secret: str) -> dict:
+    req = urllib.request.Request(base + path, headers={'Sleepy-Secret': secret})
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+
+async def connect(host: str, port: int, path: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    '''
+    打开 SSE 连接, 读取到第一个事件为止
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+    await writer.drain()
+    buf = b''
+    while b'\r\n\r\n' not in buf or b'\n\n' not in buf.split(b'\r\n\r\n', 1)[1]:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError(f'{path}: connection closed')
+        buf += data
+    return reader, writer
+
+
+async def run(args: argparse.Namespace):
+    base = f'http://{args.host}:{args.port}'
+    loop = asyncio.get_running_loop()
+    conns = []
+    start = time.perf_counter()
+    for i in range(0, args.n, args.batch):
+        conns += await asyncio.gather(*[connect(args.host, args.port, '/api/status/events' if k % 2 else '/events')
+                                        for k in range(i, min(args.n, i + args.batch))])
+    print(f'connected {len(conns)} streams in {time.perf_counter() - start:.1f}s')
+    stats = request(base, '/api/stats', args.secret)['stats']
+    print(f'server subscribers: {stats.get("sse_subscribers")}')
+
+    for round in range(args.rounds):
+        start = time.perf_counter()
+        await loop.run_in_executor(None, request, base, f'/api/status/set?status={(round + 1) % 2}', args.secret)
+        set_ms = (time.perf_counter() - start) * 1000
+
+        async def receive(reader: asyncio.StreamReader) -> float:
+            await reader.read(65536)
+            return time.perf_counter()
+
+        done = await asyncio.gather(*[receive(reader) for reader, _ in conns])
+        print(f'round {round}: set {set_ms:.1f}ms, delivered to all in {(max(done) - start) * 1000:.1f}ms')
+
+    for _, writer in conns:
+        writer.close()
+    await asyncio.sleep(1.5)
+    stats = request(base, '/api/stats', args.secret)['stats']
+    print('after close:', {k: v for k, v in stats.items() if k.startswith('sse')})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SSE load test')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9010)
+    parser.add_argument('--secret', required=True, help='main.secret of the server')
+    parser.add_argument('-n', type=int, default=2000, help='number of streams')
+    parser.add_argument('--batch', type=int, default=200, help='streams opened concurrently')
+    parser.add_argument('--rounds', type=int, default=5, help='status changes to measure')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,579 @@
+# coding: utf-8
+
+import asyncio
+from collections import Counter, deque
+from functools import partial
+from logging import getLogger
+from threading import Thread, Condition, Lock
+from time import time
+from typing import AsyncGenerator, Callable, Iterator
+
+import flask
+
+from scheduler import Scheduler, Job
+
+l = getLogger(__name__)
+
+ASGI_CHANNEL_KEY = 'sleepy.sse_channel'
+'''
+ASGI 模式 (`asgi.py`) 下请求 environ 中的键: 适配器将其设为 None, `Channel.response()` 再将其设为生成事件流的函数 (返回 `Channel.stream_async()`), 由适配器在事件循环中发送
+'''
+
+RESUME_GRACE = 60
+'''最后一个订阅者断开后继续记录事件的时间 (秒): 期间 (如网络波动) 重连的客户端仍可补发错过的事件'''
+
+RESUMED = b': resumed\n\n'
+'''断线重连且没有错过事件时发送的注释 (让响应头立即发出, 客户端会忽略)'''
+
+
+class Subscriber:
+    '''
+    SSE 订阅者 (每个连接一个): 广播线程放入已编码的事件, 连接所在的线程依次取出写入响应
+    '''
+
+    size = 1
+    '''包含的订阅者数'''
+
+    def __init__(self, maxsize: int):
+        self._queue: deque[bytes] = deque()
+        self._maxsize = maxsize
+        self._cond = Condition(Lock())
+        self.closed = False
+        '''已关闭 (取消订阅 / 队列溢出), 之后 `get()` 返回 None'''
+
+    def put(self, frame: bytes) -> bool:
+        '''
+        放入事件 (不阻塞)
+
+        :return: 是否成功 (队列已满时关闭订阅, 客户端重连后会重新获取完整状态)
+        '''
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._queue) >= self._maxsize:
+                self.closed = True
+                self._cond.notify()
+                return False
+            self._queue.append(frame)
+            self._cond.notify()
+            return True
+
+    def get(self) -> bytes | None:
+        '''
+        取出下一个事件 (无事件时等待)
+
+        :return: 事件, 已关闭则返回 None
+        '''
+        with self._cond:
+            while not self._queue and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return None
+            return self._queue.popleft()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class _AsyncSubscriber:
+    '''
+    asyncio SSE 订阅者 (只在所属事件循环的线程中访问)
+    '''
+
+    def __init__(self, maxsize: int):
+        self._queue: deque[bytes] = deque()
+        self._maxsize = maxsize
+        self._waiter: asyncio.Future | None = None
+        self.closed = False
+
+    def put(self, frame: bytes) -> bool:
+        '''
+        放入事件
+
+        :return: 是否成功 (队列已满时关闭订阅)
+        '''
+        if self.closed:
+            return True
+        if len(self._queue) >= self._maxsize:
+            self.close()
+            return False
+        self._queue.append(frame)
+        self._wake()
+        return True
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        self._wake()
+
+    def _wake(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self) -> bytes | None:
+        '''
+        取出下一个事件 (无事件时等待)
+
+        :return: 事件, 已关闭则返回 None
+        '''
+        while not self._queue and not self.closed:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        if self.closed:
+            return None
+        return self._queue.popleft()
+
+
+class _LoopGroup:
+    '''
+    同一事件循环中的 asyncio 订阅者
+    - 对广播线程表现为一个订阅者: 每次广播只唤醒一次事件循环, 再在循环中分发给各订阅者
+    '''
+
+    def __init__(self, channel: 'Channel', loop: asyncio.AbstractEventLoop):
+        self._channel = channel
+        self.loop = loop
+        self.members: set[_AsyncSubscriber] = set()
+
+    @property
+    def size(self) -> int:
+        return len(self.members)
+
+    def put(self, frame: bytes) -> bool:
+        '''
+        (广播线程) 将事件交给事件循环分发
+
+        :return: 是否成功 (事件循环已关闭时失败)
+        '''
+        try:
+            self.loop.call_soon_threadsafe(self._dispatch, frame)
+        except RuntimeError:
+            return False
+        return True
+
+    def _dispatch(self, frame: bytes):
+        for sub in list(self.members):
+            if not sub.put(frame):
+                # 连接可能仍阻塞在发送上, 先移出 (不再计入订阅者)
+                self._channel._remove_async(self, sub)
+                self._channel._dropped()
+
+    def close(self):
+        for sub in self.members:
+            sub.close()
+
+
+class Channel:
+    '''
+    广播频道: 数据变化时生成一次事件, 同一频道的所有订阅者收到完全相同的 bytes
+    - 没有订阅者时不生成事件
+    - 可同时有线程 (`stream()`) 和 asyncio (`stream_async()`) 订阅者
+    - 带 id 的频道保留最近的更新事件, 断线重连 (`Last-Event-ID`) 时补发错过的事件
+    '''
+
+    def __init__(self, broadcaster: 'Broadcaster', name: str, build: Callable[[], str | None], heartbeat: Callable[[], str], with_id: bool,
+                 snapshot: Callable[[], str] | None, event: str, temporary: bool = False):
+        self._b = broadcaster
+        self.name = name
+        self.temporary = temporary
+        '''临时频道 (没有订阅者超过 `RESUME_GRACE` 秒后由广播器删除)'''
+        self._build = build
+        self._snapshot: Callable[[], str] = snapshot or build  # type: ignore
+        self._event = event
+        self._heartbeat = heartbeat
+        self._with_id = with_id
+        self._subscribers: set[Subscriber | _LoopGroup] = set()
+        self._groups: dict[asyncio.AbstractEventLoop, _LoopGroup] = {}
+        self._replay = with_id and broadcaster.replay_size > 0
+        self._ring: deque[tuple[int, bytes]] = deque()
+        '''最近的 `(事件 id, 事件)` (仅 `_replay`)'''
+        self._ring_bytes = 0
+        self._last_id = broadcaster.event_id
+        '''最后一次更新事件的 id'''
+        self._known_from = broadcaster.event_id
+        '''`_ring` 包含 id 大于此值的全部更新事件'''
+        self._left_at = 0.
+        '''最后一次有订阅者断开的时间'''
+        self._lock = Lock()
+        '''保护 `_subscribers` / `_groups` (及其成员) / `_ring` 及相关状态'''
+
+    def _frame(self, event: str, data: str, event_id: int | None = None) -> bytes:
+        '''
+        编码 SSE 事件
+        '''
+        head = f'id: {event_id}\n' if self._with_id and event_id is not None else ''
+        return f'{head}event: {event}\ndata: {data}\n\n'.encode()
+
+    @property
+    def subscribers(self) -> int:
+        '''
+        订阅者数量
+        '''
+        with self._lock:
+            return sum(sub.size for sub in self._subscribers)
+
+    def _deliver(self, subscribers: list[Subscriber | _LoopGroup], frame: bytes) -> int:
+        '''
+        将事件放入订阅者的队列
+
+        :return: 收到事件的订阅者数
+        '''
+        sent = 0
+        for sub in subscribers:
+            if sub.put(frame):
+                sent += sub.size
+            else:
+                self._unsubscribe(sub, dropped=isinstance(sub, Subscriber))
+        return sent
+
+    def _record(self, event_id: int, frame: bytes | None):
+        '''
+        记录更新事件, 用于断线重连时补发 (需持有 `_lock`)
+
+        :param frame: 事件 (为 None 则表示未生成, 之前保留的事件不再连续, 全部丢弃)
+        '''
+        self._last_id = event_id
+        if not self._replay:
+            return
+        if frame is None:
+            self._ring.clear()
+            self._ring_bytes = 0
+            self._known_from = event_id
+            return
+        self._ring.append((event_id, frame))
+        self._ring_bytes += len(frame)
+        while self._ring and (len(self._ring) > self._b.replay_size or self._ring_bytes > self._b.replay_bytes):
+            old_id, old = self._ring.popleft()
+            self._ring_bytes -= len(old)
+            self._known_from = old_id
+
+    def _resume(self, last_event_id: int | None) -> tuple[list[bytes] | None, int]:
+        '''
+        查找客户端错过的事件 (需持有 `_lock`)
+
+        :param last_event_id: 客户端收到的最后一个事件 id (`Last-Event-ID`)
+        :return: (错过的事件 (无法补发则为 None), 当前事件 id)
+        '''
+        if self._replay and last_event_id is not None and self._known_from <= last_event_id <= self._last_id:
+            return [frame for event_id, frame in self._ring if event_id > last_event_id], self._last_id
+        return None, self._last_id
+
+    def idle(self, now: float) -> bool:
+        '''
+        是否没有订阅者, 且最后一个订阅者断开已超过 `RESUME_GRACE` 秒
+        '''
+        with self._lock:
+            return not self._subscribers and now - self._left_at >= RESUME_GRACE
+
+    def _touch(self):
+        '''
+        推迟 `idle()` 变为真 (即将有新订阅者)
+        '''
+        with self._lock:
+            self._left_at = time()
+
+    def publish(self, event_id: int) -> int:
+        '''
+        广播数据更新事件 (没有订阅者, 且最后一个订阅者断开已超过 `RESUME_GRACE` 秒时不生成)
+        '''
+        with self._lock:
+            if not self._subscribers and not (self._replay and time() - self._left_at < RESUME_GRACE):
+                self._record(event_id, None)
+                return 0
+        data = self._build()
+        if data is None:
+            # 变化与此频道无关: 不发送, 也不影响补发
+            with self._lock:
+                self._last_id = event_id
+            self._b._count('sse_suppressed')
+            return 0
+        frame = self._frame(self._event, data, event_id)
+        # 记录与取订阅者在同一锁内: 新订阅者要么从 `_ring` 补发, 要么从队列收到
+        with self._lock:
+            self._record(event_id, frame)
+            subscribers = list(self._subscribers)
+        return self._deliver(subscribers, frame)
+
+    def heartbeat(self) -> int:
+        '''
+        广播心跳 (`heartbeat`) 事件
+        '''
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return 0
+        return self._deliver(subscribers, self._frame('heartbeat', self._heartbeat()))
+
+    def _initial(self, missed: list[bytes] | None, event_id: int, data: str | None) -> list[bytes]:
+        '''
+        连接后首先发送的事件
+
+        :param missed: 错过的事件 (`_resume()`)
+        :param data: 完整数据 (仅 `missed` 为 None 时)
+        '''
+        if missed is None:
+            return [self._frame('update', data, event_id)]  # type: ignore
+        self._b._count('sse_resumed')
+        return missed or [RESUMED]
+
+    def response(self, last_event_id: int | None = None) -> flask.Response:
+        '''
+        生成订阅此频道的 SSE 响应 (需在请求上下文中调用)
+        - ASGI 模式下响应体为空, 由 `asgi.py` 在事件循环中发送事件流 (不占用线程)
+
+        :param last_event_id: 客户端收到的最后一个事件 id (`Last-Event-ID`, 见 `stream()`)
+        '''
+        environ = flask.request.environ
+        if ASGI_CHANNEL_KEY in environ:
+            environ[ASGI_CHANNEL_KEY] = partial(self.stream_async, last_event_id)
+            body = iter(())
+        else:
+            body = self.stream(last_event_id)
+        response = flask.Response(body, mimetype='text/event-stream', status=200)
+        response.headers['Cache-Control'] = 'no-cache'  # 禁用缓存
+        response.headers['X-Accel-Buffering'] = 'no'  # 禁用 Nginx 缓冲
+        return response
+
+    def stream(self, last_event_id: int | None = None) -> Iterator[bytes]:
+        '''
+        订阅频道, 依次返回编码后的 SSE 事件 (用作 `flask.Response` 的响应体)
+        - 首先补发 `last_event_id` 之后错过的事件; 无法补发 (太旧 / 未知) 时发送当前的完整数据
+        - 客户端断开 (生成器关闭) 时取消订阅
+
+        :param last_event_id: 客户端收到的最后一个事件 id
+        '''
+        sub = Subscriber(self._b.queue_size)
+        with self._lock:
+            self._subscribers.add(sub)
+            missed, event_id = self._resume(last_event_id)
+        self._b._subscribed(+1)
+        try:
+            # 先订阅再生成初始事件, 期间的更新不会丢失 (最多重复一次)
+            yield from self._initial(missed, event_id, self._snapshot() if missed is None else None)
+            while (frame := sub.get()) is not None:
+                yield frame
+        finally:
+            self._unsubscribe(sub)
+
+    async def stream_async(self, last_event_id: int | None = None) -> AsyncGenerator[bytes, None]:
+        '''
+        `stream()` 的 asyncio 版本 (在事件循环中等待, 不占用线程)
+        '''
+        loop = asyncio.get_running_loop()
+        sub = _AsyncSubscriber(self._b.queue_size)
+        with self._lock:
+            group = self._groups.get(loop)
+            if group is None:
+                group = self._groups[loop] = _LoopGroup(self, loop)
+                self._subscribers.add(group)
+            group.members.add(sub)
+            missed, event_id = self._resume(last_event_id)
+        self._b._subscribed(+1)
+        try:
+            # 生成初始事件可能读取存储后端, 在线程池中执行
+            data = await loop.run_in_executor(None, self._snapshot) if missed is None else None
+            for frame in self._initial(missed, event_id, data):
+                yield frame
+            while (frame := await sub.get()) is not None:
+                yield frame
+        finally:
+            sub.close()
+            self._remove_async(group, sub)
+
+    def _remove_async(self, group: _LoopGroup, sub: _AsyncSubscriber):
+        with self._lock:
+            removed = sub in group.members
+            group.members.discard(sub)
+            if not group.members and self._groups.get(group.loop) is group:
+                del self._groups[group.loop]
+                self._subscribers.discard(group)
+            self._left_at = time()
+        if removed:
+            self._b._subscribed(-1)
+
+    def _unsubscribe(self, sub: Subscriber | _LoopGroup, dropped: bool = False):
+        with self._lock:
+            if sub not in self._subscribers:
+                return
+            self._subscribers.discard(sub)
+            self._left_at = time()
+            size = sub.size
+            if isinstance(sub, _LoopGroup):
+                # 事件循环已关闭: 其中的订阅者不会再收到事件
+                self._groups.pop(sub.loop, None)
+                sub.close()
+                sub.members.clear()
+        sub.close()
+        if dropped:
+            self._dropped()
+        self._b._subscribed(-size)
+
+    def _dropped(self):
+        l.warning(f'[broadcast] {self.name}: subscriber too slow (queue full), disconnected')
+        self._b._count('sse_dropped')
+
+
+class Broadcaster:
+    '''
+    SSE 广播: 单个线程等待数据版本号变化, 每次变化对每个频道只生成 / 编码一次事件, 再将同一份 bytes 放入所有订阅者的队列
+    - 心跳由调度器中的一个共享任务发送 (仅在有订阅者时运行)
+    - 空闲时不会读取存储后端, 负载与连接数无关
+    - 事件 id 从启动时的毫秒时间戳开始递增, 重启后通常仍大于之前的 id; 重连时无法识别的 id 一律重新发送完整数据
+    '''
+
+    def __init__(self, wait_for_revision: Callable[[int, float | None], int], revision: int, scheduler: Scheduler,
+                 heartbeat: float = 30, queue_size: int = 64, replay_size: int = 256, replay_bytes: int = 1048576,
+                 name: str = 'broadcast'):
+        '''
+        :param wait_for_revision: 等待数据版本号变化的函数 (`Data.wait_for_revision`)
+        :param revision: 当前数据版本号
+        :param scheduler: 用于发送心跳的调度器
+        :param heartbeat: 心跳间隔 (秒)
+        :param queue_size: 每个订阅者最多积压的事件数 (超出则断开)
+        :param replay_size: 每个频道为断线重连保留的最近事件数 (为 0 则不保留)
+        :param replay_bytes: 每个频道保留的最近事件最多占用的字节数
+        :param name: 广播线程名
+        '''
+        self._wait_for_revision = wait_for_revision
+        self._revision = revision
+        self._scheduler = scheduler
+        self._heartbeat_interval = heartbeat
+        self.queue_size = queue_size
+        self.replay_size = replay_size
+        self.replay_bytes = replay_bytes
+        self._name = name
+        self._channels: dict[str, Channel] = {}
+        self._lock = Lock()
+        '''保护 `_channels` / `_subscriber_count` / `_heartbeat_job` / `_stats` / `event_id`'''
+        self._subscriber_count = 0
+        self._heartbeat_job: Job | None = None
+        self._stats: Counter[str] = Counter()
+        self.event_id = int(time() * 1000)
+        '''最后一次广播的事件 id (从启动时的毫秒时间戳开始递增)'''
+        self._thread: Thread | None = None
+
+    def channel(self, name: str, build: Callable[[], str | None], heartbeat: Callable[[], str] = lambda: '', with_id: bool = True,
+                snapshot: Callable[[], str] | None = None, event: str = 'update') -> Channel:
+        '''
+        注册频道
+
+        :param name: 频道名 (唯一)
+        :param build: 生成更新事件数据的函数 (每次数据变化只由广播线程调用一次, 与订阅者数无关; 返回 None 则不发送)
+        :param heartbeat: 生成 `heartbeat` 事件数据的函数
+        :param with_id: 事件是否带 `id`
+        :param snapshot: 生成连接后第一个 (`update`) 事件数据的函数 (为空则使用 `build`)
+        :param event: 更新事件的事件名
+        '''
+        with self._lock:
+            if name in self._channels:
+                raise ValueError(f'channel {name} already exists')
+            ch = self._channels[name] = Channel(self, name, build, heartbeat, with_id, snapshot, event)
+        return ch
+
+    def temporary_channel(self, name: str, build: Callable[[], str | None], snapshot: Callable[[], str] | None = None,
+                          event: str = 'update', limit: int = 64) -> Channel | None:
+        '''
+        获取临时频道, 不存在则注册 (用于按参数区分的事件流, 相同参数的订阅者共用一个频道)
+        - 没有订阅者超过 `RESUME_GRACE` 秒后自动删除
+
+        :param name: 频道名 (应包含区分频道的参数)
+        :param build: 同 `channel()` (频道已存在时忽略)
+        :param snapshot: 同 `channel()` (频道已存在时忽略)
+        :param event: 同 `channel()` (频道已存在时忽略)
+        :param limit: 临时频道数上限
+        :return: 频道, 超出上限则返回 None
+        '''
+        with self._lock:
+            ch = self._channels.get(name)
+            if ch is None:
+                temporary = [c for c in self._channels.values() if c.temporary]
+                if len(temporary) >= limit:
+                    self._prune(temporary)
+                    if sum(c.temporary for c in self._channels.values()) >= limit:
+                        return None
+                ch = self._channels[name] = Channel(self, name, build, lambda: '', True, snapshot, event, temporary=True)
+            ch._touch()
+        return ch
+
+    def _prune(self, channels: list[Channel]):
+        '''
+        删除空闲的临时频道 (需持有 `_lock`)
+        '''
+        now = time()
+        for ch in channels:
+            if ch.temporary and ch.idle(now):
+                del self._channels[ch.name]
+                l.debug(f'[broadcast] removed idle channel {ch.name}')
+
+    def start(self):
+        '''
+        启动广播线程
+        '''
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = Thread(target=self._loop, name=self._name, daemon=True)
+            self._thread.start()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        '''
+        广播计数器
+        - `sse_subscribers`: 当前订阅者数
+        - `sse_broadcasts`: 广播的更新次数
+        - `sse_frames`: 放入订阅者队列的事件数
+        - `sse_dropped`: 因队列溢出断开的订阅者数
+        - `sse_resumed`: 断线重连时只补发了错过事件的订阅者数
+        - `sse_suppressed`: 因与频道无关 (订阅过滤) 而未发送的更新次数
+        - `sse_channels`: 当前频道数 (包括临时频道)
+        '''
+        with self._lock:
+            return dict(self._stats, sse_subscribers=self._subscriber_count, sse_channels=len(self._channels))
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _subscribed(self, delta: int):
+        '''
+        订阅者数变化: 有订阅者时才运行心跳任务
+        '''
+        with self._lock:
+            self._subscriber_count += delta
+            if self._subscriber_count > 0 and not self._heartbeat_job:
+                self._heartbeat_job = self._scheduler.every(self._heartbeat_interval, self._heartbeat, name='sse_heartbeat')
+            elif self._subscriber_count <= 0 and self._heartbeat_job:
+                self._heartbeat_job.cancel()
+                self._heartbeat_job = None
+
+    def _channel_list(self) -> list[Channel]:
+        with self._lock:
+            return list(self._channels.values())
+
+    def _heartbeat(self):
+        sent = sum(ch.heartbeat() for ch in self._channel_list())
+        self._count('sse_frames', sent)
+
+    def _loop(self):
+        revision = self._revision
+        while True:
+            # 无超时等待: 数据不变化时不会醒来
+            revision = self._wait_for_revision(revision, None)
+            with self._lock:
+                self.event_id += 1
+                event_id = self.event_id
+                self._stats['sse_broadcasts'] += 1
+            sent = 0
+            for ch in self._channel_list():
+                try:
+                    sent += ch.publish(event_id)
+                except Exception as e:
+                    l.error(f'[broadcast] Error when publishing to channel {ch.name}: {e}')
+            self._count('sse_frames', sent)
+            with self._lock:
+                self._prune(list(self._channels.values()))
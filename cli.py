@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# coding: utf-8
+'''
+命令行工具: 导出 / 导入全部数据 (格式与 `/api/admin/export` / `/api/admin/import` 相同)
+
+```
+python cli.py export [-o 文件]   # 为空则输出到 stdout
+python cli.py import [文件]      # 为空则从 stdin 读取
+```
+
+- 使用与 `main.py` 相同的配置 (`data/.env` / `data/config.*` / 环境变量), 不加载插件
+- 可用于在存储后端之间迁移: `SLEEPY_MAIN_DATABASE=旧地址 python cli.py export -o dump.ndjson`, 再 `SLEEPY_MAIN_DATABASE=新地址 python cli.py import dump.ndjson`
+- *导入前请先停止使用同一存储的服务, 否则其缓存不会感知数据变化*
+'''
+
+import sys
+import logging
+from argparse import ArgumentParser
+
+import flask
+
+from config import Config as config_init
+import utils as u
+from data import Data as data_init
+
+l = logging.getLogger(__name__)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = ArgumentParser(prog='cli.py', description='Sleepy data export / import')
+    sub = parser.add_subparsers(dest='command', required=True)
+    export_parser = sub.add_parser('export', help='export all data as NDJSON')
+    export_parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    import_parser = sub.add_parser('import', help='import NDJSON exported by `export` (replaces all existing data)')
+    import_parser.add_argument('input', nargs='?', help='input file (default: stdin)')
+    args = parser.parse_args(argv)
+
+    # 日志输出到 stderr, 避免混入导出的数据
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    shandler = logging.StreamHandler(sys.stderr)
+    shandler.setFormatter(u.CustomFormatter(colorful=False))
+    root_logger.addHandler(shandler)
+    root_logger.setLevel(logging.INFO)
+
+    try:
+        c = config_init().config
+        d = data_init(
+            config=c,
+            app=flask.Flask(import_name=__name__)
+        )
+
+        if args.command == 'export':
+            f = open(args.output, 'w', encoding='utf-8', newline='\n') if args.output else sys.stdout
+            try:
+                line = ''
+                for line in d.export_data():
+                    f.write(line)
+            finally:
+                f.flush()
+                if f is not sys.stdout:
+                    f.close()
+            if not line.startswith('{"type":"end"'):
+                l.critical('export failed: incomplete export (see logs above)')
+                return 1
+        else:
+            if args.input:
+                with open(args.input, 'rb') as f:
+                    d.import_data(f)
+            else:
+                d.import_data(sys.stdin.buffer)
+    except u.APIUnsuccessful as e:
+        l.critical(f'{args.command} failed: {e.message}')
+        return 1
+    except u.SleepyException as e:
+        l.critical(e)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
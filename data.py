@@ -1,100 +1,167 @@
 # coding: utf-8
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging import getLogger
-from threading import Thread
-from time import sleep, time
-from typing import Any
+from threading import Thread, Lock, RLock, Condition, local
+from time import time
+from typing import IO, Any, Callable, Iterable, Iterator, NamedTuple
 from io import BytesIO
+from tempfile import TemporaryFile
+import atexit
+import json
+from collections import Counter
+from copy import deepcopy
+from types import MappingProxyType
+from contextlib import contextmanager
+from bisect import bisect_left, insort
+from heapq import heapify, heappop, heappush
 
 from werkzeug.security import safe_join
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import JSON, Integer, Float, String, Boolean, Text
-from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy.exc import SQLAlchemyError
 from objtyping import to_primitive
 import pytz
-import schedule
 
 import utils as u
 from models import ConfigModel, _StatusItemModel
+from scheduler import Scheduler
+from broadcast import Broadcaster
+from storage import Backend, JournalBackend, StorageError, create_backend, _DeviceStatusData, HOUR, DAY, STREAM_CHUNK, TABLES
 
 l = getLogger(__name__)
 
-db = SQLAlchemy()
-LIMIT = 1024
+EXPORT_FORMAT = 'sleepy-export'
+EXPORT_VERSION = 1
+'''导出数据的格式版本 (导入时只接受不高于此版本的数据)'''
 
 # -----
 
 
-class _MainData(db.Model):
+class _MainCache:
     '''
-    主程序数据
+    main 状态的进程内缓存 (写穿透, 由 `Data._lock` 保护)
+    - 启动时从存储后端加载一次, 之后所有读取均不再访问后端
+    - *仅适用于单进程部署 (多进程间不会同步)*
     '''
-    __tablename__ = 'main'
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
-    status: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
-    '''当前状态 id *(即 status_list 中的列表索引)*'''
-    private_mode: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
-    '''是否开启隐私模式 *(启用时 /query 返回中的 `device` 替换为空字典)*'''
-    last_updated: Mapped[float] = mapped_column(Float, default=time, onupdate=time)
-    '''数据最后更新时间 (utc timestamp)'''
+    __slots__ = ('status', 'private_mode', 'last_updated')
 
+    def __init__(self, row: dict[str, Any]):
+        self.status: int = row['status']
+        self.private_mode: bool = row['private_mode']
+        self.last_updated: float = row['last_updated']
 
-class _DeviceStatusData(db.Model):
-    '''
-    设备状态
-    '''
-    __tablename__ = 'device_status'
-    id: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
-    '''[必选] 设备唯一 id'''
-    show_name: Mapped[str] = mapped_column(String(LIMIT), nullable=False)
-    '''[必选] 设备显示名称'''
-    using: Mapped[bool] = mapped_column(Boolean, nullable=True)
-    '''[可选] 设备是否正在使用'''
-    status: Mapped[str] = mapped_column(Text, nullable=True)
-    '''[可选] 设备状态文本 (如打开的应用名)'''
-    fields: Mapped[dict] = mapped_column(JSON, default=dict, nullable=False)
-    '''[可选] 设备的扩展字段'''
-    last_updated: Mapped[float] = mapped_column(Float, default=time, onupdate=time)
-    '''(本设备) 数据最后更新时间 (utc timestamp)'''
-
-
-class _MetricsMetaData(db.Model):
+
+class DataSnapshot(NamedTuple):
     '''
-    访问统计元数据
+    数据快照 (由 `Data.snapshot()` 生成, 只读)
+    - 同一快照中的状态 / 设备 / 更新时间来自同一次读取, 互相一致
     '''
-    __tablename__ = 'metrics_meta'
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
-    today: Mapped[str] = mapped_column(String(LIMIT), nullable=False, default='')
-    week: Mapped[str] = mapped_column(String(LIMIT), nullable=False, default='')
-    month: Mapped[str] = mapped_column(String(LIMIT), nullable=False, default='')
-    year: Mapped[str] = mapped_column(String(LIMIT), nullable=False, default='')
+    status_id: int
+    '''当前状态 id'''
+    private_mode: bool
+    '''是否开启隐私模式'''
+    last_updated: float
+    '''数据最后更新时间 (utc)'''
+    revision: int
+    '''数据版本号 (见 `Data.revision`)'''
+    devices: MappingProxyType[str, dict[str, Any]]
+    '''排序后设备列表 (隐私模式下为空) *(请勿修改其中的值, 如需修改请使用 `device_list()`)*'''
+
+    def device_list(self) -> dict[str, dict[str, Any]]:
+        '''
+        排序后设备列表 (副本, 可随意修改)
+        '''
+        # 行中只有 fields 可能嵌套, 无需 deepcopy 整个列表
+        return {k: {**v, 'fields': deepcopy(v['fields']) if v['fields'] else {}} for k, v in self.devices.items()}
 
 
-class _MetricsData(db.Model):
+class _DeviceIndex:
     '''
-    访问统计数据
+    内存中的有序设备索引 (由 `Data._lock` 保护)
+    - 启动时从存储后端加载一次, 之后随每次提交的 设置 / 移除 / 清除 增量更新
+    - 按 `status.using_first` 分组 (使用中 / 未在使用 / 未知), `status.sorted` 时组内按 id 二分插入保持有序, 否则保持创建顺序
+    - 修改后首次读取时按已有顺序拼接出有序视图 (无需排序), 未修改时直接复用
+    - *仅适用于单进程部署 (多进程间不会同步)*
     '''
-    __tablename__ = 'metrics'
-    path: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
-    daily: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
-    weekly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
-    monthly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
-    yearly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
-    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
+    def __init__(self, rows: list[dict[str, Any]], sorted: bool, using_first: bool, not_using: str | None):
+        self._sorted = sorted
+        self._using_first = using_first
+        self._not_using = not_using
+        self._rows: dict[str, dict[str, Any]] = {}
+        '''设备 id -> 展示用的行 (已替换未在使用设备的状态名, 按创建顺序)'''
+        self._groups: tuple[list[str], list[str], list[str]] = ([], [], [])
+        '''各分组中有序的设备 id (仅 `sorted` 时维护)'''
+        self._view: MappingProxyType[str, dict[str, Any]] | None = None
+        '''有序视图 (修改后置空, 读取时重新生成)'''
+        for row in rows:
+            self.set(row)
+
+    def _group(self, row: dict[str, Any]) -> int:
+        '''
+        获取设备所在分组 (未启用 `using_first` 时只有一组)
+        '''
+        if not self._using_first:
+            return 0
+        using = row.get('using')
+        return 0 if using == True else 1 if using == False else 2
 
-class _PluginData(db.Model):
-    '''
-    插件数据
-    '''
-    __tablename__ = 'plugin'
-    id: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
-    '''插件 id'''
-    data: Mapped[dict] = mapped_column(JSON, default=dict, nullable=False)
-    '''插件数据'''
+    def _unlink(self, row: dict[str, Any]):
+        '''
+        从分组中移除设备 id
+        '''
+        keys = self._groups[self._group(row)]
+        del keys[bisect_left(keys, row['id'])]
+
+    def set(self, row: dict[str, Any]):
+        '''
+        设置设备 (已存在则替换, 保持原创建顺序)
+        '''
+        row = dict(row)
+        if self._not_using and row.get('using') == False:
+            row['status'] = self._not_using  # 如锁定了未在使用时状态名, 则替换
+        old = self._rows.get(row['id'])
+        if self._sorted and (old is None or self._group(old) != self._group(row)):
+            if old is not None:
+                self._unlink(old)
+            insort(self._groups[self._group(row)], row['id'])
+        self._rows[row['id']] = row
+        self._view = None
+
+    def remove(self, id: str):
+        '''
+        移除设备 (不存在则忽略)
+        '''
+        old = self._rows.pop(id, None)
+        if old is not None:
+            if self._sorted:
+                self._unlink(old)
+            self._view = None
+
+    def clear(self):
+        '''
+        清除所有设备
+        '''
+        self._rows.clear()
+        self._groups = ([], [], [])
+        self._view = None
+
+    def view(self) -> MappingProxyType[str, dict[str, Any]]:
+        '''
+        获取有序视图 (只读, 其中的行也请勿修改)
+        '''
+        if self._view is None:
+            rows = self._rows
+            if self._sorted:
+                devices = {k: rows[k] for keys in self._groups for k in keys}
+            elif self._using_first:
+                groups: tuple[dict, dict, dict] = ({}, {}, {})
+                for k, v in rows.items():
+                    groups[self._group(v)][k] = v
+                devices = groups[0] | groups[1] | groups[2]
+            else:
+                devices = dict(rows)
+            self._view = MappingProxyType(devices)
+        return self._view
 
 
 # -----
@@ -102,82 +169,238 @@ class _PluginData(db.Model):
 
 class Data:
     '''
-    data 类, 定义 sql 数据表格式
+    data 类, 管理 状态 / 设备 / 统计 / 插件数据 (持久化由 `storage` 中的存储后端负责)
     '''
 
     def __init__(self, config: ConfigModel, app: Flask):
         perf = u.perf_counter()
         self._app = app
         self._c = config
-        # 配置数据库地址
-        app.config['SQLALCHEMY_DATABASE_URI'] = self._c.main.database
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-        # 初始化数据库
-        db.init_app(app)
-        with app.app_context():
-            db.create_all()
-            main_data = _MainData.query.first()
-            if not main_data:
-                l.debug(f'[data] main_data not exist, creating a new one')
-                main_data = _MainData()
-                db.session.add(main_data)
-                db.session.commit()
-
-            metrics_metadata = _MetricsMetaData.query.first()
-            if self._c.metrics.enabled and not metrics_metadata:
-                l.debug(f'[data] metrics_metadata not exist, creating a new one')
-                metrics_metadata = _MetricsMetaData()
-                db.session.add(metrics_metadata)
-                db.session.commit()
-
-            # 启动 schedule loop
-            self._schedule_loop_th = Thread(target=self._schedule_loop, daemon=True)
-            self._schedule_loop_th.start()
+        # 锁顺序: `_plugin_lock` -> `_metrics_flush_lock` -> `_lock` -> 后端事务 -> `_metrics_lock` / `_expiry_changed`
+        # (插件代码可能在持有 `_plugin_lock` 时运行, 但不会在持有 `_lock` / 后端事务时运行)
+        self._lock = RLock()
+        self._local = local()
+        self._revision = 0
+        '''数据版本号 (每次提交修改 +1, 由 `self._lock` 保护)'''
+        self._revision_changed = Condition(self._lock)
+        '''版本号变化时通知 (`wait_for_revision()`)'''
+        self._stats: Counter[str] = Counter()
+        self._metrics_allow = frozenset(config.metrics.allow_list)
+        self._metrics_pending: Counter[tuple[str, int]] = Counter()
+        '''尚未写入的 metrics 增量 (`(路径, 小时桶开始时间)` -> 次数)'''
+        self._metrics_lock = Lock()
+        '''保护 `_metrics_pending`'''
+        self._metrics_flush_lock = RLock()
+        '''在写入 metrics 期间持有, 保证读取时 已写入 + 增量 的总数准确'''
+        self._plugin_data: dict[str, dict[str, Any]] = {}
+        '''插件数据缓存 (插件 id -> {键: 值})'''
+        self._plugin_dirty: set[tuple[str, str]] = set()
+        '''尚未写入的 `(插件 id, 键)` (缓存中已不存在的键将被删除)'''
+        self._plugin_lock = RLock()
+        '''保护 `_plugin_data` / `_plugin_dirty` / `_plugin_flushing` (`plugin_data_context()` 期间也会持有, 写入存储后端时不持有)'''
+        self._plugin_flushing = False
+        '''是否有线程正在写入插件数据 (同一时间只有一个线程写入, 保证写入顺序)'''
+        self._plugin_flush_again = False
+        '''写入期间有其他线程请求写入, 结束后需再写入一次'''
+        self._plugin_flushed = Condition(self._plugin_lock)
+        '''插件数据写入结束时通知 (`import_data()`)'''
+        self._expiry: list[tuple[float, str]] = []
+        '''设备过期时间堆 (`(过期时间, 设备 id)`, 设备更新后旧的项不会移除, 弹出时跳过)'''
+        self._expiry_deadline: dict[str, float] = {}
+        '''设备 id -> 当前有效的过期时间'''
+        self._expiry_changed = Condition(Lock())
+        '''保护 `_expiry` / `_expiry_deadline`, 最早的过期时间变化时通知'''
+        self._expire_handler: Callable[[str], Any] = self._device_expire
+        '''设备过期时的处理函数 (见 `start_device_expiry()`)'''
+
+        # 初始化存储后端 (由 `main.database` 决定)
+        self._backend: Backend = create_backend(config, app)
+        self._backend.migrate(self._metrics_periods())
+        self._main = _MainCache(self._backend.main_get())
+        self._load_devices(self._backend.device_all())
+        # 一次性载入所有插件数据
+        self._plugin_data = self._backend.plugin_all()
+
+        # 定时任务
+        self.scheduler = Scheduler(config.main.timezone)
+        '''定时任务调度器 (插件可通过 `Plugin.add_scheduled_job()` 添加任务)'''
+        self._schedule_jobs()
+        self.broadcaster = Broadcaster(
+            self.wait_for_revision,
+            self._revision,
+            self.scheduler,
+            heartbeat=config.status.sse_heartbeat,
+            queue_size=config.status.sse_queue_size,
+            replay_size=config.status.sse_replay_size,
+            replay_bytes=config.status.sse_replay_bytes
+        )
+        '''SSE 广播 (插件可通过 `broadcaster.channel()` 注册自己的事件流)'''
+
+        # 退出时先停止定时任务, 再写入未保存的 metrics / 插件数据, 最后关闭后端 (atexit 按注册的相反顺序执行)
+        atexit.register(self._backend.close)
+        atexit.register(self.flush_metrics)
+        atexit.register(self.flush_plugin_data)
+        atexit.register(self.scheduler.shutdown)
+        self.scheduler.start()
+        self.broadcaster.start()
 
         l.debug(f'[data] init took {perf()}ms')
 
-    def _throw(self, e: SQLAlchemyError):
+    def _throw(self, e: StorageError):
         '''
-        简化抛出 sql call failed error
+        简化抛出 storage call failed error
         '''
-        l.error(f'SQL Call Failed: {e}')
+        l.error(f'Storage Call Failed: {e}')
         raise u.APIUnsuccessful(500, 'Database Error')
 
-    def _schedule_loop(self):
-        if self._c.metrics.enabled:
-            # 先执行一次
-            self._metrics_refresh()
-            schedule.every().day.at('00:00:00', self._c.main.timezone).do(self._metrics_refresh)  # metrics check
-        schedule.every(self._c.main.cache_age).seconds.do(self._clean_cache)  # cache
+    @property
+    def backend(self) -> Backend:
+        '''
+        当前使用的存储后端
+        '''
+        return self._backend
 
-        while True:
-            schedule.run_pending()
-            sleep(1)
+    @property
+    def stats(self) -> dict[str, int]:
+        '''
+        数据层计数器
+        - `main_cache_saved`: 因 main 状态缓存而省去的后端读取次数
+        '''
+        with self._lock:
+            return dict(self._stats)
+
+    def _schedule_jobs(self):
+        '''
+        添加数据层的定时任务
+        '''
+        sch = self.scheduler
+        if self._c.metrics.enabled:
+            sch.daily('00:00:00', self._metrics_compact, run_now=True)  # metrics compaction (启动时先执行一次)
+            if self._c.metrics.flush_interval > 0:
+                sch.every(self._c.metrics.flush_interval, self.flush_metrics)  # metrics write-behind
+        if self._c.status.history_enabled:
+            sch.every(HOUR, self._history_cleanup, run_now=True)  # device history retention
+        if self._c.main.plugin_data_flush_interval > 0:
+            sch.every(self._c.main.plugin_data_flush_interval, self.flush_plugin_data)  # plugin data write-behind
+        if isinstance(self._backend, JournalBackend) and self._c.main.storage_options.memory_snapshot_interval > 0:
+            sch.every(self._c.main.storage_options.memory_snapshot_interval, self._backend.snapshot, name='journal_snapshot')  # journal snapshot
+        if self._c.main.cache_age > 0:
+            sch.every(self._c.main.cache_age, self._clean_cache)  # cache
 
     # --- 主程序数据访问
 
+    def _read_main(self, key: str) -> Any:
+        '''
+        从缓存读取 main 状态字段
+        '''
+        with self._lock:
+            self._stats['main_cache_saved'] += 1
+            pending: dict | None = getattr(self._local, 'pending', None)
+            if pending and key in pending:
+                # 写入中尚未提交的值
+                return pending[key]
+            return getattr(self._main, key)
+
+    @contextmanager
+    def _write(self):
+        '''
+        写入上下文: 持有锁, 在后端事务中执行, 退出时提交 `_commit()` 记录的 main 字段并更新缓存 / 设备索引
+        - 出现异常时回滚全部修改 (存储后端错误会转为 `APIUnsuccessful`)
+        - 嵌套调用会并入外层
+        '''
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        with self._lock:
+            self._local.pending = {}
+            self._local.device_ops = []
+            try:
+                with self._backend.transaction():
+                    yield
+                    values = self._local.pending
+                    device_ops = self._local.device_ops
+                    if values:
+                        self._backend.main_set(**values)
+            except StorageError as e:
+                self._throw(e)
+            finally:
+                self._local.pending = None
+                self._local.device_ops = None
+            if values:
+                for k, v in values.items():
+                    setattr(self._main, k, v)
+                for func, *args in device_ops:
+                    func(*args)
+                self._revision += 1
+                self._revision_changed.notify_all()
+
+    @contextmanager
+    def batch(self):
+        '''
+        批量修改: 其中的所有 设备 / 状态 / 隐私模式 修改在同一事务中执行, 退出时统一提交一次 (`last_updated` 只更新一次)
+        - 出现异常时回滚全部修改
+        - 执行期间其他线程的读写将等待批量操作结束
+
+        ```
+        with d.batch():
+            d.device_set(id='a', show_name='A')
+            d.status_id = 1
+        ```
+        '''
+        with self._write():
+            yield
+            if self._local.pending:
+                self._commit()
+
+    def _commit(self, **values):
+        '''
+        记录要写入的 main 字段, 在最外层的 `_write()` 结束时提交
+        - 未指定 `last_updated` 时自动设为当前时间
+        - *需在 `self._write()` 内调用*
+        '''
+        values.setdefault('last_updated', time())
+        self._local.pending.update(values)
+
+    @property
+    def revision(self) -> int:
+        '''
+        数据版本号: 每个修改 状态 / 设备 / 隐私模式 的事务提交后 +1 (批量修改只 +1 次)
+        - *仅在进程内递增, 重启后从 0 开始*
+        '''
+        with self._lock:
+            return self._revision
+
+    def wait_for_revision(self, revision: int, timeout: float | None = None) -> int:
+        '''
+        等待数据版本号与 `revision` 不同 (即数据已变化)
+
+        :param revision: 已知的版本号
+        :param timeout: 最长等待时间 (秒, 为空则一直等待)
+        :return: 当前版本号 (超时则与 `revision` 相同)
+        '''
+        with self._revision_changed:
+            self._revision_changed.wait_for(lambda: self._revision != revision, timeout)
+            return self._revision
+
+    def _write_main(self, **values):
+        '''
+        写入 main 状态字段 (同时更新缓存)
+        - 未指定 `last_updated` 时自动设为当前时间
+        '''
+        with self._write():
+            self._commit(**values)
+
+
     @property
     def status_id(self) -> int:
         '''
         当前的状态 id
         '''
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                return maindata.status
-        except SQLAlchemyError as e:
-            self._throw(e)
+        return self._read_main('status')
 
     @status_id.setter
     def status_id(self, value: int):
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                maindata.status = value
-                db.session.commit()
-        except SQLAlchemyError as e:
-            self._throw(e)
+        self._write_main(status=value)
 
     def get_status(self, status_id: int) -> tuple[bool, _StatusItemModel]:
         '''
@@ -192,8 +415,6 @@ class Data:
                 desc='未知的标识符，可能是配置问题。',
                 color='error'
             )
-        except SQLAlchemyError as e:
-            self._throw(e)
 
     @property
     def status(self) -> tuple[bool, _StatusItemModel]:
@@ -222,44 +443,22 @@ class Data:
         '''
         是否开启隐私模式 (不返回设备状态)
         '''
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                return maindata.private_mode
-        except SQLAlchemyError as e:
-            self._throw(e)
+        return self._read_main('private_mode')
 
     @private_mode.setter
     def private_mode(self, value: bool):
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                maindata.private_mode = value
-                db.session.commit()
-        except SQLAlchemyError as e:
-            self._throw(e)
+        self._write_main(private_mode=value)
 
     @property
     def last_updated(self) -> float:
         '''
         数据最后更新时间 (utc)
         '''
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                return maindata.last_updated
-        except SQLAlchemyError as e:
-            self._throw(e)
+        return self._read_main('last_updated')
 
     @last_updated.setter
     def last_updated(self, value: float):
-        try:
-            with self._app.app_context():
-                maindata: _MainData = _MainData.query.first()  # type: ignore
-                maindata.last_updated = value
-                db.session.commit()
-        except SQLAlchemyError as e:
-            self._throw(e)
+        self._write_main(last_updated=value)
 
     # --- 设备状态接口
 
@@ -268,14 +467,12 @@ class Data:
         '''
         原始设备列表 (未排序)
         '''
+        # 判断隐私模式
+        if self.private_mode:
+            return {}
         try:
-            # 判断隐私模式
-            if self.private_mode:
-                return {}
-            with self._app.app_context():
-                devices: list[_DeviceStatusData] = _DeviceStatusData.query.all().copy()
-                return {d.id: d for d in devices}
-        except SQLAlchemyError as e:
+            return {row['id']: _DeviceStatusData(**row) for row in self._backend.device_all()}
+        except StorageError as e:
             self._throw(e)
 
     @property
@@ -283,49 +480,27 @@ class Data:
         devices = self._raw_device_list
         return to_primitive(devices, format_date_time=False)  # type: ignore
 
+    def snapshot(self) -> DataSnapshot:
+        '''
+        获取当前数据的一致快照 (一次读取 main 状态及所有设备)
+        '''
+        with self._lock:
+            private_mode = self._read_main('private_mode')
+            return DataSnapshot(
+                status_id=self._read_main('status'),
+                private_mode=private_mode,
+                last_updated=self._read_main('last_updated'),
+                revision=self._revision,
+                # 隐私模式下不返回设备
+                devices=MappingProxyType({}) if private_mode else self._devices.view()
+            )
+
     @property
     def device_list(self) -> dict[str, dict[str, Any]]:
         '''
         排序后设备列表
         '''
-        try:
-            if self.private_mode:
-                # 隐私模式
-                devicelst = {}
-            elif self._c.status.using_first:
-                # 使用中优先
-                devicelst = {}  # devicelst = device_using
-                device_not_using = {}
-                device_unknown = {}
-                for k, v in self._raw_device_list_dict.items():
-                    if v.get('using') == True:  # * 正在使用
-                        devicelst[k] = v
-                    elif v.get('using') == False:  # * 未在使用
-                        if self._c.status.not_using:
-                            v['status'] = self._c.status.not_using  # 如锁定了未在使用时状态名, 则替换
-                        device_not_using[k] = v
-                    else:  # * 未知
-                        device_unknown[k] = v
-                if self._c.status.sorted:
-                    devicelst = dict(sorted(devicelst.items()))
-                    device_not_using = dict(sorted(device_not_using.items()))
-                    device_unknown = dict(sorted(device_unknown.items()))
-                # 追加到末尾
-                devicelst.update(device_not_using)
-                devicelst.update(device_unknown)
-            else:
-                # 正常获取
-                devicelst = self._raw_device_list_dict
-                # 如锁定了未在使用时状态名, 则替换
-                if self._c.status.not_using:
-                    for d in devicelst.keys():
-                        if devicelst[d].get('using') == False:
-                            devicelst[d]['status'] = self._c.status.not_using
-                if self._c.status.sorted:
-                    devicelst = dict(sorted(devicelst.items()))
-            return devicelst
-        except SQLAlchemyError as e:
-            self._throw(e)
+        return self.snapshot().device_list()
 
     def device_get(self, id: str) -> _DeviceStatusData | None:
         '''
@@ -334,17 +509,18 @@ class Data:
         :param id: 设备 id
         '''
         try:
-            with self._app.app_context():
-                device: _DeviceStatusData | None = _DeviceStatusData.query.filter_by(id=id).first()
-                return device
-        except SQLAlchemyError as e:
+            row = self._backend.device_get(id)
+        except StorageError as e:
             self._throw(e)
+        return _DeviceStatusData(**row) if row else None
 
     def device_set(self, id: str | None = None,
                    show_name: str | None = None,
                    using: bool | None = None,
                    status: str | None = None,
-                   fields: dict = {}
+                   fields: dict = {},
+                   ttl: int | None = None,
+                   touch: bool = True
                    ):
         '''
         设备状态设置
@@ -354,28 +530,67 @@ class Data:
         :param using: 设备是否正在使用
         :param status: 设备状态文本
         :param fields: 扩展字段
+        :param ttl: 设备存活时间 (秒, 为空则保持之前的设置, 0 为永不过期, 见 `status.device_ttl`)
+        :param touch: 是否更新设备的 `last_updated` (设备过期时为 False, 保留最后一次上报的时间)
         '''
-        try:
-            with self._app.app_context():
-                device = _DeviceStatusData.query.filter_by(id=id).first()
-                if not id:
-                    # 验证设备 id 不为空
-                    raise u.APIUnsuccessful(400, 'device id cannot be empty!')
-                if not device:
-                    # 在创建时验证必填字段 (显示名称不能为空)
-                    if not show_name:
-                        raise u.APIUnsuccessful(400, 'device show_name cannot be empty!')
-                    device = _DeviceStatusData()
-                    device.id = id
-                    db.session.add(device)
-                device.show_name = show_name or device.show_name
-                device.using = using if using is not None else device.using
-                device.status = status or device.status
-                device.fields = u.deep_merge_dict(device.fields, fields)
-                db.session.commit()
-                self.last_updated = time()
-        except SQLAlchemyError as e:
-            self._throw(e)
+        if not id:
+            # 验证设备 id 不为空
+            raise u.APIUnsuccessful(400, 'device id cannot be empty!')
+        with self._write():
+            device = self._backend.device_get(id)
+            if not device and not show_name:
+                # 在创建时验证必填字段 (显示名称不能为空)
+                raise u.APIUnsuccessful(400, 'device show_name cannot be empty!')
+            now = time()
+            new_fields, fields_changed = u.merge_patch(device['fields'] if device else {}, fields)
+            if fields_changed:
+                self._check_fields(new_fields)
+            row = {
+                'id': id,
+                'show_name': show_name or device['show_name'],  # type: ignore
+                'using': using if using is not None else (device['using'] if device else None),
+                'status': status or (device['status'] if device else None),
+                'fields': new_fields,
+                'last_updated': now if touch or not device else device['last_updated'],
+                'ttl': ttl if ttl is not None else (device.get('ttl') if device else None)
+            }
+            if device:
+                # 只写入有变化的列 (未变化的 fields 不会重新写入)
+                changes = {k: row[k] for k in ('show_name', 'using', 'status', 'ttl') if device.get(k) != row[k]}
+                if fields_changed:
+                    changes['fields'] = new_fields
+                changes['last_updated'] = row['last_updated']
+                self._backend.device_update(id, changes)
+            else:
+                self._backend.device_upsert(row)
+            self._local.device_ops.append((self._devices.set, row))
+            self._local.device_ops.append((self._expire_at, id, self._device_deadline(row)))
+            if self._c.status.history_enabled and (not device or (device['show_name'], device['using'], device['status']) != (row['show_name'], row['using'], row['status'])):
+                # 记录状态历史 (与设备状态在同一事务中写入)
+                self._backend.history_add({
+                    'device_id': id,
+                    'timestamp': now,
+                    'show_name': row['show_name'],
+                    'using': row['using'],
+                    'status': row['status']
+                })
+            self._commit(last_updated=now)
+
+    def _check_fields(self, fields: dict[str, Any]):
+        '''
+        检查设备扩展字段是否超出限制 (`status.fields_max_size` / `status.fields_max_keys` / `status.fields_max_depth`)
+        '''
+        c = self._c.status
+        if c.fields_max_keys > 0 or c.fields_max_depth > 0:
+            keys, depth = u.dict_stats(fields)
+            if c.fields_max_keys > 0 and keys > c.fields_max_keys:
+                raise u.APIUnsuccessful(413, f'too many keys in fields ({keys} > {c.fields_max_keys})')
+            if c.fields_max_depth > 0 and depth > c.fields_max_depth:
+                raise u.APIUnsuccessful(413, f'fields nested too deep ({depth} > {c.fields_max_depth})')
+        if c.fields_max_size > 0:
+            size = len(json.dumps(fields, ensure_ascii=False, separators=(',', ':')).encode())
+            if size > c.fields_max_size:
+                raise u.APIUnsuccessful(413, f'fields too large ({size} > {c.fields_max_size} bytes)')
 
     def device_remove(self, id: str):
         '''
@@ -383,107 +598,353 @@ class Data:
 
         :param id: 设备唯一 id
         '''
-        try:
-            with self._app.app_context():
-                device: _DeviceStatusData | None = _DeviceStatusData.query.filter_by(id=id).first()
-                if device:
-                    db.session.delete(device)
-                    db.session.commit()
-                    self.last_updated = time()
-        except SQLAlchemyError as e:
-            self._throw(e)
+        with self._write():
+            if self._backend.device_delete(id):
+                self._local.device_ops.append((self._devices.remove, id))
+                self._local.device_ops.append((self._expire_at, id, None))
+                self._commit()
 
     def device_clear(self):
         '''
         清除设备状态
         '''
+        with self._write():
+            self._backend.device_clear()
+            self._local.device_ops.append((self._devices.clear,))
+            self._local.device_ops.append((self._expire_clear,))
+            self._commit()
+
+    def _load_devices(self, devices: list[dict[str, Any]]):
+        '''
+        由所有设备行重建设备索引及过期时间 (启动 / 导入后调用)
+        '''
+        self._devices = _DeviceIndex(
+            devices,
+            sorted=self._c.status.sorted,
+            using_first=self._c.status.using_first,
+            not_using=self._c.status.not_using
+        )
+        self._expire_clear()
+        for row in devices:
+            self._expire_at(row['id'], self._device_deadline(row))
+
+    # --- 设备过期
+
+    def _device_deadline(self, row: dict[str, Any]) -> float | None:
+        '''
+        计算设备的过期时间 (不会过期则返回 None)
+        '''
+        ttl = row.get('ttl')
+        if ttl is None:
+            ttl = self._c.status.device_ttl
+        if ttl <= 0 or (self._c.status.device_expire_action == 'not_using' and row.get('using') != True):
+            return None
+        return row['last_updated'] + ttl
+
+    def _expire_at(self, id: str, deadline: float | None, keep: bool = False):
+        '''
+        设置设备的过期时间
+
+        :param deadline: 过期时间 (为空则取消)
+        :param keep: 已有过期时间时不修改
+        '''
+        with self._expiry_changed:
+            if keep and id in self._expiry_deadline:
+                return
+            if deadline is None:
+                self._expiry_deadline.pop(id, None)
+                return
+            self._expiry_deadline[id] = deadline
+            if len(self._expiry) > 2 * len(self._expiry_deadline) + 64:
+                # 失效的项过多时重建
+                self._expiry = [(v, k) for k, v in self._expiry_deadline.items()]
+                heapify(self._expiry)
+            else:
+                heappush(self._expiry, (deadline, id))
+            if self._expiry[0] == (deadline, id):
+                self._expiry_changed.notify()
+
+    def _expire_clear(self):
+        '''
+        取消所有设备的过期时间
+        '''
+        with self._expiry_changed:
+            self._expiry.clear()
+            self._expiry_deadline.clear()
+
+    def start_device_expiry(self, handler: Callable[[str], Any] | None = None):
+        '''
+        启动设备过期检查 (`status.device_ttl`)
+        - 启动前到期的设备会在启动后立即处理
+
+        :param handler: 设备过期时的处理函数 (参数为设备 id, 在不持有数据锁时调用, 返回 False 表示未处理, 将在一个存活时间后再次检查), 为空则直接按 `status.device_expire_action` 修改 (不触发插件事件)
+        '''
+        if handler:
+            self._expire_handler = handler
+        self._expiry_loop_th = Thread(target=self._expiry_loop, daemon=True)
+        self._expiry_loop_th.start()
+
+    def _expiry_loop(self):
+        '''
+        设备过期检查: 等待到最早的过期时间, 再处理到期的设备 (无需扫描所有设备)
+        - 处理函数在释放锁后调用, 由其在写入前确认设备仍已过期 (`device_expired()`)
+        '''
+        while True:
+            with self._expiry_changed:
+                while True:
+                    now = time()
+                    if self._expiry and self._expiry[0][0] <= now:
+                        deadline, id = heappop(self._expiry)
+                        if self._expiry_deadline.get(id) == deadline:
+                            del self._expiry_deadline[id]
+                            break
+                    else:
+                        self._expiry_changed.wait(self._expiry[0][0] - now if self._expiry else None)
+            l.debug(f'[device_expire] device {id} expired')
+            try:
+                handled = self._expire_handler(id)
+            except Exception as e:
+                l.error(f'[device_expire] Error when expiring device {id}: {e}')
+                continue
+            if handled is False:
+                self._expire_retry(id)
+
+    def _expire_retry(self, id: str):
+        '''
+        过期处理未执行 (如被插件拦截) 时, 在一个存活时间后再次检查 (期间设备已更新则不修改)
+        '''
         try:
-            with self._app.app_context():
-                _DeviceStatusData.query.delete()
-                db.session.commit()
-                self.last_updated = time()
-        except SQLAlchemyError as e:
+            row = self._backend.device_get(id)
+        except StorageError as e:
+            l.error(f'[device_expire] Error when rescheduling device {id}: {e}')
+            return
+        if row:
+            self._expire_at(id, self._device_deadline(row | {'last_updated': time()}), keep=True)
+
+    def device_expired(self, id: str) -> bool:
+        '''
+        设备是否已过期 (设备不存在 / 不会过期时为 False)
+        - 在 `batch()` 中调用可保证写入前设备未被其他线程更新
+
+        :param id: 设备唯一 id
+        '''
+        try:
+            row = self._backend.device_get(id)
+        except StorageError as e:
             self._throw(e)
+        if not row:
+            return False
+        deadline = self._device_deadline(row)
+        return deadline is not None and deadline <= time()
+
+    def _device_expire(self, id: str):
+        '''
+        按 `status.device_expire_action` 处理过期设备 (设备已被移除 / 更新则忽略)
+        '''
+        with self._write():
+            if not self.device_expired(id):
+                return
+            if self._c.status.device_expire_action == 'remove':
+                self.device_remove(id)
+            else:
+                self.device_set(id=id, using=False, touch=False)
+
+    def device_history(self, id: str | None = None, start: float | None = None, end: float | None = None, limit: int = 50, cursor: int | None = None) -> list[dict[str, Any]]:
+        '''
+        获取设备状态历史 (从新到旧)
+
+        :param id: 设备唯一 id (为空则返回所有设备)
+        :param start: 开始时间 (utc timestamp, 包括)
+        :param end: 结束时间 (utc timestamp, 不包括)
+        :param limit: 最多返回条数
+        :param cursor: 分页游标 (上一页最后一条的 `id`, 只返回更早的记录)
+        '''
+        try:
+            return self._backend.history_query(id, start, end, limit, cursor)
+        except StorageError as e:
+            self._throw(e)
+
+    def _history_cleanup(self):
+        '''
+        (在 每小时 / 启动时 执行) 按 `status.history_retention` / `status.history_max_rows` 清理设备状态历史
+        '''
+        perf = u.perf_counter()
+        retention = self._c.status.history_retention
+        try:
+            with self._backend.transaction():
+                removed = self._backend.history_cleanup(
+                    before=time() - retention * DAY if retention > 0 else None,
+                    max_rows=self._c.status.history_max_rows
+                )
+        except StorageError as e:
+            l.error(f'[_history_cleanup] Error: {e}')
+            return
+        l.debug(f'[_history_cleanup] removed {removed} rows, took {perf()}ms')
 
     # --- 统计数据访问
 
+    def _local_day_start(self, ts: float) -> int:
+        '''
+        获取时间戳所在 (设置时区的) 当天 0 点的时间戳
+        '''
+        tz = pytz.timezone(self._c.main.timezone)
+        dt = datetime.fromtimestamp(ts, tz)
+        return int(tz.localize(datetime(dt.year, dt.month, dt.day)).timestamp())
+
+    def _hour_start(self, ts: float) -> int:
+        '''
+        获取时间戳所在 (设置时区的) 整点的时间戳
+        '''
+        offset = int(datetime.fromtimestamp(ts, pytz.timezone(self._c.main.timezone)).utcoffset().total_seconds())  # type: ignore
+        ts = int(ts)
+        return ts - (ts + offset) % HOUR
+
+    def _metrics_periods(self) -> tuple[int, int, int, int]:
+        '''
+        获取当前 今日 / 本周 / 本月 / 今年 的开始时间戳 (基于设置的时区)
+        '''
+        tz = pytz.timezone(self._c.main.timezone)
+        now = datetime.now(tz)
+        today = datetime(now.year, now.month, now.day)
+        return (
+            int(tz.localize(today).timestamp()),
+            int(tz.localize(today - timedelta(days=now.weekday())).timestamp()),
+            int(tz.localize(datetime(now.year, now.month, 1)).timestamp()),
+            int(tz.localize(datetime(now.year, 1, 1)).timestamp())
+        )
+
+    def metrics_allowed(self, path: str) -> bool:
+        '''
+        路径是否计入统计 (在 `metrics.allow_list` 中)
+        '''
+        return path in self._metrics_allow
+
     def record_metrics(self, path: str, count: int = 1, override: bool = False):
         '''
         记录 metrics 数据
+        - 增加的次数先累计在内存中, 由 `flush_metrics()` 定时批量写入 (间隔见 `metrics.flush_interval`)
 
         :param path: 路径
         :param count: 记录增加次数 (调试使用?)
-        :param override: 是否直接替换值而不是增加
+        :param override: 是否直接替换值而不是增加 *(会清除此路径的历史, 并立即写入)*
         '''
-        if not path in self._c.metrics.allow_list:
+        if not self.metrics_allowed(path):
+            return
+        hour = self._hour_start(time())
+        if override:
+            try:
+                with self._metrics_flush_lock:
+                    self.flush_metrics()
+                    with self._backend.transaction():
+                        self._backend.metrics_reset(path, hour, count)
+            except StorageError as e:
+                self._throw(e)
             return
+        with self._metrics_lock:
+            self._metrics_pending[(path, hour)] += count
+        if self._c.metrics.flush_interval <= 0:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        '''
+        将内存中累计的 metrics 增量批量写入存储后端 (一次提交)
+        - 写入失败时增量会放回, 等待下次写入
+        '''
+        with self._metrics_flush_lock:
+            with self._metrics_lock:
+                pending, self._metrics_pending = self._metrics_pending, Counter()
+            if not pending:
+                return
+            perf = u.perf_counter()
+            try:
+                with self._backend.transaction():
+                    self._backend.metrics_add({(path, start, HOUR): count for (path, start), count in pending.items()})
+            except StorageError as e:
+                l.error(f'[metrics] flush failed, will retry later: {e}')
+                with self._metrics_lock:
+                    self._metrics_pending.update(pending)
+                return
+            l.debug(f'[metrics] flushed {len(pending)} buckets ({sum(pending.values())} records) took {perf()}ms')
+
+    def _metrics_unflushed(self) -> Counter[tuple[str, int]]:
+        '''
+        获取尚未写入的 metrics 增量 (副本)
+        '''
+        with self._metrics_lock:
+            return self._metrics_pending.copy()
+
+    def _metrics_summary(self, path: str | None = None) -> dict[str, list[int]]:
+        '''
+        从分桶数据汇总 今日 / 本周 / 本月 / 今年 / 全部 的访问次数 (包含尚未写入的增量)
+
+        :param path: 仅汇总指定路径 (为空则汇总所有路径)
+        :return: `{路径: [今日, 本周, 本月, 今年, 全部]}`
+        '''
+        periods = self._metrics_periods()
         try:
-            with self._app.app_context():
-                metric: _MetricsData | None = _MetricsData.query.filter_by(path=path).first()
-                if not metric:
-                    metric = _MetricsData()
-                    metric.path = path
-                    metric.daily = 0
-                    metric.weekly = 0
-                    metric.monthly = 0
-                    metric.yearly = 0
-                    metric.total = 0
-                    db.session.add(metric)
-                if override:
-                    metric.daily = count
-                    metric.weekly = count
-                    metric.monthly = count
-                    metric.yearly = count
-                    metric.total = count
-                else:
-                    metric.daily += count
-                    metric.weekly += count
-                    metric.monthly += count
-                    metric.yearly += count
-                    metric.total += count
-                db.session.commit()
-        except SQLAlchemyError as e:
+            with self._metrics_flush_lock:
+                ret = self._backend.metrics_summary(periods, path)
+                pending = self._metrics_unflushed()
+        except StorageError as e:
             self._throw(e)
+        for (p, start), count in pending.items():
+            if path is not None and p != path:
+                continue
+            counts = ret.setdefault(p, [0, 0, 0, 0, 0])
+            for i, period_start in enumerate(periods):
+                if start >= period_start:
+                    counts[i] += count
+            counts[4] += count
+        return ret
 
     @property
     def metrics_data(self) -> tuple[dict[str, int], dict[str, int], dict[str, int], dict[str, int], dict[str, int]]:
         '''
-        获取 metrics 数据
+        获取 metrics 数据 (包含尚未写入的增量)
 
         :return: (今日, 本周, 本月, 今年, 全部)
         '''
-        try:
-            raw_metrics: list[_MetricsData] = _MetricsData.query.all()
-            daily = {}
-            weekly = {}
-            monthly = {}
-            yearly = {}
-            total = {}
-            for i in raw_metrics:
-                daily[i.path] = i.daily
-                weekly[i.path] = i.weekly
-                monthly[i.path] = i.monthly
-                yearly[i.path] = i.yearly
-                total[i.path] = i.total
-            return (daily, weekly, monthly, yearly, total)
-        except SQLAlchemyError as e:
-            self._throw(e)
+        daily = {}
+        weekly = {}
+        monthly = {}
+        yearly = {}
+        total = {}
+        for path, counts in self._metrics_summary().items():
+            daily[path], weekly[path], monthly[path], yearly[path], total[path] = counts
+        return (daily, weekly, monthly, yearly, total)
 
     @property
     def metric_data_index(self) -> tuple[int, int, int, int, int]:
         '''
-        获取主页 (/) 的 metric 数据
+        获取主页 (/) 的 metric 数据 (包含尚未写入的增量)
 
         :return: (今日, 本周, 本月, 今年, 全部)
         '''
+        return tuple(self._metrics_summary('/').get('/', [0, 0, 0, 0, 0]))  # type: ignore
+
+    def metrics_range(self, path: str | None, start: int, end: int, step: int) -> list[int]:
+        '''
+        按时间范围汇总访问次数 (包含尚未写入的增量)
+        - 以桶的开始时间归入对应的区间, 精度受桶大小限制 (近期为小时, 更早为天)
+
+        :param path: 路径 (为空则汇总所有路径)
+        :param start: 开始时间 (utc timestamp, 包括)
+        :param end: 结束时间 (utc timestamp, 不包括)
+        :param step: 区间长度 (秒)
+        :return: 每个区间的访问次数
+        '''
+        ret = [0] * -(-(end - start) // step)
         try:
-            raw_metric: _MetricsData | None = _MetricsData.query.filter_by(path='/').first()
-            if raw_metric:
-                return (raw_metric.daily, raw_metric.weekly, raw_metric.monthly, raw_metric.yearly, raw_metric.total)
-            else:
-                return (0, 0, 0, 0, 0)
-        except SQLAlchemyError as e:
+            with self._metrics_flush_lock:
+                for i, count in self._backend.metrics_range(path, start, end, step).items():
+                    ret[i] += count
+                pending = self._metrics_unflushed()
+        except StorageError as e:
             self._throw(e)
+        for (p, bucket_start), count in pending.items():
+            if (path is None or p == path) and start <= bucket_start < end:
+                ret[(bucket_start - start) // step] += count
+        return ret
 
     @property
     def metrics_resp(self) -> dict[str, Any]:
@@ -512,86 +973,328 @@ class Data:
                 'enabled': False
             }
 
-    def _metrics_refresh(self):
+    def _metrics_compact(self):
         '''
-        (在 每日 0 点 / 启动时 执行) 刷新 metrics 数据
+        (在 每日 0 点 / 启动时 执行) 将超过保留时间 (`metrics.bucket_retention`) 的小时桶合并为天桶
         '''
         perf = u.perf_counter()
+        # 先写入尚未保存的增量
+        self.flush_metrics()
+        cutoff = self._local_day_start(time() - self._c.metrics.bucket_retention * DAY)
         try:
-            with self._app.app_context():
-                raw_metrics: list[_MetricsData] = _MetricsData.query.all()
-                meta_metrics: _MetricsMetaData = _MetricsMetaData.query.first()  # type: ignore
-
-                # get today
-                now = datetime.now(pytz.timezone(self._c.main.timezone))
-                year = f'{now.year}'
-                month = f'{now.year}-{now.month}'
-                today = f'{now.year}-{now.month}-{now.day}'
-                week = f'{now.year}-{now.isocalendar().week}'
-
-                if today != meta_metrics.today:
-                    l.debug(f'[metrics] today changed: {meta_metrics.today} -> {today}')
-                    meta_metrics.today = today
-                    for i in raw_metrics:
-                        i.daily = 0
-
-                if week != meta_metrics.week:
-                    l.debug(f'[metrics] week changed: {meta_metrics.week} -> {week}')
-                    meta_metrics.week = week
-                    for i in raw_metrics:
-                        i.weekly = 0
-
-                if month != meta_metrics.month:
-                    l.debug(f'[metrics] month changed: {meta_metrics.month} -> {month}')
-                    meta_metrics.month = month
-                    for i in raw_metrics:
-                        i.monthly = 0
-
-                if year != meta_metrics.year:
-                    l.debug(f'[metrics] year changed: {meta_metrics.year} -> {year}')
-                    meta_metrics.year = year
-                    for i in raw_metrics:
-                        i.yearly = 0
-
-                db.session.commit()
-        except SQLAlchemyError as e:
-            l.error(f'[_metrics_refresh] Error: {e}')
-        l.debug(f'[_metrics_refresh] took {perf()}ms')
+            with self._metrics_flush_lock, self._backend.transaction():
+                days = self._backend.metrics_compact(cutoff, self._local_day_start)
+            if days:
+                l.debug(f'[metrics] compacted hourly buckets into {days} daily buckets')
+        except StorageError as e:
+            l.error(f'[_metrics_compact] Error: {e}')
+        l.debug(f'[_metrics_compact] took {perf()}ms')
 
     # --- 插件数据访问
 
+    def _plugin_mark_dirty(self, id: str, keys):
+        '''
+        标记插件数据中的键已修改 / 删除 (需持有 `_plugin_lock`)
+        '''
+        self._plugin_dirty.update((id, k) for k in keys)
+
+    def _plugin_autoflush(self, id: str):
+        '''
+        `main.plugin_data_flush_interval` <= 0 时立即写入 (修改插件数据后调用)
+        '''
+        if self._c.main.plugin_data_flush_interval <= 0:
+            self.flush_plugin_data(id)
+
+    def _plugin_replace(self, id: str, data: dict[str, Any]):
+        '''
+        替换插件的全部数据, 仅标记有变化的键 (需持有 `_plugin_lock`)
+        '''
+        old = self._plugin_data.get(id, {})
+        changed = [k for k in old.keys() | data.keys() if k not in old or k not in data or old[k] != data[k]]
+        self._plugin_data[id] = data
+        if changed:
+            self._plugin_mark_dirty(id, changed)
+
     def get_plugin_data(self, id: str) -> dict:
         '''
-        获取插件数据 (没有则会创建)
+        获取插件的全部数据 (副本, 从缓存读取)
         '''
-        try:
-            with self._app.app_context():
-                plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
-                if plugin is None:
-                    plugin = _PluginData()
-                    plugin.id = id
-                    db.session.add(plugin)
-                    db.session.commit()
-                return plugin.data
-        except SQLAlchemyError as e:
-            self._throw(e)
+        with self._plugin_lock:
+            return deepcopy(self._plugin_data.get(id, {}))
 
     def set_plugin_data(self, id: str, data: dict):
         '''
-        设置插件数据
+        设置插件的全部数据 (仅写入有变化的键)
+        '''
+        with self._plugin_lock:
+            self._plugin_replace(id, {str(k): v for k, v in deepcopy(data).items()})
+        self._plugin_autoflush(id)
+
+    def get_plugin_data_item(self, id: str, key: str, default: Any = None) -> Any:
+        '''
+        获取插件数据中的单个值 (副本)
+        '''
+        with self._plugin_lock:
+            return deepcopy(self._plugin_data.get(id, {}).get(str(key), default))
+
+    def set_plugin_data_item(self, id: str, key: str, value: Any):
+        '''
+        设置插件数据中的单个值 (只写入此键)
+        '''
+        key = str(key)
+        with self._plugin_lock:
+            self._plugin_data.setdefault(id, {})[key] = deepcopy(value)
+            self._plugin_mark_dirty(id, (key,))
+        self._plugin_autoflush(id)
+
+    def delete_plugin_data_item(self, id: str, key: str) -> bool:
+        '''
+        删除插件数据中的单个值
+
+        :return: 键是否存在
+        '''
+        key = str(key)
+        with self._plugin_lock:
+            data = self._plugin_data.get(id, {})
+            if key not in data:
+                return False
+            del data[key]
+            self._plugin_mark_dirty(id, (key,))
+        self._plugin_autoflush(id)
+        return True
+
+    def incr_plugin_data_item(self, id: str, key: str, amount: int | float = 1) -> int | float:
+        '''
+        将插件数据中的数值加上 `amount` (不存在则视为 0)
+
+        :return: 增加后的值
+        '''
+        key = str(key)
+        with self._plugin_lock:
+            data = self._plugin_data.setdefault(id, {})
+            value = data.get(key, 0)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise TypeError(f'plugin data {id}.{key} is not a number: {value!r}')
+            data[key] = value = value + amount
+            self._plugin_mark_dirty(id, (key,))
+        self._plugin_autoflush(id)
+        return value
+
+    def scan_plugin_data(self, id: str, prefix: str = '') -> dict[str, Any]:
+        '''
+        获取插件数据中以 `prefix` 开头的所有键值 (副本, 按键排序)
+        '''
+        with self._plugin_lock:
+            data = self._plugin_data.get(id, {})
+            return {k: deepcopy(data[k]) for k in sorted(data) if k.startswith(prefix)}
+
+    @contextmanager
+    def plugin_data_context(self, id: str):
+        '''
+        插件数据上下文 (期间持有锁, 正常退出时写入有变化的键)
+
+        :param id: 插件 id
+        '''
+        with self._plugin_lock:
+            data = deepcopy(self._plugin_data.get(id, {}))
+            yield data
+            self._plugin_replace(id, {str(k): v for k, v in data.items()})
+        self._plugin_autoflush(id)
+
+    def flush_plugin_data(self, id: str | None = None):
         '''
+        将已修改的插件数据写入存储后端 (一次提交)
+        - 在锁内取出要写入的键值, 写入存储后端时不持有 `_plugin_lock`
+        - 同一时间只有一个线程写入: 其他线程正在写入时, 由其结束后再写入一次 (此时直接返回)
+        - 写入失败时恢复修改标记, 等待下次写入
+
+        :param id: 仅写入指定插件 (为空则写入所有)
+        '''
+        with self._plugin_lock:
+            if self._plugin_flushing:
+                self._plugin_flush_again = True
+                return
+            self._plugin_flushing = True
         try:
-            with self._app.app_context():
-                plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
-                if plugin is None:
-                    plugin = _PluginData()
-                    plugin.id = id
-                    plugin.data = {}
-                    db.session.add(plugin)
-                plugin.data = data
-                db.session.commit()
-        except SQLAlchemyError as e:
-            self._throw(e)
+            while True:
+                with self._plugin_lock:
+                    dirty = set(self._plugin_dirty) if id is None else {i for i in self._plugin_dirty if i[0] == id}
+                    self._plugin_dirty -= dirty
+                    upserts = []
+                    deletes = []
+                    for plugin_id, key in dirty:
+                        data = self._plugin_data.get(plugin_id, {})
+                        if key in data:
+                            upserts.append((plugin_id, key, data[key]))
+                        else:
+                            deletes.append((plugin_id, key))
+                if dirty:
+                    try:
+                        with self._backend.transaction():
+                            self._backend.plugin_write(upserts, deletes)
+                    except StorageError as e:
+                        l.error(f'[plugin] data flush failed, will retry later: {e}')
+                        with self._plugin_lock:
+                            self._plugin_dirty |= dirty
+                        return
+                    l.debug(f'[plugin] flushed {len(upserts)} keys, deleted {len(deletes)} keys')
+                with self._plugin_lock:
+                    if not self._plugin_flush_again:
+                        return
+                    self._plugin_flush_again = False
+                    id = None
+        finally:
+            with self._plugin_lock:
+                self._plugin_flushing = self._plugin_flush_again = False
+                self._plugin_flushed.notify_all()
+
+    @contextmanager
+    def _plugin_flush_paused(self):
+        '''
+        暂停插件数据写入: 等待正在进行的写入结束, 期间其他线程的写入请求直接返回 (修改标记保留)
+        '''
+        with self._plugin_lock:
+            self._plugin_flushed.wait_for(lambda: not self._plugin_flushing)
+            self._plugin_flushing = True
+        try:
+            yield
+        finally:
+            with self._plugin_lock:
+                self._plugin_flushing = False
+                self._plugin_flushed.notify_all()
+
+    # --- 导出 / 导入
+
+    def export_data(self) -> Iterator[str]:
+        '''
+        流式导出全部数据 (NDJSON, 每行一条记录, 格式见 `doc/api.md`)
+        - 先写入未保存的 metrics / 插件数据
+        - 逐批从存储后端读取, 内存占用与数据量无关
+        - 读取出错时在 `end` 记录之前停止 (导入时会被视为不完整的数据)
+        '''
+        self.flush_metrics()
+        self.flush_plugin_data()
+        counts: Counter[str] = Counter()
+        yield self._export_line({'type': 'header', 'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'backend': self._backend.name, 'time': time()})
+        try:
+            for table, row in self._backend.export_rows():
+                counts[table] += 1
+                yield self._export_line({'type': table, 'data': row})
+        except StorageError as e:
+            l.error(f'[export] Storage Call Failed, export aborted: {e}')
+            return
+        yield self._export_line({'type': 'end', 'counts': dict(counts)})
+        l.info(f'[export] exported {dict(counts)}')
+
+    def _export_line(self, record: dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def import_data(self, lines: Iterable[str | bytes]) -> dict[str, int]:
+        '''
+        从 `export_data()` 导出的数据导入, 替换现有的 main 状态 / 设备 / 设备历史 / 统计 / 插件数据
+        - 先读取并校验全部数据 (写入临时文件, 不持有锁), 数据有误或不完整 (缺少 `end` 记录 / 行数不符) 时不做任何修改
+        - 校验通过后在同一事务中清空并写入, 每 `STREAM_CHUNK` 行批量插入一次, 除设备 / 插件数据 (本就全部缓存在内存中) 外内存占用与数据量无关
+        - 只有写入阶段会阻塞其他线程的读写, 读取上传的数据 (如缓慢的请求流) 期间服务照常运行
+
+        :param lines: NDJSON 的各行 (可为文件 / 请求流)
+        :return: 各数据导入的行数
+        '''
+        perf = u.perf_counter()
+        with TemporaryFile('w+', encoding='utf-8') as spool:
+            try:
+                counts, devices, plugins = self._import_read(lines, spool)
+            except u.APIUnsuccessful as e:
+                l.warning(f'[import] invalid data, nothing changed: {e.message}')
+                raise
+            spool.seek(0)
+            l.debug(f'[import] validated {dict(counts)} took {perf()}ms')
+
+            with self._plugin_flush_paused():
+                with self._metrics_flush_lock:
+                    with self._write():
+                        self._backend.import_clear()
+                        chunk: list[dict[str, Any]] = []
+                        chunk_table = ''
+                        for line in spool:
+                            type, row = json.loads(line)
+                            if type == 'main':
+                                self._commit(**row)
+                                continue
+                            if chunk and (type != chunk_table or len(chunk) >= STREAM_CHUNK):
+                                self._backend.import_rows(chunk_table, chunk)
+                                chunk = []
+                            chunk_table = type
+                            chunk.append(row)
+                        if chunk:
+                            self._backend.import_rows(chunk_table, chunk)
+                        if not counts['main']:
+                            self._commit()
+                        self._local.device_ops.append((self._load_devices, devices))
+
+                    # 已提交: 丢弃导入前未写入的 metrics
+                    with self._metrics_lock:
+                        self._metrics_pending.clear()
+                # 替换插件数据缓存, 丢弃导入前未写入的插件数据
+                with self._plugin_lock:
+                    self._plugin_data = plugins
+                    self._plugin_dirty.clear()
+
+        l.info(f'[import] imported {dict(counts)} took {perf()}ms')
+        return dict(counts)
+
+    def _import_read(self, lines: Iterable[str | bytes], spool: IO[str]) -> tuple[Counter[str], list[dict[str, Any]], dict[str, dict[str, Any]]]:
+        '''
+        读取并校验导入的数据, 将各记录 (`[类型, 行]`) 写入 `spool`
+        - *不持有任何锁, 不修改数据*
+
+        :param lines: NDJSON 的各行
+        :param spool: 临时文件
+        :return: (各数据的行数, 设备列表, 插件数据)
+        '''
+        counts: Counter[str] = Counter()
+        devices: list[dict[str, Any]] = []
+        plugins: dict[str, dict[str, Any]] = {}
+        header = end = None
+
+        for n, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise u.APIUnsuccessful(400, f'line {n}: invalid json: {e}')
+            type = record.get('type') if isinstance(record, dict) else None
+            if header is None:
+                if type != 'header' or record.get('format') != EXPORT_FORMAT or not isinstance(record.get('version'), int):
+                    raise u.APIUnsuccessful(400, f'line {n}: not a sleepy export (missing header)')
+                if record['version'] > EXPORT_VERSION:
+                    raise u.APIUnsuccessful(400, f'line {n}: unsupported export version {record["version"]} (> {EXPORT_VERSION})')
+                header = record
+                continue
+            if end is not None:
+                raise u.APIUnsuccessful(400, f'line {n}: unexpected record after end')
+            if type == 'end':
+                end = record
+                continue
+            if type not in TABLES or not isinstance(record.get('data'), dict):
+                raise u.APIUnsuccessful(400, f'line {n}: invalid record')
+            try:
+                row = {k: record['data'][k] for k in TABLES[type]}
+            except KeyError as e:
+                raise u.APIUnsuccessful(400, f'line {n}: missing column {e} in {type}')
+            counts[type] += 1
+
+            if type == 'device':
+                devices.append(row)
+            elif type == 'plugin':
+                plugins.setdefault(row['plugin_id'], {})[row['key']] = row['value']
+            spool.write(json.dumps([type, row], ensure_ascii=False, separators=(',', ':')) + '\n')
+
+        if header is None or end is None:
+            raise u.APIUnsuccessful(400, 'incomplete export (missing end record)')
+        if end.get('counts') != dict(counts):
+            raise u.APIUnsuccessful(400, f'incomplete export (expect {end.get("counts")}, got {dict(counts)})')
+        return counts, devices, plugins
 
     # --- 缓存系统
 
@@ -22,6 +22,11 @@ try:
     import time
     from urllib.parse import urlparse, parse_qs, urlunparse
     import json
+    import hashlib
+    from functools import wraps, partial
+    from threading import Lock, Event
+    from collections import Counter
+    import typing as t
     from traceback import format_exc
     from mimetypes import guess_type
 
@@ -35,7 +40,7 @@ try:
     # local modules
     from config import Config as config_init
     import utils as u
-    from data import Data as data_init
+    from data import Data as data_init, DataSnapshot
     import plugin as pl
 except:
     print(f'''
@@ -339,6 +344,80 @@ def after_request(resp: flask.Response):
 
 # endregion inject
 
+# ========== Conditional GET ==========
+
+# region conditional
+
+_etags: dict[tuple, str] = {}
+'''`(路径, 参数, 版本)` -> 此版本返回的 ETag (用于在生成返回前直接回复 304)'''
+_ETAG_IGNORED = ('time', 'time_local')
+'''计算 ETag 时忽略的字段 (每次请求都会变化)'''
+
+
+def _cache_headers(resp: flask.Response) -> flask.Response:
+    '''
+    设置条件请求接口的 `Cache-Control` (见 `main.api_cache_max_age` / `main.api_cache_stale_while_revalidate`)
+    '''
+    if c.main.api_cache_max_age > 0:
+        cache_control = f'public, max-age={c.main.api_cache_max_age}'
+        if c.main.api_cache_stale_while_revalidate > 0:
+            cache_control += f', stale-while-revalidate={c.main.api_cache_stale_while_revalidate}'
+        resp.headers['Cache-Control'] = cache_control
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def conditional(version: t.Callable[[], t.Hashable | None] | None = None):
+    '''
+    为返回 json 的路由添加 ETag 及条件请求支持 (`If-None-Match` 匹配时返回 304)
+    - ETag 由返回内容 (插件修改后, 不包括 `time` / `time_local`) 计算
+    - 路由也可直接返回已设置 ETag 的 `flask.Response` (如使用缓存的返回)
+    - 被插件拦截等其他返回不做处理
+
+    :param version: 返回当前数据版本 (如 `d.revision`), 同一版本已生成过 ETag 时会在执行路由前直接回复 304 *(返回 None 则每次都生成返回后再比较)*
+    '''
+    def decorator(func: t.Callable):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            req = flask.request
+            key = None
+            if version:
+                v = version()
+                if v is not None:
+                    key = (req.path, req.query_string, v)
+                    etag = _etags.get(key)
+                    if etag and req.if_none_match.contains(etag):
+                        return _cache_headers(flask.Response(status=304, headers={'ETag': f'"{etag}"'}))
+
+            ret = func(*args, **kwargs)
+            if isinstance(ret, flask.Response) and ret.get_etag()[0]:
+                # 路由已自行设置 ETag
+                etag = ret.get_etag()[0]
+                resp = ret
+            elif isinstance(ret, dict):
+                etag = hashlib.sha1(json.dumps(
+                    {k: v for k, v in ret.items() if k not in _ETAG_IGNORED},
+                    sort_keys=True, ensure_ascii=False, default=str
+                ).encode()).hexdigest()
+                resp = None
+            else:
+                return ret
+            if key:
+                if len(_etags) >= 1024:
+                    _etags.clear()
+                _etags[key] = etag
+            if req.if_none_match.contains(etag):
+                resp = flask.Response(status=304)
+            elif resp is None:
+                resp = flask.make_response(ret)
+            resp.set_etag(etag)
+            return _cache_headers(resp)
+        return wrapper
+    return decorator
+
+# endregion conditional
+
 # ========== Routes ==========
 
 # region routes
@@ -458,6 +537,10 @@ def none():
 
 @app.route('/api/meta')
 @cross_origin(c.main.cors_origins)
+@conditional()
+def metadata_route():
+    return metadata()
+
 def metadata():
     '''
     获取站点元数据
@@ -492,6 +575,7 @@ def metadata():
 
 @app.route('/api/metrics')
 @cross_origin(c.main.cors_origins)
+@conditional()
 def metrics():
     '''
     获取统计信息
@@ -502,6 +586,58 @@ def metrics():
         return evt.interception
     return evt.metrics_response
 
+
+@app.route('/api/metrics/range')
+@cross_origin(c.main.cors_origins)
+def metrics_range():
+    '''
+    按时间范围获取统计信息
+    - Method: **GET**
+    '''
+    if not c.metrics.enabled:
+        raise u.APIUnsuccessful(404, 'metrics is disabled')
+    args = flask.request.args
+    path = args.get('path') or None
+    if path is not None and not d.metrics_allowed(path):
+        raise u.APIUnsuccessful(404, f'path {path} is not recorded in metrics')
+    try:
+        end = int(float(args.get('to', time.time())))
+        start = int(float(args.get('from', end - 86400)))
+        step = int(args.get('step', 3600))
+    except ValueError:
+        raise u.APIUnsuccessful(400, '\'from\', \'to\' and \'step\' must be numbers')
+    if step <= 0 or end <= start:
+        raise u.APIUnsuccessful(400, '\'step\' must be positive and \'to\' must be greater than \'from\'')
+    if (end - start) / step > 10000:
+        raise u.APIUnsuccessful(400, 'too many steps (max 10000), please increase \'step\'')
+
+    counts = d.metrics_range(path, start, end, step)
+    return {
+        'success': True,
+        'path': path,
+        'from': start,
+        'to': end,
+        'step': step,
+        'timezone': c.main.timezone,
+        'data': [{'time': start + i * step, 'count': n} for i, n in enumerate(counts)],
+        'total': sum(counts)
+    }
+
+@app.route('/api/stats')
+@cross_origin(c.main.cors_origins)
+@u.require_secret()
+def stats():
+    '''
+    获取服务器内部计数器 (缓存命中等)
+    - Method: **GET**
+    '''
+    with _query_cache_lock:
+        query_stats = dict(_query_cache_stats)
+    return {
+        'success': True,
+        'stats': d.stats | query_stats | d.broadcaster.stats
+    }
+
 # endregion routes-special
 
 # ----- Status -----
@@ -510,17 +646,31 @@ def metrics():
 
 @app.route('/api/status/query')
 @cross_origin(c.main.cors_origins)
+@conditional(lambda: None if u.tobool(flask.request.args.get('metrics', False)) else d.revision)
 def query_route():
-    return query()
-
-def query():
+    args = flask.request.args
+    meta = u.tobool(args.get('meta', False))
+    if u.tobool(args.get('metrics', False)):
+        # metrics 每次请求都会变化, 不缓存
+        return query(meta=meta, metrics=True)
+    entry = _query_cached(meta=meta)
+    resp = flask.Response(entry.encode(), mimetype='application/json')
+    resp.set_etag(entry.etag)
+    return resp
+
+def query(snapshot: DataSnapshot | None = None, meta: bool = False, metrics: bool = False):
     '''
     获取当前状态
     - 无需鉴权
     - Method: **GET**
+
+    :param snapshot: 使用的数据快照 (为空则获取当前快照)
+    :param meta: 是否同时返回 metadata
+    :param metrics: 是否同时返回 metrics
     '''
+    snap = snapshot or d.snapshot()
     # 获取手动状态
-    st: int = d.status_id
+    st: int = snap.status_id
     try:
         stinfo = c.status.status_list[st].model_dump()
     except:
@@ -536,46 +686,293 @@ def query():
         'success': True,
         'time': datetime.now().timestamp(),
         'status': stinfo,
-        'device': d.device_list,
-        'last_updated': d.last_updated
+        'device': snap.device_list(),
+        'last_updated': snap.last_updated,
+        'revision': snap.revision
     }
     # 如同时包含 metadata / metrics 返回
-    if u.tobool(flask.request.args.get('meta', False)) if flask.request else False:
+    if meta:
         ret['meta'] = metadata()
-    if u.tobool(flask.request.args.get('metrics', False)) if flask.request else False:
+    if metrics:
         ret['metrics'] = d.metrics_resp
     evt = p.trigger_event(pl.QueryAccessEvent(ret))
     return evt.query_response
 
 
-def _event_stream(event_id: int, ipstr: str):
-    last_updated = None
-    last_heartbeat = time.time()
+class _QueryCacheEntry(t.NamedTuple):
+    '''
+    已编码的 /api/status/query 返回
+    '''
+    revision: int
+    '''生成时的数据版本号'''
+    private_mode: bool
+    '''生成时是否为隐私模式'''
+    body: str
+    '''编码后的 json (不含 `time`, 且去掉了结尾的 `}`)'''
+    etag: str
+    '''此返回的 ETag'''
+
+    def encode(self) -> str:
+        '''
+        补上当前时间 (`time`), 生成完整的 json
+        '''
+        sep = ',' if len(self.body) > 1 else ''
+        return f'{self.body}{sep}"time":{datetime.now().timestamp()}}}'
+
+
+class _QueryBuilding:
+    '''
+    正在生成中的 /api/status/query 返回
+    '''
+    def __init__(self):
+        self.done = Event()
+        self.entry: _QueryCacheEntry | None = None
+
+
+_query_cache: dict[tuple[int, bool, bool], _QueryCacheEntry] = {}
+'''`(版本号, 隐私模式, 是否包含 meta)` -> 已编码的返回 (只保留最新版本)'''
+_query_building: dict[tuple[int, bool, bool], _QueryBuilding] = {}
+'''生成中的返回 (同一 key 并发未命中时只生成一次)'''
+_query_cache_lock = Lock()
+_query_cache_stats: Counter[str] = Counter()
+'''
+/api/status/query 缓存计数器
+- `query_cache_hit`: 命中次数
+- `query_cache_miss`: 未命中 (生成返回) 次数
+- `query_cache_wait`: 未命中, 但等待其他请求生成同一返回的次数
+'''
+
+
+def _query_build(meta: bool) -> _QueryCacheEntry:
+    '''
+    获取快照并生成编码后的返回 (不含 metrics)
+    '''
+    snap = d.snapshot()
+    ret = query(snap, meta=meta)
+    ret.pop('time', None)
+    body = json.dumps(ret, ensure_ascii=False, separators=(',', ':'), default=str)
+    return _QueryCacheEntry(
+        revision=snap.revision,
+        private_mode=snap.private_mode,
+        body=body[:-1],
+        etag=hashlib.sha1(body.encode()).hexdigest()
+    )
+
+
+def _query_cached(meta: bool = False) -> _QueryCacheEntry:
+    '''
+    获取 /api/status/query 返回 (不含 metrics), 按 `(版本号, 隐私模式, 是否包含 meta)` 缓存
+    - 数据修改后版本号变化, 旧缓存随之失效
+    - 同一 key 并发未命中时只由一个请求生成, 其他请求等待其结果
 
-    l.info(f'[SSE] Event stream connected: {ipstr}')
-    while True:
-        current_time = time.time()
-        # 检查数据是否已更新
-        current_updated = d.last_updated
+    :param meta: 是否同时返回 metadata
+    '''
+    key = (d.revision, d.private_mode, meta)
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry:
+            _query_cache_stats['query_cache_hit'] += 1
+            return entry
+        building = _query_building.get(key)
+        owner = building is None
+        if owner:
+            building = _query_building[key] = _QueryBuilding()
+            _query_cache_stats['query_cache_miss'] += 1
+        else:
+            _query_cache_stats['query_cache_wait'] += 1
+
+    if not owner:
+        building.done.wait()
+        # 生成失败则自行生成 (不缓存)
+        return building.entry or _query_build(meta)
+
+    try:
+        entry = _query_build(meta)
+        with _query_cache_lock:
+            # 丢弃旧版本
+            for k in [k for k in _query_cache if k[0] < entry.revision]:
+                del _query_cache[k]
+            _query_cache[(entry.revision, entry.private_mode, meta)] = entry
+        building.entry = entry
+        return entry
+    finally:
+        with _query_cache_lock:
+            _query_building.pop(key, None)
+        building.done.set()
+
+
+def _sse_update() -> str:
+    '''
+    生成 SSE `update` 事件的数据 (使用缓存的 /api/status/query 返回, 每次数据变化只由广播线程调用一次)
+    '''
+    return _query_cached().encode()
 
-        # 如果数据有更新, 发送更新事件并重置心跳计时器
-        if last_updated != current_updated:
-            last_updated = current_updated
-            # 重置心跳计时器
-            last_heartbeat = current_time
 
-            # 获取 /query 返回数据
-            update_data = json.dumps(query(), ensure_ascii=False)
-            event_id += 1
-            yield f'id: {event_id}\nevent: update\ndata: {update_data}\n\n'
+_events_channel = d.broadcaster.channel('events', _sse_update)
+'''/api/status/events 的广播频道'''
 
-        # 只有在没有数据更新的情况下才检查是否需要发送心跳
-        elif current_time - last_heartbeat >= 30:
-            event_id += 1
-            yield f'id: {event_id}\nevent: heartbeat\ndata:\n\n'
-            last_heartbeat = current_time
 
-        time.sleep(1)  # 每秒检查一次更新
+_sse_parsed: tuple[_QueryCacheEntry, dict[str, t.Any]] | None = None
+'''最近一次解析的 /api/status/query 返回'''
+
+
+def _query_parsed() -> tuple[_QueryCacheEntry, dict[str, t.Any]]:
+    '''
+    获取缓存的 /api/status/query 返回, 及其解析后的 dict (不含 `time`, 同一返回只解析一次, *请勿修改*)
+    '''
+    global _sse_parsed
+    entry = _query_cached()
+    parsed = _sse_parsed
+    if parsed is None or parsed[0] is not entry:
+        parsed = _sse_parsed = (entry, json.loads(f'{entry.body}}}'))
+    return parsed
+
+
+class _SseFilter(t.NamedTuple):
+    '''
+    SSE 订阅过滤 (`/api/status/events` 的参数), 相同过滤的连接共用一个频道
+    '''
+    devices: frozenset[str] | None
+    '''只包含这些设备 (`devices=id1,id2`)'''
+    status_only: bool
+    '''只包含手动状态等, 不含设备 (`status_only=1`)'''
+    fields: frozenset[str] | None
+    '''设备只包含这些字段 (`fields=status,using`, 总是包含 `id`)'''
+
+    @classmethod
+    def from_args(cls, args) -> '_SseFilter | None':
+        '''
+        从请求参数解析
+
+        :return: 过滤, 没有过滤则返回 None
+        '''
+        def split(name: str) -> frozenset[str] | None:
+            value = args.get(name)
+            return None if value is None else frozenset(i.strip() for i in value.split(',') if i.strip())
+
+        flt = cls(devices=split('devices'), status_only=bool(u.tobool(args.get('status_only', False))), fields=split('fields'))
+        return None if flt == cls(None, False, None) else flt
+
+    @property
+    def key(self) -> str:
+        '''
+        规范化的过滤参数 (用于频道名)
+        '''
+        parts = []
+        if self.devices is not None:
+            parts.append(f'devices={",".join(sorted(self.devices))}')
+        if self.status_only:
+            parts.append('status_only=1')
+        if self.fields is not None:
+            parts.append(f'fields={",".join(sorted(self.fields))}')
+        return '&'.join(parts)
+
+    def apply(self, ret: dict[str, t.Any]) -> dict[str, t.Any]:
+        '''
+        过滤 /api/status/query 返回 (不修改 `ret`)
+        '''
+        out = {k: v for k, v in ret.items() if k != 'device'}
+        if self.status_only:
+            return out
+        devices: dict[str, t.Any] = ret.get('device', {})
+        if self.devices is not None:
+            devices = {k: v for k, v in devices.items() if k in self.devices}
+        if self.fields is not None:
+            devices = {k: {f: fv for f, fv in v.items() if f in self.fields or f == 'id'} for k, v in devices.items()}
+        out['device'] = devices
+        return out
+
+
+class _SseStream:
+    '''
+    生成 SSE 事件的数据: 每次数据变化只由广播线程调用一次 `build()`, 与上一次发送的数据比较
+    - 增量模式: 只发送变化的部分 (`patch` 事件)
+    - 有过滤时: 变化与过滤范围无关则不发送
+    '''
+
+    _SKIP = ('device', 'revision', 'success', 'time')
+    '''不逐项比较的顶层字段'''
+    _IGNORE = ('last_updated', 'revision', 'success', 'time')
+    '''判断变化是否与过滤范围有关时忽略的字段'''
+
+    def __init__(self, delta: bool, flt: _SseFilter | None = None):
+        '''
+        :param delta: 是否为增量模式
+        :param flt: 订阅过滤
+        '''
+        self._delta = delta
+        self._filter = flt
+        self._last: dict[str, t.Any] | None = None
+        '''上一次发送的数据'''
+        self._lock = Lock()
+
+    def _current(self) -> tuple[_QueryCacheEntry, dict[str, t.Any]]:
+        entry, ret = _query_parsed()
+        return entry, (self._filter.apply(ret) if self._filter else ret)
+
+    @staticmethod
+    def _encode(ret: dict[str, t.Any]) -> str:
+        return json.dumps(ret, ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def _view(self, ret: dict[str, t.Any]) -> dict[str, t.Any]:
+        return {k: v for k, v in ret.items() if k not in self._IGNORE}
+
+    def snapshot(self) -> str:
+        '''
+        生成连接后的完整数据 (`update` 事件), 第一次调用时作为比较的基准
+        '''
+        entry, cur = self._current()
+        if self._last is None:
+            with self._lock:
+                if self._last is None:
+                    self._last = cur
+        if self._filter is None:
+            return entry.encode()
+        return self._encode(cur | {'time': datetime.now().timestamp()})
+
+    def build(self) -> str | None:
+        '''
+        生成数据变化后的事件数据
+
+        :return: 事件数据, 变化与过滤范围无关则返回 None
+        '''
+        _, cur = self._current()
+        with self._lock:
+            last = self._last
+            if self._filter and last is not None and self._view(cur) == self._view(last):
+                return None
+            self._last = cur
+        if not self._delta:
+            return self._encode(cur | {'time': datetime.now().timestamp()})
+        if last is None:
+            # 没有上一次的数据: 发送完整数据 (客户端先清空设备)
+            patch = {k: v for k, v in cur.items() if k not in self._SKIP}
+            if 'device' in cur:
+                patch['device'] = cur['device']
+            patch['base'] = None
+        else:
+            patch = {k: cur.get(k) for k in cur.keys() | last.keys() if k not in self._SKIP and cur.get(k) != last.get(k)}
+            cur_device: dict[str, t.Any] = cur.get('device', {})
+            last_device: dict[str, t.Any] = last.get('device', {})
+            device = {k: v for k, v in cur_device.items() if last_device.get(k) != v}
+            device.update({k: None for k in last_device.keys() - cur_device.keys()})
+            if device:
+                patch['device'] = device
+            order = list(cur_device)
+            if order != list(last_device):
+                # 设备顺序有变化 (新增 / 删除 / 按 `status.using_first` / `status.sorted` 重新排序)
+                patch['order'] = order
+            patch['base'] = last['revision']
+        patch['revision'] = cur['revision']
+        return self._encode(patch)
+
+
+_sse_delta = _SseStream(delta=True)
+_events_delta_channel = d.broadcaster.channel('events_delta', _sse_delta.build, snapshot=_sse_delta.snapshot, event='patch')
+'''/api/status/events?delta=1 的广播频道'''
+
+_SSE_MAX_FILTERS = 64
+'''带过滤的 SSE 频道 (不同的过滤参数组合) 数上限'''
 
 
 @app.route('/api/status/events')
@@ -584,20 +981,39 @@ def events():
     '''
     SSE 事件流，用于推送状态更新
     - Method: **GET**
+    - `?delta=1`: 连接后发送一次完整数据, 之后只发送变化的部分 (`patch` 事件)
+    - `?devices=id1,id2` / `?status_only=1` / `?fields=status,using`: 只订阅部分数据, 无关的变化不会推送
     '''
     try:
         last_event_id = int(flask.request.headers.get('Last-Event-ID', '0'))
     except ValueError:
         raise u.APIUnsuccessful(400, 'Invaild Last-Event-ID header, it must be int!')
+    args = flask.request.args
+    delta = bool(u.tobool(args.get('delta', False)))
+    flt = _SseFilter.from_args(args)
 
     evt = p.trigger_event(pl.StreamConnectedEvent(last_event_id))
     if evt.interception:
         return evt.interception
     ipstr: str = flask.g.ipstr
 
-    response = flask.Response(_event_stream(last_event_id, ipstr), mimetype='text/event-stream', status=200)
-    response.headers['Cache-Control'] = 'no-cache'  # 禁用缓存
-    response.headers['X-Accel-Buffering'] = 'no'  # 禁用 Nginx 缓冲
+    if flt is None:
+        channel = _events_delta_channel if delta else _events_channel
+    else:
+        # 相同过滤的连接共用一个频道: 每次变化只过滤 / 比较一次
+        stream = _SseStream(delta, flt)
+        channel = d.broadcaster.temporary_channel(
+            f'{"events_delta" if delta else "events"}?{flt.key}',
+            stream.build,
+            snapshot=stream.snapshot,
+            event='patch' if delta else 'update',
+            limit=_SSE_MAX_FILTERS
+        )
+        if channel is None:
+            raise u.APIUnsuccessful(503, 'Too many different event stream filters, please try again later')
+
+    l.info(f'[SSE] Event stream connected: {ipstr}')
+    response = channel.response(last_event_id)
     response.call_on_close(lambda: (
         l.info(f'[SSE] Event stream disconnected: {ipstr}'),
         p.trigger_event(pl.StreamDisconnectedEvent())
@@ -605,6 +1021,44 @@ def events():
     return response
 
 
+def _apply(defer: list | None, func: t.Callable, *args, **kwargs):
+    '''
+    执行修改 (`defer` 不为空时不立即执行, 而是加入其中, 见 `batch()`)
+    '''
+    if defer is None:
+        func(*args, **kwargs)
+    else:
+        defer.append(partial(func, *args, **kwargs))
+
+
+def _status_set(status: int, current: int | None = None, defer: list | None = None) -> tuple[tuple | None, int]:
+    '''
+    设置状态 (触发 `StatusUpdatedEvent`)
+
+    :param status: 状态 id
+    :param current: 当前的状态 id (为空则读取)
+    :param defer: 延后执行的修改列表 (见 `_apply()`)
+    :return: (拦截返回 (如被拦截), 最终设置的状态 id)
+    '''
+    if current is None:
+        current = d.status_id
+    if not status == current:
+        old_status = d.get_status(current)
+        new_status = d.get_status(status)
+        evt = p.trigger_event(pl.StatusUpdatedEvent(
+            old_exists=old_status[0],
+            old_status=old_status[1],
+            new_exists=new_status[0],
+            new_status=new_status[1]
+        ))
+        if evt.interception:
+            return evt.interception, status
+        status = evt.new_status.id
+
+        _apply(defer, setattr, d, 'status_id', status)
+    return None, status
+
+
 @app.route('/api/status/set')
 @cross_origin(c.main.cors_origins)
 @u.require_secret()
@@ -620,20 +1074,9 @@ def set_status():
     except:
         raise u.APIUnsuccessful(400, 'argument \'status\' must be int')
 
-    if not status == d.status_id:
-        old_status = d.status
-        new_status = d.get_status(status)
-        evt = p.trigger_event(pl.StatusUpdatedEvent(
-            old_exists=old_status[0],
-            old_status=old_status[1],
-            new_exists=new_status[0],
-            new_status=new_status[1]
-        ))
-        if evt.interception:
-            return evt.interception
-        status = evt.new_status.id
-
-        d.status_id = status
+    interception, status = _status_set(status)
+    if interception:
+        return interception
 
     return {
         'success': True,
@@ -643,6 +1086,7 @@ def set_status():
 
 @app.route('/api/status/list')
 @cross_origin(c.main.cors_origins)
+@conditional()
 def get_status_list():
     '''
     获取 `status_list`
@@ -664,6 +1108,53 @@ def get_status_list():
 # region routes-device
 
 
+def _device_set(device_id: str | None, show_name: str | None, using: bool | None, status: str | None, fields: dict, ttl: int | None = None, expired: bool = False, defer: list | None = None) -> tuple | None:
+    '''
+    设置单个设备的信息 (触发 `DeviceSetEvent`)
+
+    :param defer: 延后执行的修改列表 (见 `_apply()`)
+    :return: 拦截返回 (如被拦截)
+    '''
+    evt = p.trigger_event(pl.DeviceSetEvent(
+        device_id=device_id,
+        show_name=show_name,
+        using=using,
+        status=status,
+        fields=fields,
+        ttl=ttl,
+        expired=expired
+    ))
+    if evt.interception:
+        return evt.interception
+
+    _apply(
+        defer,
+        d.device_set,
+        id=evt.device_id,
+        show_name=evt.show_name,
+        using=evt.using,
+        status=evt.status,
+        fields=evt.fields,
+        ttl=evt.ttl,
+        touch=not expired
+    )
+
+
+def _parse_ttl(ttl: t.Any) -> int | None:
+    '''
+    解析设备的 `ttl` 参数 (为空则返回 None)
+    '''
+    if ttl is None or ttl == '':
+        return None
+    try:
+        ttl = int(ttl)
+    except (TypeError, ValueError):
+        raise u.APIUnsuccessful(400, 'argument \'ttl\' must be int')
+    if ttl < 0:
+        raise u.APIUnsuccessful(400, 'argument \'ttl\' cannot be negative')
+    return ttl
+
+
 @app.route('/api/device/set', methods=['GET', 'POST'])
 @cross_origin(c.main.cors_origins)
 @u.require_secret()
@@ -679,47 +1170,34 @@ def device_set():
         device_show_name = args.pop('show_name', None)
         device_using = u.tobool(args.pop('using', None))
         device_status = args.pop('status', None) or args.pop('app_name', None)  # 兼容旧版名称
+        device_ttl = _parse_ttl(args.pop('ttl', None))
         args.pop('secret', None)
 
-        evt = p.trigger_event(pl.DeviceSetEvent(
+        interception = _device_set(
             device_id=device_id,
             show_name=device_show_name,
             using=device_using,
             status=device_status,
-            fields=args
-        ))
-        if evt.interception:
-            return evt.interception
-
-        d.device_set(
-            id=evt.device_id,
-            show_name=evt.show_name,
-            using=evt.using,
-            status=evt.status,
-            fields=evt.fields
+            fields=args,
+            ttl=device_ttl
         )
+        if interception:
+            return interception
 
     elif flask.request.method == 'POST':
         try:
             req: dict = flask.request.get_json()
 
-            evt = p.trigger_event(pl.DeviceSetEvent(
+            interception = _device_set(
                 device_id=req.get('id'),
                 show_name=req.get('show_name'),
                 using=req.get('using'),
                 status=req.get('status') or req.get('app_name'),  # 兼容旧版名称
-                fields=req.get('fields') or {}
-            ))
-            if evt.interception:
-                return evt.interception
-
-            d.device_set(
-                id=evt.device_id,
-                show_name=evt.show_name,
-                using=evt.using,
-                status=evt.status,
-                fields=evt.fields
+                fields=req.get('fields') or {},
+                ttl=_parse_ttl(req.get('ttl'))
             )
+            if interception:
+                return interception
         except Exception as e:
             if isinstance(e, u.APIUnsuccessful):
                 raise e
@@ -733,18 +1211,13 @@ def device_set():
     }
 
 
-@app.route('/api/device/remove')
-@cross_origin(c.main.cors_origins)
-@u.require_secret()
-def device_remove():
+def _device_remove(device_id: str, expired: bool = False, defer: list | None = None) -> tuple | None:
     '''
-    移除单个设备的状态
-    - Method: **GET**
-    '''
-    device_id = flask.request.args.get('id')
-    if not device_id:
-        raise u.APIUnsuccessful(400, 'Missing device id!')
+    移除单个设备 (触发 `DeviceRemovedEvent`)
 
+    :param defer: 延后执行的修改列表 (见 `_apply()`)
+    :return: 拦截返回 (如被拦截)
+    '''
     device = d.device_get(device_id)
 
     if device:
@@ -754,7 +1227,8 @@ def device_remove():
             show_name=device.show_name,
             using=device.using,
             status=device.status,
-            fields=device.fields
+            fields=device.fields,
+            expired=expired
         ))
     else:
         evt = p.trigger_event(pl.DeviceRemovedEvent(
@@ -763,13 +1237,58 @@ def device_remove():
             show_name=None,
             using=None,
             status=None,
-            fields=None
+            fields=None,
+            expired=expired
         ))
 
     if evt.interception:
         return evt.interception
 
-    d.device_remove(evt.device_id)
+    _apply(defer, d.device_remove, evt.device_id)
+
+
+def _device_expire(device_id: str) -> bool:
+    '''
+    处理过期的设备 (超过 `status.device_ttl` 未更新, 由 data 的过期检查调用)
+    - 与请求 API 一样触发 `DeviceSetEvent` / `DeviceRemovedEvent` (`expired=True`)
+    - 事件在不持有数据锁时触发, 之后在事务中确认设备仍已过期 (期间未被更新 / 移除) 再修改
+
+    :return: 是否已处理 (被插件拦截则为 False, 之后会再次检查)
+    '''
+    if not d.device_expired(device_id):
+        return True
+    writes = []
+    if c.status.device_expire_action == 'remove':
+        interception = _device_remove(device_id, expired=True, defer=writes)
+    else:
+        interception = _device_set(device_id=device_id, show_name=None, using=False, status=None, fields={}, expired=True, defer=writes)
+    if interception:
+        return False
+    with d.batch():
+        if d.device_expired(device_id):
+            for func in writes:
+                func()
+    return True
+
+
+d.start_device_expiry(_device_expire)
+
+
+@app.route('/api/device/remove')
+@cross_origin(c.main.cors_origins)
+@u.require_secret()
+def device_remove():
+    '''
+    移除单个设备的状态
+    - Method: **GET**
+    '''
+    device_id = flask.request.args.get('id')
+    if not device_id:
+        raise u.APIUnsuccessful(400, 'Missing device id!')
+
+    interception = _device_remove(device_id)
+    if interception:
+        return interception
 
     return {
         'success': True
@@ -795,6 +1314,26 @@ def device_clear():
     }
 
 
+def _private_set(private: bool, current: bool | None = None, defer: list | None = None) -> tuple[tuple | None, bool]:
+    '''
+    设置隐私模式 (触发 `PrivateModeChangedEvent`)
+
+    :param current: 当前是否开启隐私模式 (为空则读取)
+    :param defer: 延后执行的修改列表 (见 `_apply()`)
+    :return: (拦截返回 (如被拦截), 最终的隐私模式)
+    '''
+    if current is None:
+        current = d.private_mode
+    if not private == current:
+        evt = p.trigger_event(pl.PrivateModeChangedEvent(current, private))
+        if evt.interception:
+            return evt.interception, private
+        private = evt.new_status
+
+        _apply(defer, setattr, d, 'private_mode', private)
+    return None, private
+
+
 @app.route('/api/device/private')
 @u.require_secret()
 @cross_origin(c.main.cors_origins)
@@ -806,19 +1345,203 @@ def device_private_mode():
     private = u.tobool(flask.request.args.get('private'))
     if private == None:
         raise u.APIUnsuccessful(400, '\'private\' arg must be boolean')
-    elif not private == d.private_mode:
-        evt = p.trigger_event(pl.PrivateModeChangedEvent(d.private_mode, private))
-        if evt.interception:
-            return evt.interception
 
-        d.private_mode = evt.new_status
+    interception, _ = _private_set(private)
+    if interception:
+        return interception
 
     return {
         'success': True
     }
 
+
+@app.route('/api/device/history')
+@cross_origin(c.main.cors_origins)
+def device_history():
+    '''
+    获取设备状态历史 (从新到旧, 使用游标分页)
+    - 无需鉴权 (隐私模式下返回空列表)
+    - Method: **GET**
+    '''
+    if not c.status.history_enabled or d.private_mode:
+        return {
+            'success': True,
+            'history': [],
+            'next_cursor': None
+        }
+    args = flask.request.args
+    try:
+        start = float(args['from']) if args.get('from') else None
+        end = float(args['to']) if args.get('to') else None
+        limit = min(max(int(args.get('limit', 50)), 1), 500)
+        cursor = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        raise u.APIUnsuccessful(400, '\'from\', \'to\', \'limit\' and \'cursor\' must be numbers')
+
+    history = d.device_history(id=args.get('id') or None, start=start, end=end, limit=limit, cursor=cursor)
+    return {
+        'success': True,
+        'history': history,
+        'next_cursor': history[-1]['id'] if len(history) == limit else None
+    }
+
 # endregion routes-device
 
+# ----- Batch -----
+
+# region routes-batch
+
+
+class _BatchIntercepted(Exception):
+    '''
+    批量操作中某项被插件拦截 (用于回滚整个批量操作)
+    '''
+
+    def __init__(self, interception: tuple):
+        self.interception = interception
+
+
+def _batch_apply(op: dict[str, t.Any], state: dict[str, t.Any], defer: list) -> dict[str, t.Any]:
+    '''
+    触发批量操作中单项的插件事件, 并将其修改加入 `defer` (在 `batch()` 的事务中执行)
+
+    :param op: 操作 (`{"op": "device/set", ...}`)
+    :param state: 前面各项执行后的 状态 id / 隐私模式 (`{"status": int, "private": bool}`, 会被更新)
+    :param defer: 延后执行的修改列表
+    :return: 此项的结果
+    '''
+    name = op.get('op')
+    if name == 'device/set':
+        fields = op.get('fields') or {}
+        if not isinstance(fields, dict):
+            raise u.APIUnsuccessful(400, '\'fields\' must be an object')
+        interception = _device_set(
+            device_id=op.get('id'),
+            show_name=op.get('show_name'),
+            using=op.get('using'),
+            status=op.get('status') or op.get('app_name'),  # 兼容旧版名称
+            fields=fields,
+            ttl=_parse_ttl(op.get('ttl')),
+            defer=defer
+        )
+        result = {'success': True}
+    elif name == 'device/remove':
+        if not op.get('id'):
+            raise u.APIUnsuccessful(400, 'Missing device id!')
+        interception = _device_remove(op['id'], defer=defer)
+        result = {'success': True}
+    elif name == 'status/set':
+        try:
+            status = int(op.get('status'))  # type: ignore
+        except:
+            raise u.APIUnsuccessful(400, 'argument \'status\' must be int')
+        interception, state['status'] = _status_set(status, current=state['status'], defer=defer)
+        status = state['status']
+        result = {'success': True, 'set_to': status}
+    elif name == 'private':
+        private = u.tobool(op.get('private'))
+        if private == None:
+            raise u.APIUnsuccessful(400, '\'private\' arg must be boolean')
+        interception, state['private'] = _private_set(private, current=state['private'], defer=defer)
+        result = {'success': True}
+    else:
+        raise u.APIUnsuccessful(400, f'unknown op: {name}')
+
+    if interception:
+        raise _BatchIntercepted(interception)
+    return result
+
+
+@app.route('/api/batch', methods=['POST'])
+@cross_origin(c.main.cors_origins)
+@u.require_secret()
+def batch():
+    '''
+    批量执行 设备 / 状态 / 隐私模式 修改 (在同一事务中按顺序执行, 任一项失败 / 被拦截则全部回滚)
+    - 先按顺序触发所有项的插件事件 (此时未持有数据锁), 均未被拦截时再在同一事务中执行修改
+    - 事件中的状态 / 隐私模式为前面各项执行后的值, 设备信息为批量操作开始前的值
+    - Method: **POST**
+    '''
+    req: dict = flask.request.get_json(silent=True) or {}
+    ops = req.get('operations')
+    if not isinstance(ops, list):
+        raise u.APIUnsuccessful(400, '\'operations\' must be a list')
+
+    results = []
+    writes: list[tuple[int, t.Callable[[], t.Any]]] = []
+    state = {'status': d.status_id, 'private': d.private_mode}
+    try:
+        for i, op in enumerate(ops):
+            if not isinstance(op, dict):
+                raise u.APIUnsuccessful(400, f'operations[{i}]: operation must be an object')
+            defer = []
+            try:
+                results.append(_batch_apply(op, state, defer))
+            except u.APIUnsuccessful as e:
+                raise u.APIUnsuccessful(e.code, f'operations[{i}]: {e.message}')
+            except (KeyError, TypeError, ValueError) as e:
+                raise u.APIUnsuccessful(400, f'operations[{i}]: missing param or wrong param type: {e}')
+            writes.extend((i, func) for func in defer)
+    except _BatchIntercepted as e:
+        return e.interception
+
+    with d.batch():
+        for i, func in writes:
+            try:
+                func()
+            except u.APIUnsuccessful as e:
+                raise u.APIUnsuccessful(e.code, f'operations[{i}]: {e.message}')
+            except (KeyError, TypeError, ValueError) as e:
+                raise u.APIUnsuccessful(400, f'operations[{i}]: missing param or wrong param type: {e}')
+
+    return {
+        'success': True,
+        'results': results
+    }
+
+# endregion routes-batch
+
+# ----- Export / Import -----
+
+# region routes-admin
+
+
+@app.route('/api/admin/export')
+@u.require_secret()
+def admin_export():
+    '''
+    导出全部数据 (NDJSON 流, 格式见 doc/api.md)
+    - Method: **GET**
+    '''
+    filename = f'sleepy-export-{datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")}.ndjson'
+    return flask.Response(
+        d.export_data(),
+        mimetype='application/x-ndjson',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'no-store'
+        }
+    )
+
+
+@app.route('/api/admin/import', methods=['POST'])
+@u.require_secret()
+def admin_import():
+    '''
+    导入数据 (请求体为 `/api/admin/export` 导出的 NDJSON, 替换现有的全部数据)
+    - Method: **POST**
+    '''
+    if flask.request.is_json:
+        # 鉴权时已按 json 读取请求体
+        raise u.APIUnsuccessful(415, 'Content-Type must be application/x-ndjson')
+    imported = d.import_data(flask.request.stream)
+    return {
+        'success': True,
+        'imported': imported
+    }
+
+# endregion routes-admin
+
 # ----- Panel (Admin) -----
 
 # region routes-panel
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from typing import Any
+from typing import Any, Literal
 
 from pydantic import BaseModel, PositiveInt
 
@@ -38,6 +38,82 @@ class _StatusItemModel(BaseModel):
     '''
 
 
+class _StorageOptionsModel(BaseModel):
+    '''
+    存储设置 (`main.storage_options`)
+    - *留空 (`null`) 的项使用 SQLAlchemy / 数据库自身的默认值*
+    - `sqlite_*` 仅对 SQLite 有效, `memory_*` 仅对内存 + 日志存储有效
+    '''
+
+    pool_size: PositiveInt | None = None
+    '''
+    `main.storage_options.pool_size`
+    连接池保持的连接数 (MySQL / PostgreSQL 等)
+    '''
+
+    max_overflow: int | None = None
+    '''
+    `main.storage_options.max_overflow`
+    连接池满时允许额外创建的连接数
+    '''
+
+    pool_recycle: int | None = None
+    '''
+    `main.storage_options.pool_recycle`
+    连接的最长复用时间 (秒), 超过后重新连接
+    - *MySQL 建议设置为小于服务端 `wait_timeout` 的值*
+    '''
+
+    pool_pre_ping: bool = False
+    '''
+    `main.storage_options.pool_pre_ping`
+    每次取出连接前检查连接是否可用 (避免使用已被服务端断开的连接)
+    - *远程数据库建议开启*
+    '''
+
+    sqlite_journal_mode: Literal['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'] | None = 'WAL'
+    '''
+    `main.storage_options.sqlite_journal_mode`
+    SQLite 日志模式 (`PRAGMA journal_mode`)
+    - *`WAL` 模式下读取与写入互不阻塞*
+    '''
+
+    sqlite_synchronous: Literal['OFF', 'NORMAL', 'FULL', 'EXTRA'] | None = 'NORMAL'
+    '''
+    `main.storage_options.sqlite_synchronous`
+    SQLite 同步模式 (`PRAGMA synchronous`)
+    - *`WAL` 模式下使用 `NORMAL` 即可保证数据库不损坏*
+    '''
+
+    sqlite_busy_timeout: int | None = 5000
+    '''
+    `main.storage_options.sqlite_busy_timeout`
+    SQLite 数据库被锁定时的等待时间 (毫秒, `PRAGMA busy_timeout`)
+    '''
+
+    sqlite_cache_size: int | None = None
+    '''
+    `main.storage_options.sqlite_cache_size`
+    SQLite 页缓存大小 (`PRAGMA cache_size`)
+    - 正数为页数, 负数为 KiB (如 `-8000` 即约 8 MB)
+    '''
+
+    memory_snapshot_interval: int = 600
+    '''
+    `main.storage_options.memory_snapshot_interval`
+    内存 + 日志存储 (`memory:///路径`) 保存快照的间隔 (秒)
+    - 保存快照后日志文件会被清空, 退出时也会保存
+    - *设置为 0 则只在退出时保存*
+    '''
+
+    memory_journal_fsync: bool = False
+    '''
+    `main.storage_options.memory_journal_fsync`
+    内存 + 日志存储每次写入日志后是否调用 fsync
+    - *开启后断电也不会丢失已提交的修改, 但写入变慢*
+    '''
+
+
 class _MainConfigModel(BaseModel):
     '''
     系统基本配置 (`main`)
@@ -48,9 +124,17 @@ class _MainConfigModel(BaseModel):
     数据库地址
     - SQLite: `sqlite:///../文件名.db`
     - MySQL: `mysql://用户名:密码@主机:端口号/数据库名`
+    - 纯内存 (重启后数据丢失): `memory://`
+    - 内存 + 日志文件: `memory:///../文件名.journal` (路径规则同 SQLite, 另会生成 `.snapshot` 快照文件)
     - 更多: https://docs.sqlalchemy.org.cn/en/20/core/engines.html#backend-specific-urls
     '''
 
+    storage_options: _StorageOptionsModel = _StorageOptionsModel()
+    '''
+    `main.storage_options`
+    数据库连接池 / SQLite / 内存存储参数设置
+    '''
+
     host: str = '0.0.0.0'
     '''
     `main.host`
@@ -109,6 +193,29 @@ class _MainConfigModel(BaseModel):
     - *建议设置为 20 分钟 (1200s)*
     '''
 
+    plugin_data_flush_interval: int = 30
+    '''
+    `main.plugin_data_flush_interval`
+    插件数据写入数据库的间隔 (秒)
+    - 插件数据缓存在内存中, 修改后每隔此时间批量写入一次 (退出时也会写入)
+    - *设置为 0 则每次修改都立即写入*
+    '''
+
+    api_cache_max_age: int = 0
+    '''
+    `main.api_cache_max_age`
+    状态 / 元数据 / 统计接口 (`/api/status/query`, `/api/status/list`, `/api/meta`, `/api/metrics`) 返回的 `Cache-Control: max-age` (秒)
+    - *设置为 0 则返回 `no-cache` (每次都需向服务端验证 ETag)*
+    - 在前面有 CDN 时可设为几秒, 由 CDN 承担大部分轮询请求
+    '''
+
+    api_cache_stale_while_revalidate: int = 0
+    '''
+    `main.api_cache_stale_while_revalidate`
+    上述接口返回的 `Cache-Control: stale-while-revalidate` (秒)
+    - *仅在 `main.api_cache_max_age` 大于 0 时有效, 设置为 0 则不添加*
+    '''
+
     cors_origins: list[str] | str = '*'
     '''
     `main.cors_origins`
@@ -240,6 +347,88 @@ class _StatusConfigModel(BaseModel):
     - 顺序: 在线 (正在使用 -> 未在使用) -> 离线 -> 未知
     '''
 
+    device_ttl: int = 0
+    '''
+    `status.device_ttl`
+    设备存活时间 (秒): 设备超过此时间未更新状态则视为已离线, 执行 `status.device_expire_action`
+    - 可在 `/api/device/set` 中使用 `ttl` 参数为单个设备单独设置
+    - *设置为 0 禁用*
+    '''
+
+    device_expire_action: Literal['not_using', 'remove'] = 'not_using'
+    '''
+    `status.device_expire_action`
+    设备过期后的操作
+    - `not_using`: 设为未在使用 *(仅对正在使用的设备生效)*
+    - `remove`: 移除设备
+    '''
+
+    fields_max_size: int = 16384
+    '''
+    `status.fields_max_size`
+    单个设备扩展字段 (`fields`) 编码为 json 后的最大字节数
+    - *设置为 0 则不限制*
+    '''
+
+    fields_max_keys: int = 256
+    '''
+    `status.fields_max_keys`
+    单个设备扩展字段中键的最大总数 (包括嵌套的键)
+    - *设置为 0 则不限制*
+    '''
+
+    fields_max_depth: int = 8
+    '''
+    `status.fields_max_depth`
+    单个设备扩展字段的最大嵌套深度 (每层 字典 / 列表 计 1 层)
+    - *设置为 0 则不限制*
+    '''
+
+    history_enabled: bool = True
+    '''
+    `status.history_enabled`
+    是否记录设备状态历史 (`using` / `status` / `show_name` 变化时记录, 可在 `/api/device/history` 查看)
+    '''
+
+    history_retention: int = 30
+    '''
+    `status.history_retention`
+    设备状态历史保留天数
+    - *设置为 0 则不按时间清理*
+    '''
+
+    history_max_rows: int = 10000
+    '''
+    `status.history_max_rows`
+    设备状态历史最多保留条数 (所有设备共计, 超出时删除最旧的记录)
+    - *设置为 0 则不限制*
+    '''
+
+    sse_heartbeat: PositiveInt = 30
+    '''
+    `status.sse_heartbeat`
+    SSE 事件流 (`/api/status/events`) 的心跳间隔 (秒)
+    '''
+
+    sse_queue_size: PositiveInt = 64
+    '''
+    `status.sse_queue_size`
+    每个 SSE 连接最多积压的事件数, 超出 (客户端读取过慢) 时断开连接, 由客户端重连
+    '''
+
+    sse_replay_size: int = 256
+    '''
+    `status.sse_replay_size`
+    为断线重连 (`Last-Event-ID`) 保留的最近事件数, 重连时补发错过的事件 (太旧则重新发送完整状态)
+    - *设置为 0 则禁用*
+    '''
+
+    sse_replay_bytes: int = 1048576
+    '''
+    `status.sse_replay_bytes`
+    保留的最近事件最多占用的内存 (字节, 超出时丢弃最旧的事件)
+    '''
+
     status_list: list[_StatusItemModel] = [
         _StatusItemModel(
             name='活着',
@@ -271,6 +460,21 @@ class _MetricsConfigModel(BaseModel):
     是否启用统计功能
     '''
 
+    flush_interval: int = 30
+    '''
+    `metrics.flush_interval`
+    统计数据写入数据库的间隔 (秒)
+    - 统计先累计在内存中, 每隔此时间批量写入一次 (退出时也会写入)
+    - *设置为 0 则每次请求都立即写入*
+    '''
+
+    bucket_retention: PositiveInt = 7
+    '''
+    `metrics.bucket_retention`
+    按小时保存的统计数据保留天数
+    - 超过此天数的数据会合并为按天保存 (用于 `/api/metrics/range`)
+    '''
+
     allow_list: list[str] = [
         '/',
         '/api/status/query',
@@ -280,6 +484,7 @@ class _MetricsConfigModel(BaseModel):
         '/api/device/remove',
         '/api/device/clear',
         '/api/device/private',
+        '/api/batch',
         '/api/status/events',
         '/api/metrics',
         '/api/meta',
@@ -14,6 +14,7 @@ from toml import loads as load_toml
 
 from models import ConfigModel, _StatusItemModel
 from data import Data, _DeviceStatusData
+from scheduler import Job
 import utils as u
 
 l = getLogger(__name__)
@@ -270,18 +271,22 @@ class DeviceSetEvent(BaseEvent):
     id = 'device_set'
     interceptable = True
 
-    def __init__(self, device_id: str | None, show_name: str | None, using: bool | None, status: str | None, fields: dict[str, t.Any]):
+    def __init__(self, device_id: str | None, show_name: str | None, using: bool | None, status: str | None, fields: dict[str, t.Any], ttl: int | None = None, expired: bool = False):
         '''
         :param device_id: 设备 id
         :param show_name: 设备前台显示名称
         :param using: 设备是否在使用
         :param status: 设备状态
+        :param ttl: 设备存活时间 (秒, 为空则保持之前的设置)
+        :param expired: 是否因设备过期而触发 (见 `status.device_ttl`)
         '''
         self.device_id = device_id
         self.show_name = show_name
         self.using = using
         self.status = status
         self.fields = fields
+        self.ttl = ttl
+        self.expired = expired
 
 
 class DeviceRemovedEvent(BaseEvent):
@@ -291,13 +296,14 @@ class DeviceRemovedEvent(BaseEvent):
     id = 'device_removed'
     interceptable = True
 
-    def __init__(self, exists: bool, device_id: str, show_name: str | None, using: bool | None, status: str | None, fields: dict[str, t.Any] | None):
+    def __init__(self, exists: bool, device_id: str, show_name: str | None, using: bool | None, status: str | None, fields: dict[str, t.Any] | None, expired: bool = False):
         '''
         :param exists: 设备在请求时是否存在
         :param device_id: 设备 id
         :param show_name: 设备前台显示名称
         :param using: 设备是否在使用
         :param status: 设备状态
+        :param expired: 是否因设备过期而触发 (见 `status.device_ttl`)
         '''
         self.exists = exists
         self.device_id = device_id
@@ -305,6 +311,7 @@ class DeviceRemovedEvent(BaseEvent):
         self.using = using
         self.status = status
         self.fields = fields
+        self.expired = expired
 
 
 class DeviceClearedEvent(BaseEvent):
@@ -431,7 +438,9 @@ class Plugin:
     @property
     def data(self):
         '''
-        插件数据存储
+        插件数据存储 (副本, 修改后需重新赋值才会保存)
+        - *数据按键存储并缓存在内存中, 只有变化的键会定期写入数据库 (见 `main.plugin_data_flush_interval`)*
+        - *单个键的读写请使用 `get_data()` / `set_data()` 等方法*
         '''
         return PluginInit.instance.d.get_plugin_data(self.name)
 
@@ -449,24 +458,52 @@ class Plugin:
             data['calls'] = data.get('calls', 0) + 1
         ```
         '''
-        data = self.data
-        yield data
-        if data != self.data:
-            self.data = data
+        with PluginInit.instance.d.plugin_data_context(self.name) as data:
+            yield data
 
     def set_data(self, key, value):
         '''
         设置数据值
         '''
-        data = self.data
-        data[key] = value
-        self.data = data
+        PluginInit.instance.d.set_plugin_data_item(self.name, key, value)
 
     def get_data(self, key, default=None):
         '''
         获取数据值
         '''
-        return self.data.get(key, default)
+        return PluginInit.instance.d.get_plugin_data_item(self.name, key, default)
+
+    def delete_data(self, key) -> bool:
+        '''
+        删除数据值
+
+        :return: 键是否存在
+        '''
+        return PluginInit.instance.d.delete_plugin_data_item(self.name, key)
+
+    def incr_data(self, key, amount: int | float = 1) -> int | float:
+        '''
+        将数值加上 `amount` (不存在则视为 0, 适合计数)
+
+        :return: 增加后的值
+        '''
+        return PluginInit.instance.d.incr_plugin_data_item(self.name, key, amount)
+
+    def scan_data(self, prefix: str = '') -> dict[str, t.Any]:
+        '''
+        获取所有以 `prefix` 开头的键值 (按键排序)
+
+        ```
+        songs = plugin.scan_data('song:')
+        ```
+        '''
+        return PluginInit.instance.d.scan_plugin_data(self.name, prefix)
+
+    def flush(self):
+        '''
+        立即将插件数据写入数据库 (通常无需调用, 退出时会自动写入)
+        '''
+        PluginInit.instance.d.flush_plugin_data(self.name)
 
     @property
     def global_config(self) -> ConfigModel:
@@ -694,6 +731,39 @@ class Plugin:
 
     # endregion plugin-api-injects
 
+    # region plugin-api-jobs
+
+    def add_scheduled_job(self, func: t.Callable[[], t.Any], every: float | None = None, at: str | None = None) -> Job:
+        '''
+        注册定时任务 (在调度线程中执行, 请勿长时间阻塞)
+
+        :param func: 任务函数 (无参数)
+        :param every: 执行间隔 (秒)
+        :param at: 每天执行的时间 (`HH:MM` / `HH:MM:SS`, 按 `main.timezone` 计算) *(与 `every` 二选一)*
+        :return: 任务 (可使用 `job.cancel()` 取消)
+        '''
+        if (every is None) == (at is None):
+            raise ValueError('exactly one of \'every\' and \'at\' must be set')
+        sch = PluginInit.instance.d.scheduler
+        name = f'{self.name}.{getattr(func, "__name__", "job")}'
+        if every is not None:
+            return sch.every(every, func, name=name)
+        return sch.daily(at, func, name=name)  # type: ignore
+
+    def scheduled_job(self, every: float | None = None, at: str | None = None):
+        '''
+        [装饰器] 注册定时任务
+
+        :param every: 执行间隔 (秒)
+        :param at: 每天执行的时间 (`HH:MM` / `HH:MM:SS`, 按 `main.timezone` 计算) *(与 `every` 二选一)*
+        '''
+        def decorator(f):
+            self.add_scheduled_job(f, every=every, at=at)
+            return f
+        return decorator
+
+    # endregion plugin-api-jobs
+
     def register_event(self, event: type[BaseEvent], handler: t.Callable):
         '''
         注册事件处理器
@@ -4,7 +4,6 @@
 
 from logging import getLogger
 from datetime import datetime
-import time
 import json
 
 import pytz
@@ -15,6 +14,7 @@ from markupsafe import escape
 from pydantic import BaseModel
 
 import plugin as pl
+from data import DataSnapshot
 from .utils import require_secret, APIUnsuccessful
 import utils as u
 
@@ -62,56 +62,44 @@ def query_req():
     return query()
 
 
-def query():
-    status = d.status_dict[1]
-    del status['id']
-    devices = d.device_list
+def v4_devices(snap: DataSnapshot) -> dict[str, dict]:
+    '''
+    将设备列表转换为 v4 格式 (`app_name` 代替 `status`, 去除 v5 新增的字段)
+
+    :param snap: 数据快照
+    '''
+    devices = snap.device_list()
     for dev in devices.values():
-        del dev['fields']
-        dev['app_name'] = dev['status']
-        del dev['status']
-        del dev['last_updated']
-        del dev['id']
+        dev['app_name'] = dev.pop('status')
+        for key in ('fields', 'last_updated', 'id', 'ttl'):
+            dev.pop(key, None)
+    return devices
+
+
+def query(snapshot: DataSnapshot | None = None):
+    snap = snapshot or d.snapshot()
+    status = to_primitive(d.get_status(snap.status_id)[1])
+    del status['id']
+    devices = v4_devices(snap)
     return {
         'time': datetime.now(tz).strftime(datefmt),
         'timezone': p.global_config.main.timezone,
         'success': True,
-        'status': d.status_id,
+        'status': snap.status_id,
         'info': status,
         'device': devices,
-        'last_updated': datetime.fromtimestamp(d.last_updated, tz).strftime(datefmt),
+        'last_updated': datetime.fromtimestamp(snap.last_updated, tz).strftime(datefmt),
         'refresh': c.status.refresh_interval,
         'device_status_slice': c.status.device_slice
     }
 
 
-def _event_stream(ipstr: str):
-    last_updated = None
-    last_heartbeat = time.time()
-
-    l.info(f'[SSE] Event stream connected: {ipstr}')
-    while True:
-        current_time = time.time()
-        # 检查数据是否已更新
-        current_updated = d.last_updated
-
-        # 如果数据有更新, 发送更新事件并重置心跳计时器
-        if last_updated != current_updated:
-            last_updated = current_updated
-            # 重置心跳计时器
-            last_heartbeat = current_time
-
-            # 获取 /query 返回数据
-            update_data = json.dumps(query(), ensure_ascii=False)
-            yield f'event: update\ndata: {update_data}\n\n'
-
-        # 只有在没有数据更新的情况下才检查是否需要发送心跳
-        elif current_time - last_heartbeat >= 30:
-            timenow = datetime.now(tz)
-            yield f"event: heartbeat\ndata: {timenow.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            last_heartbeat = current_time
-
-        time.sleep(1)  # 每秒检查一次更新
+_events_channel = d.broadcaster.channel(
+    'v4_events',
+    build=lambda: json.dumps(query(), ensure_ascii=False),
+    heartbeat=lambda: datetime.now(tz).strftime(datefmt),
+    with_id=False
+)
 
 
 @p.global_route('/events')
@@ -126,9 +114,8 @@ def events():
         return evt.interception
     ipstr: str = flask.g.ipstr
 
-    response = flask.Response(_event_stream(ipstr), mimetype='text/event-stream', status=200)
-    response.headers['Cache-Control'] = 'no-cache'  # 禁用缓存
-    response.headers['X-Accel-Buffering'] = 'no'  # 禁用 Nginx 缓冲
+    l.info(f'[SSE] Event stream connected: {ipstr}')
+    response = _events_channel.response()
     response.call_on_close(lambda: (
         l.info(f'[SSE] Event stream disconnected: {ipstr}'),
         p.trigger_event(pl.StreamDisconnectedEvent())
@@ -345,20 +332,15 @@ def device_private_mode():
 @require_secret()
 def save_data():
     if conf.simulate_save_data:
-        devices = d.device_list
-        for dev in devices.values():
-            del dev['fields']
-            dev['app_name'] = dev['status']
-            del dev['status']
-            del dev['last_updated']
-            del dev['id']
+        snap = d.snapshot()
+        devices = v4_devices(snap)
         return {
             'success': True,
             'code': 'OK',
             'data': {
-                'status': d.status_id,
+                'status': snap.status_id,
                 'device_status': devices,
-                'last_updated': datetime.fromtimestamp(d.last_updated, tz).strftime(datefmt)
+                'last_updated': datetime.fromtimestamp(snap.last_updated, tz).strftime(datefmt)
             }
         }
     else:
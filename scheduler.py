@@ -0,0 +1,212 @@
+# coding: utf-8
+
+from datetime import datetime, timedelta, time as dtime
+from logging import getLogger
+from threading import Thread, Condition, current_thread
+from time import time
+from typing import Any, Callable
+from heapq import heappop, heappush
+from itertools import count
+
+import pytz
+
+l = getLogger(__name__)
+
+MAX_WAIT = 300
+'''
+最长连续等待时间 (秒)
+- 等待超时基于单调时钟, 而任务时间基于系统时间; 定期醒来重新计算, 避免系统时间被校准 (如无 RTC 的设备开机后同步 NTP) 后任务长时间不执行
+'''
+
+
+class Job:
+    '''
+    调度任务 (由 `Scheduler.every()` / `Scheduler.daily()` / `Scheduler.call_at()` 创建)
+    '''
+
+    def __init__(self, scheduler: 'Scheduler', func: Callable[[], Any], name: str, interval: float | None, at: dtime | None):
+        self._scheduler = scheduler
+        self.func = func
+        self.name = name
+        '''任务名 (用于日志)'''
+        self.interval = interval
+        '''执行间隔 (秒, 仅 `every()` 任务)'''
+        self.at = at
+        '''每天执行的时间 (仅 `daily()` 任务)'''
+        self.next_run: float = 0
+        '''下次执行的时间 (utc timestamp)'''
+        self.cancelled = False
+
+    def cancel(self):
+        '''
+        取消任务 (正在执行的不会被中断)
+        '''
+        self._scheduler.cancel(self)
+
+    def __repr__(self):
+        return f'<Job {self.name} next_run={self.next_run}>'
+
+
+class Scheduler:
+    '''
+    基于时间堆的任务调度器: 单个线程睡眠到最早的任务到期, 无任务到期时不会被唤醒
+    - 任务在调度线程中依次执行 (请勿在任务中长时间阻塞)
+    - `daily()` 任务按 `main.timezone` 计算时间
+    '''
+
+    def __init__(self, timezone: str, name: str = 'scheduler'):
+        '''
+        :param timezone: 时区 (用于 `daily()` 任务)
+        :param name: 调度线程名
+        '''
+        self._tz = pytz.timezone(timezone)
+        self._name = name
+        self._heap: list[tuple[float, int, Job]] = []
+        '''`(执行时间, 序号, 任务)` (已取消的任务在弹出时跳过)'''
+        self._seq = count()
+        self._cond = Condition()
+        '''保护 `_heap` / `_stopped`, 最早的执行时间变化时通知'''
+        self._stopped = False
+        self._thread: Thread | None = None
+
+    def start(self):
+        '''
+        启动调度线程
+        '''
+        with self._cond:
+            if self._thread or self._stopped:
+                return
+            self._thread = Thread(target=self._loop, name=self._name, daemon=True)
+            self._thread.start()
+
+    def shutdown(self, wait: float | None = 10) -> bool:
+        '''
+        停止调度线程 (只会执行一次, 之后添加的任务不再执行)
+
+        :param wait: 等待正在执行的任务结束的最长时间 (秒, 为 0 则不等待)
+        :return: 是否为第一次调用
+        '''
+        with self._cond:
+            if self._stopped:
+                return False
+            self._stopped = True
+            self._cond.notify_all()
+        if wait != 0 and self._thread and self._thread is not current_thread():
+            self._thread.join(wait)
+        l.debug(f'[{self._name}] stopped')
+        return True
+
+    @property
+    def jobs(self) -> list[Job]:
+        '''
+        未取消的任务 (按下次执行时间排序)
+        '''
+        with self._cond:
+            return sorted((job for _, _, job in self._heap if not job.cancelled), key=lambda job: job.next_run)
+
+    def _push(self, job: Job):
+        '''
+        将任务加入时间堆 (需持有 `_cond`)
+        '''
+        heappush(self._heap, (job.next_run, next(self._seq), job))
+        if self._heap[0][2] is job:
+            self._cond.notify()
+
+    def every(self, seconds: float, func: Callable[[], Any], name: str | None = None, run_now: bool = False) -> Job:
+        '''
+        添加按间隔执行的任务
+
+        :param seconds: 执行间隔 (秒)
+        :param func: 任务函数 (无参数)
+        :param name: 任务名 (为空则使用函数名)
+        :param run_now: 是否立即执行一次 (否则在 `seconds` 秒后第一次执行)
+        '''
+        if seconds <= 0:
+            raise ValueError('interval must be positive')
+        job = Job(self, func, name or func.__name__, interval=seconds, at=None)
+        job.next_run = time() if run_now else time() + seconds
+        with self._cond:
+            self._push(job)
+        return job
+
+    def daily(self, at: str, func: Callable[[], Any], name: str | None = None, run_now: bool = False) -> Job:
+        '''
+        添加每天在指定时间 (`main.timezone`) 执行的任务
+
+        :param at: 执行时间 (`HH:MM` / `HH:MM:SS`)
+        :param func: 任务函数 (无参数)
+        :param name: 任务名 (为空则使用函数名)
+        :param run_now: 是否立即执行一次
+        '''
+        job = Job(self, func, name or func.__name__, interval=None, at=dtime.fromisoformat(at))
+        job.next_run = time() if run_now else self._next_daily(job.at, time())  # type: ignore
+        with self._cond:
+            self._push(job)
+        return job
+
+    def call_at(self, when: float, func: Callable[[], Any], name: str | None = None) -> Job:
+        '''
+        添加只执行一次的任务
+
+        :param when: 执行时间 (utc timestamp, 已过去则尽快执行)
+        :param func: 任务函数 (无参数)
+        :param name: 任务名 (为空则使用函数名)
+        '''
+        job = Job(self, func, name or func.__name__, interval=None, at=None)
+        job.next_run = when
+        with self._cond:
+            self._push(job)
+        return job
+
+    def cancel(self, job: Job):
+        '''
+        取消任务
+        '''
+        with self._cond:
+            job.cancelled = True
+
+    def _next_daily(self, at: dtime, after: float) -> float:
+        '''
+        计算 `after` 之后下一个 (本地时间) `at` 的时间戳
+        - 夏令时切换导致时间不存在 / 重复时按标准时间计算
+        '''
+        day = datetime.fromtimestamp(after, self._tz).date()
+        while True:
+            ts = self._tz.localize(datetime.combine(day, at), is_dst=False).timestamp()
+            if ts > after:
+                return ts
+            day += timedelta(days=1)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, _, job = heappop(self._heap)
+                        if not job.cancelled:
+                            break
+                    else:
+                        self._cond.wait(min(self._heap[0][0] - now, MAX_WAIT) if self._heap else MAX_WAIT)
+
+            try:
+                job.func()
+            except Exception as e:
+                l.error(f'[{self._name}] Error when running job {job.name}: {e}')
+
+            with self._cond:
+                if job.cancelled or self._stopped:
+                    continue
+                now = time()
+                if job.interval:
+                    # 按计划时间累加 (不因执行耗时漂移), 落后太多则从现在开始
+                    job.next_run += job.interval
+                    if job.next_run <= now:
+                        job.next_run = now + job.interval
+                elif job.at:
+                    job.next_run = self._next_daily(job.at, now)
+                else:
+                    continue
+                self._push(job)
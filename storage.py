@@ -0,0 +1,1208 @@
+# coding: utf-8
+
+import os
+import json
+from logging import getLogger
+from threading import RLock, local
+from time import time
+from typing import Any, Callable, Iterator
+from types import SimpleNamespace
+from collections import Counter
+from copy import deepcopy
+from contextlib import contextmanager
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, JSON, Integer, Float, String, Boolean, Text, Index, update, delete, insert, select, literal, func, case, inspect, text
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import utils as u
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+db = SQLAlchemy()
+LIMIT = 1024
+HOUR = 3600
+DAY = 86400
+UPSERT_CHUNK = 200
+STREAM_CHUNK = 1000
+'''导出时每批读取 / 导入时每批插入的行数'''
+TABLES: dict[str, tuple[str, ...]] = {
+    'main': ('status', 'private_mode', 'last_updated'),
+    'device': ('id', 'show_name', 'using', 'status', 'fields', 'last_updated', 'ttl'),
+    'history': ('id', 'device_id', 'timestamp', 'show_name', 'using', 'status'),
+    'metrics': ('path', 'start', 'span', 'count'),
+    'plugin': ('plugin_id', 'key', 'value')
+}
+'''可导出 / 导入的数据及其列 (按导出顺序)'''
+
+
+class StorageError(Exception):
+    '''
+    存储后端读写失败
+    '''
+
+
+# region sql-models
+
+
+class _MainData(db.Model):
+    '''
+    主程序数据
+    '''
+    __tablename__ = 'main'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
+    status: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    '''当前状态 id *(即 status_list 中的列表索引)*'''
+    private_mode: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    '''是否开启隐私模式 *(启用时 /query 返回中的 `device` 替换为空字典)*'''
+    last_updated: Mapped[float] = mapped_column(Float, default=time, onupdate=time)
+    '''数据最后更新时间 (utc timestamp)'''
+
+
+class _DeviceStatusData(db.Model):
+    '''
+    设备状态
+    '''
+    __tablename__ = 'device_status'
+    id: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
+    '''[必选] 设备唯一 id'''
+    show_name: Mapped[str] = mapped_column(String(LIMIT), nullable=False)
+    '''[必选] 设备显示名称'''
+    using: Mapped[bool] = mapped_column(Boolean, nullable=True)
+    '''[可选] 设备是否正在使用'''
+    status: Mapped[str] = mapped_column(Text, nullable=True)
+    '''[可选] 设备状态文本 (如打开的应用名)'''
+    fields: Mapped[dict] = mapped_column(JSON, default=dict, nullable=False)
+    '''[可选] 设备的扩展字段'''
+    last_updated: Mapped[float] = mapped_column(Float, default=time, onupdate=time)
+    '''(本设备) 数据最后更新时间 (utc timestamp)'''
+    ttl: Mapped[int] = mapped_column(Integer, nullable=True)
+    '''[可选] (本设备) 存活时间 (秒), 为空则使用 `status.device_ttl`'''
+
+
+class _DeviceHistoryData(db.Model):
+    '''
+    设备状态历史 (只追加)
+    - 每次 `using` / `status` / `show_name` 实际变化时记录一行
+    '''
+    __tablename__ = 'device_history'
+    __table_args__ = (
+        Index('ix_device_history_device_time', 'device_id', 'timestamp'),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    '''记录 id (自增, 同时用作分页游标)'''
+    device_id: Mapped[str] = mapped_column(String(LIMIT), nullable=False)
+    '''设备唯一 id'''
+    timestamp: Mapped[float] = mapped_column(Float, nullable=False)
+    '''变化时间 (utc timestamp)'''
+    show_name: Mapped[str] = mapped_column(String(LIMIT), nullable=False)
+    '''设备显示名称'''
+    using: Mapped[bool] = mapped_column(Boolean, nullable=True)
+    '''设备是否正在使用'''
+    status: Mapped[str] = mapped_column(Text, nullable=True)
+    '''设备状态文本'''
+
+
+class _MetricsData(db.Model):
+    '''
+    访问统计数据 (旧版滚动计数器)
+    - *已由 `_MetricsBucketData` 取代, 仅在首次启动时迁移使用*
+    '''
+    __tablename__ = 'metrics'
+    path: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
+    daily: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    weekly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    monthly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    yearly: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class _MetricsBucketData(db.Model):
+    '''
+    访问统计数据 (按时间分桶)
+    - 按小时记录, 超过 `metrics.bucket_retention` 天的小时桶会合并为天桶
+    '''
+    __tablename__ = 'metrics_bucket'
+    __table_args__ = (
+        Index('ix_metrics_bucket_start', 'start'),
+    )
+    path: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, nullable=False)
+    '''路径'''
+    start: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    '''桶开始时间 (utc timestamp, 对齐到设置时区的 整点 / 0 点)'''
+    span: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, default=HOUR)
+    '''桶长度 (秒, `HOUR` / `DAY`)'''
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    '''访问次数'''
+
+
+class _PluginData(db.Model):
+    '''
+    插件数据 (旧版, 整个插件数据存为一个 JSON)
+    - *已由 `_PluginKVData` 取代, 仅在首次启动时迁移使用*
+    '''
+    __tablename__ = 'plugin'
+    id: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, unique=True, nullable=False)
+    '''插件 id'''
+    data: Mapped[dict] = mapped_column(JSON, default=dict, nullable=False)
+    '''插件数据'''
+
+
+class _PluginKVData(db.Model):
+    '''
+    插件数据 (每个键一行)
+    '''
+    __tablename__ = 'plugin_kv'
+    plugin_id: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, nullable=False)
+    '''插件 id'''
+    key: Mapped[str] = mapped_column(String(LIMIT), primary_key=True, nullable=False)
+    '''键'''
+    value: Mapped[Any] = mapped_column(JSON, nullable=True)
+    '''值'''
+
+
+def _upsert(model: type[db.Model], rows: list[dict[str, Any]], keys: tuple[str, ...], set_: Callable[[Any], dict[str, Any]] | None = None):
+    '''
+    执行数据库原生的 upsert (插入, 主键冲突时更新)
+    - SQLite / PostgreSQL: `INSERT ... ON CONFLICT DO UPDATE`
+    - MySQL / MariaDB: `INSERT ... ON DUPLICATE KEY UPDATE`
+    - 其他: 逐行 `UPDATE`, 未更新到行时再 `INSERT`
+    *需在 app context 内调用, 不会提交*
+
+    :param model: 数据表
+    :param rows: 要插入的行 (列名需一致, 每 `UPSERT_CHUNK` 行一条语句)
+    :param keys: 主键列名
+    :param set_: 冲突时更新的值, 传入新行 (`excluded`, 可用 `.列名` 访问) 返回 `{列名: 值/表达式}` *(为空则将非主键列更新为新值)*
+    '''
+    if not rows:
+        return
+    set_ = set_ or (lambda excluded: {k: getattr(excluded, k) for k in rows[0] if k not in keys})
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        for i in range(0, len(rows), UPSERT_CHUNK):
+            stmt = (sqlite_insert if dialect == 'sqlite' else postgresql_insert)(model).values(rows[i:i + UPSERT_CHUNK])
+            db.session.execute(stmt.on_conflict_do_update(index_elements=keys, set_=set_(stmt.excluded)))
+    elif dialect in ('mysql', 'mariadb'):
+        for i in range(0, len(rows), UPSERT_CHUNK):
+            stmt = mysql_insert(model).values(rows[i:i + UPSERT_CHUNK])
+            db.session.execute(stmt.on_duplicate_key_update(set_(stmt.inserted)))
+    else:
+        for row in rows:
+            excluded = SimpleNamespace(**{k: literal(v, model.__table__.c[k].type) for k, v in row.items()})
+            where = [model.__table__.c[k] == row[k] for k in keys]
+            if not db.session.execute(update(model).where(*where).values(set_(excluded))).rowcount:
+                db.session.execute(insert(model).values(row))
+
+# endregion sql-models
+
+# region backend
+
+
+class Backend:
+    '''
+    存储后端接口
+    - 负责 main 状态 / 设备 / 设备历史 / 统计 / 插件数据 的持久化, 缓存及业务逻辑由 `data.Data` 处理
+    - 写入方法需在 `transaction()` 内调用, 读取方法可在事务内外调用 (事务内可读到未提交的修改)
+    - 读写失败时抛出 `StorageError`
+
+    设备行 (`dict`): `id`, `show_name`, `using`, `status`, `fields`, `last_updated` \n
+    历史记录 (`dict`): `id`, `device_id`, `time`, `show_name`, `using`, `status`
+    '''
+
+    name: str = ''
+    '''后端名称 (用于日志)'''
+
+    @contextmanager
+    def transaction(self):
+        '''
+        事务: 正常退出时提交, 出现异常时回滚其中的全部修改
+        - 同一线程中嵌套调用会并入外层事务
+        '''
+        raise NotImplementedError
+        yield
+
+    def migrate(self, metrics_periods: tuple[int, int, int, int]):
+        '''
+        从旧版数据格式迁移 (启动时调用)
+
+        :param metrics_periods: 今日 / 本周 / 本月 / 今年 的开始时间戳
+        '''
+
+    def snapshot(self):
+        '''
+        保存快照 (仅对支持快照的后端有效)
+        '''
+
+    def close(self):
+        '''
+        关闭后端 (退出时调用)
+        '''
+
+    # --- main
+
+    def main_get(self) -> dict[str, Any]:
+        '''
+        获取 main 状态 (`status`, `private_mode`, `last_updated`)
+        '''
+        raise NotImplementedError
+
+    def main_set(self, **values: Any):
+        '''
+        设置 main 状态字段
+        '''
+        raise NotImplementedError
+
+    # --- device
+
+    def device_get(self, id: str) -> dict[str, Any] | None:
+        '''
+        获取单个设备行 (副本)
+        '''
+        raise NotImplementedError
+
+    def device_all(self) -> list[dict[str, Any]]:
+        '''
+        获取所有设备行 (副本, 未排序)
+        '''
+        raise NotImplementedError
+
+    def device_upsert(self, row: dict[str, Any]):
+        '''
+        写入设备行 (已存在则替换)
+        '''
+        raise NotImplementedError
+
+    def device_update(self, id: str, values: dict[str, Any]):
+        '''
+        只更新已存在设备行的部分列 (如只有 `last_updated` 变化时无需重写 `fields`)
+        '''
+        raise NotImplementedError
+
+    def device_delete(self, id: str) -> bool:
+        '''
+        删除设备
+
+        :return: 设备是否存在
+        '''
+        raise NotImplementedError
+
+    def device_clear(self) -> int:
+        '''
+        删除所有设备
+
+        :return: 删除的设备数
+        '''
+        raise NotImplementedError
+
+    # --- history
+
+    def history_add(self, row: dict[str, Any]):
+        '''
+        追加设备状态历史 (`device_id`, `timestamp`, `show_name`, `using`, `status`)
+        '''
+        raise NotImplementedError
+
+    def history_query(self, id: str | None, start: float | None, end: float | None, limit: int, cursor: int | None) -> list[dict[str, Any]]:
+        '''
+        查询设备状态历史 (从新到旧, 参数见 `Data.device_history()`)
+        '''
+        raise NotImplementedError
+
+    def history_cleanup(self, before: float | None, max_rows: int) -> int:
+        '''
+        清理设备状态历史
+
+        :param before: 删除早于此时间的记录 (为空不限制)
+        :param max_rows: 只保留最新的 N 条 (<= 0 不限制)
+        :return: 删除的记录数
+        '''
+        raise NotImplementedError
+
+    # --- metrics
+
+    def metrics_add(self, counts: dict[tuple[str, int, int], int]):
+        '''
+        增加统计桶的计数
+
+        :param counts: `(路径, 桶开始时间, 桶长度)` -> 增加的次数
+        '''
+        raise NotImplementedError
+
+    def metrics_reset(self, path: str, start: int, count: int):
+        '''
+        清除路径的所有统计桶, 并写入一个小时桶
+        '''
+        raise NotImplementedError
+
+    def metrics_summary(self, periods: tuple[int, int, int, int], path: str | None) -> dict[str, list[int]]:
+        '''
+        汇总统计桶
+
+        :param periods: 今日 / 本周 / 本月 / 今年 的开始时间戳
+        :param path: 仅汇总指定路径 (为空则汇总所有路径)
+        :return: `{路径: [今日, 本周, 本月, 今年, 全部]}`
+        '''
+        raise NotImplementedError
+
+    def metrics_range(self, path: str | None, start: int, end: int, step: int) -> dict[int, int]:
+        '''
+        按区间汇总统计桶 (参数见 `Data.metrics_range()`)
+
+        :return: `{区间序号: 次数}`
+        '''
+        raise NotImplementedError
+
+    def metrics_compact(self, cutoff: int, day_start: Callable[[int], int]) -> int:
+        '''
+        将早于 `cutoff` 的小时桶合并为天桶
+
+        :param day_start: 获取时间戳所在当天 0 点的时间戳
+        :return: 合并后的天桶数
+        '''
+        raise NotImplementedError
+
+    # --- plugin
+
+    def plugin_all(self) -> dict[str, dict[str, Any]]:
+        '''
+        获取所有插件数据 (`插件 id` -> `{键: 值}`)
+        '''
+        raise NotImplementedError
+
+    def plugin_write(self, upserts: list[tuple[str, str, Any]], deletes: list[tuple[str, str]]):
+        '''
+        写入插件数据
+
+        :param upserts: 写入的 `(插件 id, 键, 值)`
+        :param deletes: 删除的 `(插件 id, 键)`
+        '''
+        raise NotImplementedError
+
+    # --- 导出 / 导入
+
+    def export_rows(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        '''
+        流式导出全部数据 (`(数据名, 行)`, 数据名及列见 `TABLES`, 按其顺序导出)
+        - 所有数据在同一次读取中导出, 相互一致
+        - 逐批读取, 内存占用与数据量无关
+        '''
+        raise NotImplementedError
+
+    def import_clear(self):
+        '''
+        清空 设备 / 设备历史 / 统计 / 插件数据 (导入前调用)
+        '''
+        raise NotImplementedError
+
+    def import_rows(self, table: str, rows: list[dict[str, Any]]):
+        '''
+        批量插入行 (`main` 以外的数据, 列见 `TABLES`)
+        - 设备历史的 `id` 会被忽略, 按插入顺序重新分配
+        '''
+        raise NotImplementedError
+
+
+class SqlBackend(Backend):
+    '''
+    SQL 数据库存储后端 (Flask-SQLAlchemy)
+    '''
+
+    def __init__(self, config: ConfigModel, app: Flask):
+        self._c = config
+        self._app = app
+        self._local = local()
+        # 配置数据库地址
+        app.config['SQLALCHEMY_DATABASE_URI'] = config.main.database
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = self._engine_options()
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        # 初始化数据库
+        db.init_app(app)
+        with app.app_context():
+            self.name = db.engine.dialect.name
+            if self.name == 'sqlite':
+                event.listen(db.engine, 'connect', self._sqlite_pragmas)
+            self._log_database()
+            db.create_all()
+            if not _MainData.query.first():
+                l.debug(f'[data] main_data not exist, creating a new one')
+                db.session.add(_MainData())
+                db.session.commit()
+
+    def _engine_options(self) -> dict[str, Any]:
+        '''
+        由 `main.storage_options` 生成 `SQLALCHEMY_ENGINE_OPTIONS` (未设置的项不传入)
+        '''
+        opts = self._c.main.storage_options
+        ret: dict[str, Any] = {}
+        for k in ('pool_size', 'max_overflow', 'pool_recycle'):
+            v = getattr(opts, k)
+            if v is not None:
+                ret[k] = v
+        if opts.pool_pre_ping:
+            ret['pool_pre_ping'] = True
+        return ret
+
+    def _sqlite_pragmas(self, dbapi_conn, connection_record):
+        '''
+        新建 SQLite 连接时设置 pragma (`connect` 事件)
+        '''
+        opts = self._c.main.storage_options
+        pragmas = {
+            'journal_mode': opts.sqlite_journal_mode,
+            'synchronous': opts.sqlite_synchronous,
+            'busy_timeout': opts.sqlite_busy_timeout,
+            'cache_size': opts.sqlite_cache_size
+        }
+        cursor = dbapi_conn.cursor()
+        try:
+            for k, v in pragmas.items():
+                if v is not None:
+                    # 值已由配置模型限定为枚举 / 整数
+                    cursor.execute(f'PRAGMA {k}={v}')
+        finally:
+            cursor.close()
+
+    def _log_database(self):
+        '''
+        输出数据库连接的实际设置
+        '''
+        engine = db.engine
+        pool = engine.pool
+        pool_info = []
+        if hasattr(pool, 'size'):
+            pool_info.append(f'size={pool.size()}')
+            pool_info.append(f'max_overflow={getattr(pool, "_max_overflow", "-")}')
+        pool_info.append(f'recycle={getattr(pool, "_recycle", -1)}')
+        pool_info.append(f'pre_ping={getattr(pool, "_pre_ping", False)}')
+        l.info(f'[data] database: {engine.dialect.name}, pool: {type(pool).__name__} ({", ".join(pool_info)})')
+
+        if engine.dialect.name == 'sqlite':
+            synchronous_names = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+            try:
+                with engine.connect() as conn:
+                    journal_mode = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+                    synchronous = conn.exec_driver_sql('PRAGMA synchronous').scalar()
+                    busy_timeout = conn.exec_driver_sql('PRAGMA busy_timeout').scalar()
+                    cache_size = conn.exec_driver_sql('PRAGMA cache_size').scalar()
+            except SQLAlchemyError as e:
+                l.warning(f'[data] failed to read sqlite pragmas: {e}')
+                return
+            l.info(f'[data] sqlite: journal_mode={journal_mode}, synchronous={synchronous_names.get(synchronous, synchronous)}, busy_timeout={busy_timeout}ms, cache_size={cache_size}')
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'active', False):
+            # 嵌套 -> 并入外层事务
+            yield
+            return
+        try:
+            with self._app.app_context():
+                self._local.active = True
+                try:
+                    yield
+                    db.session.commit()
+                except:
+                    db.session.rollback()
+                    raise
+                finally:
+                    self._local.active = False
+        except SQLAlchemyError as e:
+            raise StorageError(e) from e
+
+    @contextmanager
+    def _read(self):
+        '''
+        读取上下文: 在事务中则复用事务的 session, 否则新建 app context
+        '''
+        try:
+            if getattr(self._local, 'active', False):
+                yield
+            else:
+                with self._app.app_context():
+                    yield
+        except SQLAlchemyError as e:
+            raise StorageError(e) from e
+
+    def migrate(self, metrics_periods: tuple[int, int, int, int]):
+        with self.transaction():
+            if self._c.metrics.enabled:
+                self._metrics_migrate(metrics_periods)
+            self._plugin_migrate()
+            self._device_migrate()
+
+    def _metrics_migrate(self, periods: tuple[int, int, int, int]):
+        '''
+        将旧版滚动计数器 (`_MetricsData`) 迁移为分桶数据 (仅在分桶数据为空时执行)
+        - 各周期的计数差值分别放入对应周期开始时的天桶中
+        '''
+        if db.session.execute(select(_MetricsBucketData.path).limit(1)).first():
+            return
+        legacy: list[_MetricsData] = _MetricsData.query.all()
+        if not legacy:
+            return
+        rows = []
+        for m in legacy:
+            # 从近到远: 每个周期开始时的天桶放入 (此周期计数 - 更近周期计数)
+            boundaries = sorted(zip(periods, (m.daily, m.weekly, m.monthly, m.yearly)), reverse=True) + [(0, m.total)]
+            assigned = 0
+            for start, count in boundaries:
+                if count > assigned:
+                    rows.append({'path': m.path, 'start': start, 'span': DAY, 'count': count - assigned})
+                    assigned = count
+        _upsert(_MetricsBucketData, rows, keys=('path', 'start', 'span'))
+        l.info(f'[metrics] migrated {len(legacy)} legacy metrics rows into {len(rows)} buckets')
+
+    def _device_migrate(self):
+        '''
+        为旧版设备状态表添加 `ttl` 列 (`create_all()` 不会修改已存在的表)
+        '''
+        if 'ttl' in {col['name'] for col in inspect(db.engine).get_columns(_DeviceStatusData.__tablename__)}:
+            return
+        db.session.execute(text(f'ALTER TABLE {_DeviceStatusData.__tablename__} ADD COLUMN ttl INTEGER'))
+        l.info('[device] added column ttl to device status table')
+
+    def _plugin_migrate(self):
+        '''
+        将旧版插件数据 (`_PluginData`, 每个插件一个 JSON) 迁移为按键存储 (仅在新表为空时执行)
+        '''
+        if db.session.execute(select(_PluginKVData.plugin_id).limit(1)).first():
+            return
+        legacy: list[_PluginData] = _PluginData.query.all()
+        rows = [{'plugin_id': p.id, 'key': str(k), 'value': v} for p in legacy for k, v in (p.data or {}).items()]
+        if not rows:
+            return
+        _upsert(_PluginKVData, rows, keys=('plugin_id', 'key'))
+        l.info(f'[plugin] migrated data of {len(legacy)} plugins into {len(rows)} keys')
+
+    # --- main
+
+    def main_get(self) -> dict[str, Any]:
+        m = _MainData.__table__
+        with self._read():
+            row = db.session.execute(select(m.c.status, m.c.private_mode, m.c.last_updated)).mappings().first()
+            return dict(row)  # type: ignore
+
+    def main_set(self, **values: Any):
+        db.session.execute(update(_MainData).values(**values))
+
+    # --- device
+
+    def device_get(self, id: str) -> dict[str, Any] | None:
+        t = _DeviceStatusData.__table__
+        with self._read():
+            row = db.session.execute(select(t).where(t.c.id == id)).mappings().first()
+            return dict(row) if row else None
+
+    def device_all(self) -> list[dict[str, Any]]:
+        with self._read():
+            return [dict(row) for row in db.session.execute(select(_DeviceStatusData.__table__)).mappings()]
+
+    def device_upsert(self, row: dict[str, Any]):
+        _upsert(_DeviceStatusData, [row], keys=('id',))
+
+    def device_update(self, id: str, values: dict[str, Any]):
+        db.session.execute(update(_DeviceStatusData).where(_DeviceStatusData.id == id).values(**values))
+
+    def device_delete(self, id: str) -> bool:
+        return db.session.execute(delete(_DeviceStatusData).where(_DeviceStatusData.id == id)).rowcount > 0
+
+    def device_clear(self) -> int:
+        return db.session.execute(delete(_DeviceStatusData)).rowcount
+
+    # --- history
+
+    def history_add(self, row: dict[str, Any]):
+        db.session.execute(insert(_DeviceHistoryData).values(**row))
+
+    def history_query(self, id: str | None, start: float | None, end: float | None, limit: int, cursor: int | None) -> list[dict[str, Any]]:
+        h = _DeviceHistoryData
+        stmt = select(h).order_by(h.id.desc()).limit(limit)
+        if id is not None:
+            stmt = stmt.where(h.device_id == id)
+        if start is not None:
+            stmt = stmt.where(h.timestamp >= start)
+        if end is not None:
+            stmt = stmt.where(h.timestamp < end)
+        if cursor is not None:
+            stmt = stmt.where(h.id < cursor)
+        with self._read():
+            return [{
+                'id': i.id,
+                'device_id': i.device_id,
+                'time': i.timestamp,
+                'show_name': i.show_name,
+                'using': i.using,
+                'status': i.status
+            } for i in db.session.execute(stmt).scalars()]
+
+    def history_cleanup(self, before: float | None, max_rows: int) -> int:
+        h = _DeviceHistoryData
+        removed = 0
+        if before is not None:
+            removed += db.session.execute(delete(h).where(h.timestamp < before)).rowcount
+        if max_rows > 0:
+            # 保留最新的 N 条
+            boundary = db.session.execute(select(h.id).order_by(h.id.desc()).offset(max_rows - 1).limit(1)).scalar()
+            if boundary is not None:
+                removed += db.session.execute(delete(h).where(h.id < boundary)).rowcount
+        return removed
+
+    # --- metrics
+
+    def metrics_add(self, counts: dict[tuple[str, int, int], int]):
+        b = _MetricsBucketData
+        _upsert(b, [{
+            'path': path,
+            'start': start,
+            'span': span,
+            'count': count
+        } for (path, start, span), count in counts.items()], keys=('path', 'start', 'span'), set_=lambda excluded: {
+            'count': b.count + excluded.count
+        })
+
+    def metrics_reset(self, path: str, start: int, count: int):
+        db.session.execute(delete(_MetricsBucketData).where(_MetricsBucketData.path == path))
+        db.session.execute(insert(_MetricsBucketData).values(path=path, start=start, span=HOUR, count=count))
+
+    def metrics_summary(self, periods: tuple[int, int, int, int], path: str | None) -> dict[str, list[int]]:
+        b = _MetricsBucketData
+        stmt = select(
+            b.path,
+            *(func.sum(case((b.start >= p, b.count), else_=0)) for p in periods),
+            func.sum(b.count)
+        ).group_by(b.path)
+        if path is not None:
+            stmt = stmt.where(b.path == path)
+        with self._read():
+            return {row[0]: [int(i or 0) for i in row[1:]] for row in db.session.execute(stmt)}
+
+    def metrics_range(self, path: str | None, start: int, end: int, step: int) -> dict[int, int]:
+        b = _MetricsBucketData
+        idx = ((b.start - start) // step).label('idx')
+        stmt = select(idx, func.sum(b.count)).where(b.start >= start, b.start < end).group_by(idx)
+        if path is not None:
+            stmt = stmt.where(b.path == path)
+        with self._read():
+            return {int(i): int(count or 0) for i, count in db.session.execute(stmt)}
+
+    def metrics_compact(self, cutoff: int, day_start: Callable[[int], int]) -> int:
+        b = _MetricsBucketData
+        days: Counter[tuple[str, int, int]] = Counter()
+        for path, start, count in db.session.execute(select(b.path, b.start, b.count).where(b.span == HOUR, b.start < cutoff)):
+            days[(path, day_start(start), DAY)] += count
+        if days:
+            self.metrics_add(days)
+            db.session.execute(delete(b).where(b.span == HOUR, b.start < cutoff))
+        return len(days)
+
+    # --- plugin
+
+    def plugin_all(self) -> dict[str, dict[str, Any]]:
+        ret: dict[str, dict[str, Any]] = {}
+        with self._read():
+            for plugin_id, key, value in db.session.execute(select(_PluginKVData.plugin_id, _PluginKVData.key, _PluginKVData.value)):
+                ret.setdefault(plugin_id, {})[key] = value
+        return ret
+
+    def plugin_write(self, upserts: list[tuple[str, str, Any]], deletes: list[tuple[str, str]]):
+        _upsert(_PluginKVData, [{'plugin_id': p, 'key': k, 'value': v} for p, k, v in upserts], keys=('plugin_id', 'key'))
+        deleted: dict[str, list[str]] = {}
+        for p, k in deletes:
+            deleted.setdefault(p, []).append(k)
+        for plugin_id, keys in deleted.items():
+            for i in range(0, len(keys), UPSERT_CHUNK):
+                db.session.execute(delete(_PluginKVData).where(
+                    _PluginKVData.plugin_id == plugin_id,
+                    _PluginKVData.key.in_(keys[i:i + UPSERT_CHUNK])
+                ))
+
+    # --- 导出 / 导入
+
+    _TABLE_MODELS: dict[str, type[db.Model]] = {
+        'device': _DeviceStatusData,
+        'history': _DeviceHistoryData,
+        'metrics': _MetricsBucketData,
+        'plugin': _PluginKVData
+    }
+
+    def export_rows(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        # 使用独立连接 (不占用 app context 中的 session), 整个导出在同一事务中读取
+        with self._app.app_context():
+            engine = db.engine
+        try:
+            with engine.connect() as conn:
+                m = _MainData.__table__
+                yield 'main', dict(conn.execute(select(*(m.c[k] for k in TABLES['main']))).mappings().one())
+                for table, model in self._TABLE_MODELS.items():
+                    t = model.__table__
+                    # yield_per: 使用服务端游标 (stream_results), 每次只取回 STREAM_CHUNK 行
+                    stmt = select(*(t.c[k] for k in TABLES[table])).order_by(*t.primary_key.columns)
+                    for row in conn.execution_options(yield_per=STREAM_CHUNK).execute(stmt).mappings():
+                        yield table, dict(row)
+        except SQLAlchemyError as e:
+            raise StorageError(e) from e
+
+    def import_clear(self):
+        for model in self._TABLE_MODELS.values():
+            db.session.execute(delete(model))
+
+    def import_rows(self, table: str, rows: list[dict[str, Any]]):
+        if table == 'history':
+            rows = [{k: v for k, v in row.items() if k != 'id'} for row in rows]
+        if rows:
+            # executemany (SQLAlchemy 会合并为多行 INSERT)
+            db.session.execute(insert(self._TABLE_MODELS[table]), rows)
+
+
+class MemoryBackend(Backend):
+    '''
+    纯内存存储后端 (`memory://`)
+    - 数据只保存在进程内, 重启后丢失 (适合 Serverless / 测试)
+    - 所有修改都以操作 (`_op_*`) 的形式执行, 事务中记录撤销函数用于回滚
+    '''
+    name = 'memory'
+
+    def __init__(self, config: ConfigModel):
+        self._c = config
+        self._lock = RLock()
+        '''在事务 / 读取期间持有'''
+        self._local = local()
+        self._main: dict[str, Any] = {'status': 0, 'private_mode': False, 'last_updated': time()}
+        self._devices: dict[str, dict[str, Any]] = {}
+        self._history: list[dict[str, Any]] = []
+        '''设备状态历史 (按 id 升序)'''
+        self._history_id = 0
+        '''最后一条历史记录的 id'''
+        self._metrics: dict[tuple[str, int, int], int] = {}
+        '''`(路径, 桶开始时间, 桶长度)` -> 次数'''
+        self._plugins: dict[str, dict[str, Any]] = {}
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'undo', None) is not None:
+            # 嵌套 -> 并入外层事务
+            yield
+            return
+        with self._lock:
+            self._local.undo = []
+            self._local.ops = []
+            try:
+                yield
+                self._commit(self._local.ops)
+            except:
+                for undo in reversed(self._local.undo):
+                    undo()
+                raise
+            finally:
+                self._local.undo = None
+                self._local.ops = None
+
+    def _commit(self, ops: list[list]):
+        '''
+        事务提交时调用 (子类可在此持久化操作, 抛出异常时事务回滚)
+
+        :param ops: 事务中执行的操作 (`[操作名, *参数]`)
+        '''
+
+    def _apply(self, op: str, *args):
+        '''
+        执行操作并记录 (需在 `transaction()` 内调用)
+        '''
+        undo = getattr(self, f'_op_{op}')(*args)
+        self._local.undo.append(undo)
+        self._local.ops.append([op, *args])
+
+    # --- 操作 (返回撤销函数, 参数需可序列化为 json)
+
+    def _op_main(self, values: dict[str, Any]):
+        old = {k: self._main.get(k) for k in values}
+        self._main.update(values)
+        return lambda: self._main.update(old)
+
+    def _op_device_set(self, row: dict[str, Any]):
+        id = row['id']
+        old = self._devices.get(id)
+        self._devices[id] = row
+
+        def undo():
+            if old is None:
+                self._devices.pop(id, None)
+            else:
+                self._devices[id] = old
+        return undo
+
+    def _op_device_update(self, id: str, values: dict[str, Any]):
+        old = self._devices[id]
+        self._devices[id] = {**old, **values}
+        return lambda: self._devices.update({id: old})
+
+    def _op_device_del(self, id: str):
+        old = self._devices.pop(id, None)
+
+        def undo():
+            if old is not None:
+                self._devices[id] = old
+        return undo
+
+    def _op_device_clear(self):
+        old = self._devices
+        self._devices = {}
+        return lambda: setattr(self, '_devices', old)
+
+    def _op_history_add(self, row: dict[str, Any]):
+        old_id = self._history_id
+        self._history.append(row)
+        self._history_id = max(old_id, row['id'])
+
+        def undo():
+            self._history.pop()
+            self._history_id = old_id
+        return undo
+
+    def _op_history_trim(self, before: float, min_id: int):
+        old = self._history
+        self._history = [h for h in old if h['timestamp'] >= before and h['id'] >= min_id]
+        return lambda: setattr(self, '_history', old)
+
+    def _op_metrics_add(self, path: str, start: int, span: int, count: int):
+        key = (path, start, span)
+        old = self._metrics.get(key)
+        self._metrics[key] = (old or 0) + count
+
+        def undo():
+            if old is None:
+                self._metrics.pop(key, None)
+            else:
+                self._metrics[key] = old
+        return undo
+
+    def _op_metrics_del(self, path: str | None, span: int | None, before: int | None):
+        removed = {k: v for k, v in self._metrics.items() if (path is None or k[0] == path) and (span is None or k[2] == span) and (before is None or k[1] < before)}
+        for k in removed:
+            del self._metrics[k]
+        return lambda: self._metrics.update(removed)
+
+    def _op_plugin_set(self, plugin_id: str, key: str, value: Any):
+        data = self._plugins.setdefault(plugin_id, {})
+        exists, old = key in data, data.get(key)
+        data[key] = value
+
+        def undo():
+            if exists:
+                data[key] = old
+            else:
+                data.pop(key, None)
+        return undo
+
+    def _op_plugin_del(self, plugin_id: str, key: str):
+        data = self._plugins.get(plugin_id, {})
+        exists, old = key in data, data.pop(key, None)
+
+        def undo():
+            if exists:
+                self._plugins.setdefault(plugin_id, {})[key] = old
+        return undo
+
+    def _op_clear(self):
+        old = (self._devices, self._history, self._history_id, self._metrics, self._plugins)
+        self._devices, self._history, self._history_id, self._metrics, self._plugins = {}, [], 0, {}, {}
+
+        def undo():
+            self._devices, self._history, self._history_id, self._metrics, self._plugins = old
+        return undo
+
+    # --- main
+
+    def main_get(self) -> dict[str, Any]:
+        with self._lock:
+            return dict(self._main)
+
+    def main_set(self, **values: Any):
+        self._apply('main', values)
+
+    # --- device
+
+    def device_get(self, id: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._devices.get(id)
+            return dict(row) if row else None
+
+    def device_all(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self._devices.values()]
+
+    def device_upsert(self, row: dict[str, Any]):
+        self._apply('device_set', deepcopy(row))
+
+    def device_update(self, id: str, values: dict[str, Any]):
+        self._apply('device_update', id, deepcopy(values))
+
+    def device_delete(self, id: str) -> bool:
+        if id not in self._devices:
+            return False
+        self._apply('device_del', id)
+        return True
+
+    def device_clear(self) -> int:
+        count = len(self._devices)
+        self._apply('device_clear')
+        return count
+
+    # --- history
+
+    def history_add(self, row: dict[str, Any]):
+        self._apply('history_add', dict(row, id=self._history_id + 1))
+
+    def history_query(self, id: str | None, start: float | None, end: float | None, limit: int, cursor: int | None) -> list[dict[str, Any]]:
+        ret = []
+        with self._lock:
+            for h in reversed(self._history):
+                if len(ret) >= limit:
+                    break
+                if (cursor is not None and h['id'] >= cursor) or (id is not None and h['device_id'] != id) \
+                        or (start is not None and h['timestamp'] < start) or (end is not None and h['timestamp'] >= end):
+                    continue
+                ret.append({
+                    'id': h['id'],
+                    'device_id': h['device_id'],
+                    'time': h['timestamp'],
+                    'show_name': h['show_name'],
+                    'using': h['using'],
+                    'status': h['status']
+                })
+        return ret
+
+    def history_cleanup(self, before: float | None, max_rows: int) -> int:
+        count = len(self._history)
+        min_id = self._history[-max_rows]['id'] if 0 < max_rows < count else 0
+        self._apply('history_trim', before or 0, min_id)
+        return count - len(self._history)
+
+    # --- metrics
+
+    def metrics_add(self, counts: dict[tuple[str, int, int], int]):
+        for (path, start, span), count in counts.items():
+            self._apply('metrics_add', path, start, span, count)
+
+    def metrics_reset(self, path: str, start: int, count: int):
+        self._apply('metrics_del', path, None, None)
+        self._apply('metrics_add', path, start, HOUR, count)
+
+    def metrics_summary(self, periods: tuple[int, int, int, int], path: str | None) -> dict[str, list[int]]:
+        ret: dict[str, list[int]] = {}
+        with self._lock:
+            for (p, start, span), count in self._metrics.items():
+                if path is not None and p != path:
+                    continue
+                counts = ret.setdefault(p, [0, 0, 0, 0, 0])
+                for i, period_start in enumerate(periods):
+                    if start >= period_start:
+                        counts[i] += count
+                counts[4] += count
+        return ret
+
+    def metrics_range(self, path: str | None, start: int, end: int, step: int) -> dict[int, int]:
+        ret: Counter[int] = Counter()
+        with self._lock:
+            for (p, bucket_start, span), count in self._metrics.items():
+                if (path is None or p == path) and start <= bucket_start < end:
+                    ret[(bucket_start - start) // step] += count
+        return dict(ret)
+
+    def metrics_compact(self, cutoff: int, day_start: Callable[[int], int]) -> int:
+        days: Counter[tuple[str, int, int]] = Counter()
+        for (path, start, span), count in self._metrics.items():
+            if span == HOUR and start < cutoff:
+                days[(path, day_start(start), DAY)] += count
+        if days:
+            self._apply('metrics_del', None, HOUR, cutoff)
+            self.metrics_add(days)
+        return len(days)
+
+    # --- plugin
+
+    def plugin_all(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return deepcopy(self._plugins)
+
+    def plugin_write(self, upserts: list[tuple[str, str, Any]], deletes: list[tuple[str, str]]):
+        for plugin_id, key, value in upserts:
+            self._apply('plugin_set', plugin_id, key, deepcopy(value))
+        for plugin_id, key in deletes:
+            self._apply('plugin_del', plugin_id, key)
+
+    # --- 导出 / 导入
+
+    def export_rows(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        # 只在持有锁时复制引用, 导出期间不阻塞写入 (行在修改时会被替换而不是原地修改)
+        with self._lock:
+            main = dict(self._main)
+            devices = sorted(self._devices.values(), key=lambda row: row['id'])
+            history, history_count = self._history, len(self._history)
+            metrics = sorted(self._metrics.items())
+            plugins = sorted((plugin_id, key, value) for plugin_id, data in self._plugins.items() for key, value in data.items())
+        yield 'main', main
+        for row in devices:
+            yield 'device', {k: row.get(k) for k in TABLES['device']}
+        for i in range(history_count):
+            yield 'history', history[i]
+        for (path, start, span), count in metrics:
+            yield 'metrics', {'path': path, 'start': start, 'span': span, 'count': count}
+        for plugin_id, key, value in plugins:
+            yield 'plugin', {'plugin_id': plugin_id, 'key': key, 'value': value}
+
+    def import_clear(self):
+        self._apply('clear')
+
+    def import_rows(self, table: str, rows: list[dict[str, Any]]):
+        if table == 'device':
+            for row in rows:
+                self._apply('device_set', deepcopy(row))
+        elif table == 'history':
+            for row in rows:
+                self.history_add({k: v for k, v in row.items() if k != 'id'})
+        elif table == 'metrics':
+            self.metrics_add({(row['path'], row['start'], row['span']): row['count'] for row in rows})
+        elif table == 'plugin':
+            for row in rows:
+                self._apply('plugin_set', row['plugin_id'], row['key'], deepcopy(row['value']))
+
+    # --- 快照
+
+    def _dump(self) -> dict[str, Any]:
+        '''
+        导出全部数据 (需持有 `self._lock`)
+        '''
+        return {
+            'main': self._main,
+            'devices': list(self._devices.values()),
+            'history': self._history,
+            'history_id': self._history_id,
+            'metrics': [[path, start, span, count] for (path, start, span), count in self._metrics.items()],
+            'plugins': self._plugins
+        }
+
+    def _load(self, data: dict[str, Any]):
+        '''
+        载入全部数据 (`_dump()` 的返回)
+        '''
+        self._main.update(data['main'])
+        self._devices = {row['id']: row for row in data['devices']}
+        self._history = data['history']
+        self._history_id = data['history_id']
+        self._metrics = {(path, start, span): count for path, start, span, count in data['metrics']}
+        self._plugins = data['plugins']
+
+
+class JournalBackend(MemoryBackend):
+    '''
+    内存 + 追加日志存储后端 (`memory:///文件路径`)
+    - 每个事务提交时向日志文件追加一行 (`{"seq": 序号, "ops": [操作...]}`)
+    - 定期 (`main.storage_options.memory_snapshot_interval`) 及退出时将全部数据写入快照文件 (`<路径>.snapshot`), 并清空日志
+    - 启动时载入快照, 再重放日志中序号更大的事务
+    '''
+    name = 'memory+journal'
+
+    def __init__(self, config: ConfigModel, path: str):
+        super().__init__(config)
+        self._path = path
+        self._snapshot_path = path + '.snapshot'
+        self._fsync = config.main.storage_options.memory_journal_fsync
+        self._seq = 0
+        '''最后一个已提交事务的序号'''
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._restore()
+        self._journal = open(path, 'a', encoding='utf-8')
+        l.info(f'[data] database: {self.name}, journal: {path} (seq {self._seq}, {len(self._devices)} devices)')
+
+    def _restore(self):
+        '''
+        载入快照并重放日志
+        '''
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._load(data)
+            self._seq = data['seq']
+        if not os.path.exists(self._path):
+            return
+        replayed = 0
+        with open(self._path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 写入中断的最后一行
+                    l.warning(f'[data] ignored broken journal entry after seq {self._seq}')
+                    break
+                if entry['seq'] <= self._seq:
+                    continue  # 已包含在快照中
+                for op, *args in entry['ops']:
+                    getattr(self, f'_op_{op}')(*args)
+                self._seq = entry['seq']
+                replayed += 1
+        l.debug(f'[data] replayed {replayed} journal entries')
+
+    def _commit(self, ops: list[list]):
+        if not ops:
+            return
+        try:
+            self._journal.write(json.dumps({'seq': self._seq + 1, 'ops': ops}, ensure_ascii=False) + '\n')
+            self._journal.flush()
+            if self._fsync:
+                os.fsync(self._journal.fileno())
+        except (OSError, TypeError, ValueError) as e:
+            raise StorageError(f'failed to write journal: {e}') from e
+        self._seq += 1
+
+    def snapshot(self):
+        perf = u.perf_counter()
+        with self._lock:
+            tmp = self._snapshot_path + '.tmp'
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(dict(self._dump(), seq=self._seq), f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self._snapshot_path)
+                # 快照已包含所有事务, 清空日志
+                self._journal.close()
+                self._journal = open(self._path, 'w', encoding='utf-8')
+            except OSError as e:
+                l.error(f'[data] failed to save snapshot: {e}')
+                if self._journal.closed:
+                    self._journal = open(self._path, 'a', encoding='utf-8')
+                return
+        l.debug(f'[data] snapshot saved (seq {self._seq}), took {perf()}ms')
+
+    def close(self):
+        self.snapshot()
+        with self._lock:
+            self._journal.close()
+
+
+def create_backend(config: ConfigModel, app: Flask) -> Backend:
+    '''
+    按 `main.database` 创建存储后端
+    - `memory://`: 纯内存
+    - `memory:///路径`: 内存 + 日志文件 (相对路径同 SQLite, 基于 Flask instance 目录)
+    - 其他: SQL 数据库
+    '''
+    url = config.main.database
+    if url.startswith('memory:'):
+        path = url[len('memory:'):]
+        path = path[3:] if path.startswith('///') else path.lstrip('/')
+        if not path:
+            l.info(f'[data] database: memory (data will be lost on exit)')
+            return MemoryBackend(config)
+        return JournalBackend(config, os.path.normpath(os.path.join(app.instance_path, path)))
+    return SqlBackend(config, app)
+
+# endregion backend
@@ -0,0 +1,28 @@
+# coding: utf-8
+'''
+测试公共设置: 将仓库根目录加入 `sys.path` (测试直接导入 `utils` / `scheduler` 等模块), 及主程序的测试客户端
+'''
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+'''仓库根目录'''
+
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope='session')
+def client():
+    '''
+    主程序的 Flask 测试客户端 (使用内存存储, 整个测试过程只导入一次主程序)
+    '''
+    os.chdir(ROOT)
+    os.environ['SLEEPY_MAIN_DATABASE'] = 'memory://'
+    os.environ['SLEEPY_MAIN_SECRET'] = 'test-secret'
+    os.environ['SLEEPY_MAIN_DEBUG'] = 'false'
+    import main
+    return main.app.test_client()
@@ -0,0 +1,154 @@
+# coding: utf-8
+'''
+ASGI 模式 (`asgi.py`) 测试: 在子进程中用 uvicorn 启动服务 (内存存储), 通过真实的 HTTP 连接测试
+'''
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from http.client import HTTPConnection, HTTPResponse
+from typing import Iterator
+
+import pytest
+
+from conftest import ROOT
+
+pytest.importorskip('uvicorn')
+
+SECRET = 'test-secret'
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def server() -> Iterator[int]:
+    '''
+    启动 ASGI 服务
+
+    :return: 端口
+    '''
+    port = _free_port()
+    env = os.environ | {
+        'SLEEPY_MAIN_DATABASE': 'memory://',
+        'SLEEPY_MAIN_SECRET': SECRET,
+        'SLEEPY_MAIN_HOST': '127.0.0.1',
+        'SLEEPY_MAIN_PORT': str(port),
+        'SLEEPY_MAIN_DEBUG': 'false'
+    }
+    proc = subprocess.Popen([sys.executable, 'asgi.py'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                _get(port, '/api/status/query')
+                break
+            except OSError:
+                if proc.poll() is not None or time.time() > deadline:
+                    pytest.fail('asgi server did not start')
+                time.sleep(0.2)
+        yield port
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def _get(port: int, path: str, secret: bool = False) -> tuple[int, dict]:
+    conn = HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', path, headers={'Sleepy-Secret': SECRET} if secret else {})
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read())
+    finally:
+        conn.close()
+
+
+def _stream(port: int, path: str = '/api/status/events', last_event_id: int | None = None) -> tuple[HTTPConnection, HTTPResponse]:
+    conn = HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path, headers={'Last-Event-ID': str(last_event_id)} if last_event_id else {})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader('Content-Type', '').startswith('text/event-stream')
+    return conn, resp
+
+
+def _next_event(resp: HTTPResponse, skip: tuple[str, ...] = ('heartbeat',)) -> dict[str, str]:
+    '''
+    读取下一个 SSE 事件 (跳过注释及 `skip` 中的事件)
+
+    :return: `{"id": ..., "event": ..., "data": ...}`
+    '''
+    while True:
+        fields: dict[str, str] = {}
+        while (line := resp.readline()) not in (b'\n', b''):
+            key, _, value = line.decode().rstrip('\n').partition(': ')
+            if key:
+                fields[key] = value
+        assert line, 'stream closed'
+        if fields and fields.get('event') not in skip:
+            return fields
+
+
+def test_normal_routes(server: int):
+    status, ret = _get(server, '/api/status/query')
+    assert status == 200
+    assert ret['success'] is True
+    status, ret = _get(server, '/api/status/set?status=0', secret=True)
+    assert status == 200
+
+
+def test_sse_update(server: int):
+    conn, resp = _stream(server)
+    try:
+        first = _next_event(resp)
+        assert first['event'] == 'update'
+        _get(server, '/api/status/set?status=1', secret=True)
+        second = _next_event(resp)
+        assert second['event'] == 'update'
+        assert int(second['id']) > int(first['id'])
+        assert json.loads(second['data'])['status']['id'] == 1
+    finally:
+        conn.close()
+
+
+def test_sse_resume(server: int):
+    conn, resp = _stream(server)
+    last_id = int(_next_event(resp)['id'])
+    conn.close()
+    _get(server, '/api/status/set?status=0', secret=True)
+    _get(server, '/api/status/set?status=1', secret=True)
+    resumed = _get(server, '/api/stats', secret=True)[1]['stats'].get('sse_resumed', 0)
+
+    conn, resp = _stream(server, last_event_id=last_id)
+    try:
+        missed = [_next_event(resp), _next_event(resp)]
+        assert [json.loads(e['data'])['status']['id'] for e in missed] == [0, 1]
+        assert last_id < int(missed[0]['id']) < int(missed[1]['id'])
+        assert _get(server, '/api/stats', secret=True)[1]['stats']['sse_resumed'] == resumed + 1
+    finally:
+        conn.close()
+
+
+def test_many_streams(server: int):
+    n = 200
+    streams = [_stream(server, '/api/status/events' if i % 2 else '/events') for i in range(n)]
+    try:
+        for _, resp in streams:
+            _next_event(resp)
+        assert _get(server, '/api/stats', secret=True)[1]['stats']['sse_subscribers'] >= n
+        _get(server, '/api/status/set?status=0', secret=True)
+        _get(server, '/api/status/set?status=1', secret=True)
+        for _, resp in streams:
+            assert _next_event(resp)['event'] == 'update'
+    finally:
+        for conn, _ in streams:
+            conn.close()
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+import pytest
+
+from broadcast import Broadcaster, Channel, RESUMED
+from scheduler import Scheduler
+
+
+@pytest.fixture
+def broadcaster() -> Broadcaster:
+    # 不启动广播线程, 由测试直接调用 `Channel.publish()`
+    return Broadcaster(lambda revision, timeout: revision, 0, Scheduler('UTC'), replay_size=4, replay_bytes=1 << 20)
+
+
+def _channel(b: Broadcaster) -> tuple[Channel, list[int]]:
+    '''
+    :return: (频道, 已发布的事件 id)
+    '''
+    n = iter(range(1000))
+    ch = b.channel('test', lambda: f'data-{next(n)}', snapshot=lambda: 'snapshot')
+    ch._touch()  # 模拟订阅者刚断开: 在 `RESUME_GRACE` 内仍记录事件
+    return ch, []
+
+
+def _publish(ch: Channel, b: Broadcaster, ids: list[int], count: int):
+    for _ in range(count):
+        b.event_id += 1
+        ch.publish(b.event_id)
+        ids.append(b.event_id)
+
+
+def _resume(ch: Channel, last_event_id: int | None):
+    with ch._lock:
+        return ch._resume(last_event_id)
+
+
+def test_resume_hit(broadcaster: Broadcaster):
+    ch, ids = _channel(broadcaster)
+    _publish(ch, broadcaster, ids, 3)
+    missed, current = _resume(ch, ids[0])
+    assert current == ids[-1]
+    assert missed == [f'id: {ids[1]}\nevent: update\ndata: data-1\n\n'.encode(), f'id: {ids[2]}\nevent: update\ndata: data-2\n\n'.encode()]
+
+
+def test_resume_up_to_date(broadcaster: Broadcaster):
+    ch, ids = _channel(broadcaster)
+    _publish(ch, broadcaster, ids, 2)
+    assert _resume(ch, ids[-1]) == ([], ids[-1])
+    # 没有错过的事件: 只发送注释
+    stream = ch.stream(ids[-1])
+    assert next(stream) == RESUMED
+    stream.close()
+
+
+def test_resume_miss_beyond_ring(broadcaster: Broadcaster):
+    ch, ids = _channel(broadcaster)
+    _publish(ch, broadcaster, ids, 10)
+    # 只保留最近 4 个事件
+    assert _resume(ch, ids[4])[0] is None
+    assert len(_resume(ch, ids[5])[0]) == 4
+    # 无法补发时发送完整数据
+    stream = ch.stream(ids[0])
+    assert next(stream) == f'id: {ids[-1]}\nevent: update\ndata: snapshot\n\n'.encode()
+    stream.close()
+
+
+def test_resume_unknown_id(broadcaster: Broadcaster):
+    ch, ids = _channel(broadcaster)
+    _publish(ch, broadcaster, ids, 2)
+    assert _resume(ch, ids[-1] + 1)[0] is None  # 来自重启前 / 其他服务器
+    assert _resume(ch, None)[0] is None
+
+
+def test_resume_gap_without_subscribers(broadcaster: Broadcaster):
+    ch, ids = _channel(broadcaster)
+    _publish(ch, broadcaster, ids, 2)
+    ch._left_at = 0  # 超过 `RESUME_GRACE`: 不再记录, 之前的事件不再连续
+    _publish(ch, broadcaster, ids, 1)
+    assert _resume(ch, ids[0])[0] is None
+    assert _resume(ch, ids[-1]) == ([], ids[-1])
+
+
+def test_events_bad_last_event_id(client):
+    resp = client.get('/api/status/events', headers={'Last-Event-ID': 'abc'})
+    assert resp.status_code == 400
+    assert resp.get_json()['success'] is False
@@ -0,0 +1,88 @@
+# coding: utf-8
+'''
+数据导入 (`/api/admin/import` / `Data.import_data()`) 测试
+'''
+
+import json
+from threading import Event, Thread
+
+import pytest
+
+SECRET = {'Sleepy-Secret': 'test-secret'}
+NDJSON = {'Content-Type': 'application/x-ndjson'}
+
+
+def _export(client) -> list[str]:
+    resp = client.get('/api/admin/export', headers=SECRET)
+    assert resp.status_code == 200
+    return resp.get_data(as_text=True).splitlines()
+
+
+def _state(client) -> tuple[dict, dict]:
+    ret = client.get('/api/status/query').get_json()
+    return ret['status'], ret['device']
+
+
+def _bad_exports(lines: list[str]) -> list[list[str]]:
+    device = json.loads(lines[1])
+    device.update(type='device', data={'id': 'import-new', 'show_name': 'New', 'using': True, 'status': 'x',
+                                       'fields': {}, 'last_updated': 0.0, 'ttl': None})
+    return [
+        lines[:-1],  # 缺少 end
+        lines[:-1] + [json.dumps(device), lines[-1]],  # 行数不符
+        lines[:2] + ['{not json'] + lines[2:],  # 中途有误
+    ]
+
+
+@pytest.fixture
+def device(client):
+    client.get('/api/device/set?id=import-dev&show_name=Dev&using=true&status=vim', headers=SECRET)
+    yield
+    client.get('/api/device/remove?id=import-dev', headers=SECRET)
+
+
+def test_import_failed_unchanged(client, device):
+    lines = _export(client)
+    before = _state(client)
+    for bad in _bad_exports(lines):
+        resp = client.post('/api/admin/import', data='\n'.join(bad), headers=SECRET | NDJSON)
+        assert resp.status_code == 400
+        assert _state(client) == before
+        assert 'import-new' not in client.get('/api/status/query').get_json()['device']
+
+
+def test_import_roundtrip(client, device):
+    lines = _export(client)
+    before = _state(client)
+    client.get('/api/device/remove?id=import-dev', headers=SECRET)
+    resp = client.post('/api/admin/import', data='\n'.join(lines), headers=SECRET | NDJSON)
+    assert resp.status_code == 200
+    assert resp.get_json()['imported']['device'] == len(before[1])
+    assert _state(client) == before
+
+
+def test_import_does_not_block_reads(client, device):
+    import main
+    lines = _export(client)
+    started, release = Event(), Event()
+
+    def slow_upload():
+        yield lines[0]
+        started.set()
+        release.wait(10)
+        yield from lines[1:]
+
+    result = {}
+    t = Thread(target=lambda: result.update(main.d.import_data(slow_upload())))
+    t.start()
+    try:
+        assert started.wait(10)
+        # 上传未结束时读取 / 写入不应等待导入
+        reader = Thread(target=main.d.snapshot)
+        reader.start()
+        reader.join(2)
+        assert not reader.is_alive()
+    finally:
+        release.set()
+        t.join(10)
+    assert result['device'] == len(_state(client)[1])
@@ -0,0 +1,88 @@
+# coding: utf-8
+
+from threading import Event
+from time import time, sleep
+
+import pytest
+
+from scheduler import Scheduler
+
+
+@pytest.fixture
+def sch():
+    s = Scheduler('UTC', name='test-scheduler')
+    s.start()
+    yield s
+    s.shutdown()
+
+
+def test_call_at_runs_in_time_order(sch: Scheduler):
+    ran = []
+    done = Event()
+    now = time()
+    sch.call_at(now + 0.15, lambda: (ran.append('c'), done.set()), name='c')
+    sch.call_at(now + 0.05, lambda: ran.append('a'), name='a')
+    sch.call_at(now + 0.10, lambda: ran.append('b'), name='b')
+    assert done.wait(2)
+    assert ran == ['a', 'b', 'c']
+
+
+def test_same_time_keeps_insertion_order(sch: Scheduler):
+    ran = []
+    done = Event()
+    when = time() + 0.05
+    for name in 'abc':
+        sch.call_at(when, lambda name=name: ran.append(name), name=name)
+    sch.call_at(when, done.set, name='done')
+    assert done.wait(2)
+    assert ran == ['a', 'b', 'c']
+
+
+def test_cancel_before_run(sch: Scheduler):
+    ran = []
+    done = Event()
+    now = time()
+    job = sch.call_at(now + 0.05, lambda: ran.append('cancelled'), name='cancelled')
+    sch.call_at(now + 0.10, done.set, name='done')
+    job.cancel()
+    assert job not in sch.jobs
+    assert done.wait(2)
+    assert ran == []
+
+
+def test_cancel_stops_interval_job(sch: Scheduler):
+    ran = []
+    job = sch.every(0.02, lambda: ran.append(time()), run_now=True)
+    sleep(0.1)
+    job.cancel()
+    sleep(0.02)  # 取消时可能正在执行
+    count = len(ran)
+    assert count >= 2
+    sleep(0.1)
+    assert len(ran) == count
+
+
+def test_jobs_sorted_by_next_run(sch: Scheduler):
+    now = time()
+    b = sch.call_at(now + 20, lambda: None, name='b')
+    a = sch.call_at(now + 10, lambda: None, name='a')
+    d = sch.daily('00:00', lambda: None, name='d')
+    jobs = sch.jobs
+    assert jobs.index(a) < jobs.index(b)
+    assert d in jobs
+    assert now < d.next_run <= now + 86400
+
+
+def test_every_rejects_non_positive_interval(sch: Scheduler):
+    with pytest.raises(ValueError):
+        sch.every(0, lambda: None)
+
+
+def test_shutdown_only_once():
+    s = Scheduler('UTC')
+    s.start()
+    assert s.shutdown()
+    assert not s.shutdown()
+    ran = Event()
+    s.call_at(time(), ran.set)
+    assert not ran.wait(0.1)
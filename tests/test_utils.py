@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import utils as u
+
+
+def test_merge_patch_null_deletes_key():
+    target = {'a': 1, 'b': 2}
+    result, changed = u.merge_patch(target, {'a': None})
+    assert result == {'b': 2}
+    assert changed
+    assert target == {'a': 1, 'b': 2}  # 不修改原字典
+
+
+def test_merge_patch_null_on_missing_key_is_noop():
+    target = {'a': 1}
+    result, changed = u.merge_patch(target, {'b': None})
+    assert result is target
+    assert not changed
+
+
+def test_merge_patch_nested():
+    target = {'app': {'pkg': 'x', 'title': 't'}, 'battery': 80}
+    result, changed = u.merge_patch(target, {'app': {'title': None, 'pid': 1}, 'net': {'wifi': True}})
+    assert result == {'app': {'pkg': 'x', 'pid': 1}, 'battery': 80, 'net': {'wifi': True}}
+    assert changed
+    assert target['app'] == {'pkg': 'x', 'title': 't'}
+
+
+def test_merge_patch_nested_replaces_non_dict():
+    result, changed = u.merge_patch({'a': 1}, {'a': {'b': 2, 'c': None}})
+    assert result == {'a': {'b': 2}}
+    assert changed
+
+
+def test_merge_patch_no_change_returns_target():
+    target = {'a': {'b': [1, 2]}, 'c': 'x'}
+    result, changed = u.merge_patch(target, {'a': {'b': [1, 2]}, 'c': 'x'})
+    assert result is target
+    assert not changed
+
+
+def test_merge_patch_type_change_is_change():
+    result, changed = u.merge_patch({'a': 1}, {'a': True})
+    assert result == {'a': True}
+    assert changed
+
+
+def test_merge_patch_shares_unchanged_subdicts():
+    target = {'a': {'x': 1}, 'b': {'y': 2}}
+    result, changed = u.merge_patch(target, {'b': {'y': 3}})
+    assert changed
+    assert result['a'] is target['a']
+    assert result['b'] == {'y': 3}
+
+
+def test_dict_stats():
+    assert u.dict_stats({}) == (0, 1)
+    assert u.dict_stats({'a': 1, 'b': {'c': [{'d': 1}]}}) == (4, 4)
@@ -0,0 +1,16 @@
+# coding: utf-8
+'''
+v4 兼容插件测试: 返回的设备列表需保持 v4 的格式
+'''
+
+SECRET = {'Sleepy-Secret': 'test-secret'}
+
+
+def test_query_device_shape(client):
+    resp = client.get('/api/device/set?id=v4-ttl&show_name=V4&using=true&status=vim&ttl=60', headers=SECRET)
+    assert resp.status_code == 200
+    try:
+        dev = client.get('/query').get_json()['device']['v4-ttl']
+        assert dev == {'show_name': 'V4', 'using': True, 'app_name': 'vim'}
+    finally:
+        client.get('/api/device/remove?id=v4-ttl', headers=SECRET)
@@ -77,8 +77,53 @@ ${last_updated}
     }
 }
 
+function applyPatch(data, patch) {
+    /*
+    增量更新使用 (将 patch 事件应用到当前数据上)
+    data: 当前数据 (update 事件返回, 会被直接修改)
+    patch: patch 事件返回数据
+    return: 是否成功 (失败说明缺少中间的变化, 需重新获取完整数据)
+    */
+    if (patch.base === null) {
+        // 完整数据
+        data.device = {};
+    } else if (patch.revision <= data.revision) {
+        // 已包含此次变化
+        return true;
+    } else if (patch.base > data.revision) {
+        return false;
+    }
+
+    for (const [key, value] of Object.entries(patch)) {
+        if (key === 'base' || key === 'revision' || key === 'order') {
+            continue;
+        }
+        if (key === 'device') {
+            // 每个设备为完整数据, null 表示已删除
+            for (const [id, device] of Object.entries(value)) {
+                if (device === null) {
+                    delete data.device[id];
+                } else {
+                    data.device[id] = device;
+                }
+            }
+        } else if (value === null) {
+            delete data[key];
+        } else {
+            data[key] = value;
+        }
+    }
+    if (patch.order) {
+        // 设备顺序有变化: 按服务器的顺序重新排列
+        data.device = Object.fromEntries(patch.order.filter(id => id in data.device).map(id => [id, data.device[id]]));
+    }
+    data.revision = patch.revision;
+    return true;
+}
+
 // 全局变量 - 重要：保证所有函数可访问
 let evtSource = null;
+let currentData = null; // 当前数据 (收到 update 事件时替换, 收到 patch 事件时修改)
 let reconnectInProgress = false;
 let countdownInterval = null;
 let delayInterval = null;
@@ -178,9 +223,10 @@ function setupEventSource() {
     if (evtSource) {
         evtSource.close();
     }
+    currentData = null;
 
-    // 创建新连接
-    evtSource = new EventSource('/api/status/events');
+    // 创建新连接 (增量模式: 先收到一次完整数据, 之后只收到变化的部分)
+    evtSource = new EventSource('/api/status/events?delta=1');
 
     // 监听连接打开事件
     evtSource.onopen = function () {
@@ -202,6 +248,7 @@ function setupEventSource() {
 
         // 处理更新数据
         if (data.success) {
+            currentData = data;
             updateDeviceStatus(data);
         } else {
             if (statusElement) {
@@ -214,6 +261,21 @@ function setupEventSource() {
         }
     });
 
+    // 监听增量更新事件
+    evtSource.addEventListener('patch', function (event) {
+        lastEventTime = Date.now(); // 更新最后收到消息的时间
+
+        const patch = JSON.parse(event.data);
+        console.log(`[SSE] [#${event.lastEventId}] 收到增量更新:`, patch);
+
+        if (!currentData || !applyPatch(currentData, patch)) {
+            console.warn('[SSE] 增量更新不连续，重新连接以获取完整数据...');
+            setupEventSource();
+            return;
+        }
+        updateDeviceStatus(currentData);
+    });
+
     // 监听心跳事件
     evtSource.addEventListener('heartbeat', function (event) {
         console.log(`[SSE] [#${event.lastEventId}] 收到心跳包`);
@@ -444,3 +444,66 @@ def deep_merge_dict(*dicts: dict) -> dict:
                     base[key] = value
 
     return base
+
+
+def merge_patch(target: dict, patch: dict) -> tuple[dict, bool]:
+    '''
+    按 JSON Merge Patch (RFC 7396) 合并字典, 并检测是否有实际变化 \n
+    - 值为 `None` 的键会被删除, 值为字典时递归合并, 其他值直接替换
+    - 不修改传入的字典, 只复制有变化的层级 *(未变化的子字典与原字典共享, 请勿原地修改结果)*
+    例:
+    ```
+    >>> merge_patch({'a': {'x': 1, 'y': 2}, 'b': 1}, {'a': {'y': None}, 'c': 3})
+    ({'a': {'x': 1}, 'b': 1, 'c': 3}, True)
+    >>> merge_patch({'a': 1}, {'a': 1, 'b': None})
+    ({'a': 1}, False)
+    ```
+
+    :param target: 原字典
+    :param patch: 要合并的修改
+    :return: (合并后的字典, 是否有变化) *(无变化时返回原字典本身)*
+    '''
+    result = None
+    for key, value in patch.items():
+        old = target.get(key)
+        if value is None:
+            # 删除
+            if key not in target:
+                continue
+            if result is None:
+                result = dict(target)
+            del result[key]
+            continue
+        if isinstance(value, dict):
+            # 递归合并 (原值不是字典时从空字典开始)
+            value, changed = merge_patch(old if isinstance(old, dict) else {}, value)
+            if not changed and isinstance(old, dict):
+                continue
+        elif key in target and type(old) is type(value) and old == value:
+            continue
+        if result is None:
+            result = dict(target)
+        result[key] = value
+    return (target, False) if result is None else (result, True)
+
+
+def dict_stats(value: Any) -> tuple[int, int]:
+    '''
+    统计嵌套结构中字典键的总数及最大嵌套深度 (字典 / 列表每层 +1)
+
+    :return: (键总数, 最大深度)
+    '''
+    keys = depth = 0
+    stack: list[tuple[Any, int]] = [(value, 1)]
+    while stack:
+        v, level = stack.pop()
+        if isinstance(v, dict):
+            keys += len(v)
+            items = v.values()
+        elif isinstance(v, list):
+            items = v
+        else:
+            continue
+        depth = max(depth, level)
+        stack.extend((i, level + 1) for i in items)
+    return keys, depth